@@ -3,21 +3,44 @@ may receive 1 or more ATCO-CIF files to process, then may be finally
 instructed to output a GTFS archive from the processed data."""
 
 
+import array
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import csv
 import datetime
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
 import os
+import queue
+import re
 import urllib.parse
+import shutil
 import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import tracemalloc
 import zipfile
 
+from atcociftogtfs.records import (
+    agency_record, route_record, service_record, stop_record
+)
+from atcociftogtfs import timecodec
+
 
 class atcocif:
     """Initialise with @param args Namespace. Then core functions:
         file(@param filename) - ATCO-CIF filename to process
         report() - logs Quality Assurance summary of data processed
         dump(@param filename) - create a GTFS from processed data
+        iter_table(@param table) - yields GTFS rows, without any file
     Maintain the same instance throughout (else unique IDs may duplicate).
     Del the instance to properly cleanup its sqlite database.
     """
@@ -26,50 +49,100 @@ class atcocif:
 
     agency_cache = {}
     """               Agency data from the current file, pending processing:
-                      agency_id: {name: str, phone: str}"""
+                      agency_id: agency_record(name: str, phone: str)"""
     agency_used = []  # List of agency_id currently used in at 1+ trip/route
     base_filename = None  # Currently processing this filename, excluding path
     date_format = "%Y%m%d"  # Same for both ATCO-CIF and GTFS
     day_offset = 0  # Days after trip start (manages 25+ hour-clock times)
+    diff = None  # Hash manifest filename compared and updated (None = none)
+    diff_manifest = None  # Manifest dict last computed by diff()
     bank_holidays = None  # List of datetimes (None = data missing)
+    columnar = None  # Columnar export directory (None = no export)
+    columnar_format = "parquet"  # Columnar export as: parquet, arrow
+    compact_calendar = False  # Merge and minimise calendars before dump
     directional_routes = False  # Unique route_ids by direction
+    duplicates = None  # Keep duplicate journeys: first, last, report (None)
     epsg = None  # EPSG code (None = skip coordinate processing)
+    exclude_agency = None  # List of operator codes to skip (None = none)
+    exclude_route = None  # List of route numbers to skip (None = none)
     file_num = 0  # Incrementing file counter
     final_date = None  # Final yyyymmdd date of service (default via __init__)
     grid = None  # Northing/Easting grid ref figures (None = guess)
     gtfs = None  # GTFS output zip filename (None = fail dump)
     in_trip = False  # Currently processing a trip_id
+    journey_duplicate = []  # List of (earlier trip_id, later trip_id) equal
+    output_format = "zip"  # GTFS output as: zip, directory, sqlite
+    include_agency = None  # List of operator codes to keep (None = all)
+    include_direction = None  # Direction to keep: I or O (None = both)
+    include_route = None  # List of route numbers to keep (None = all)
     last_hour = 0  # Hour of the last stop_time processed
     line_num = 0  # Incrementing file line counter
+    memory_phases = None  # Phase: memory use dict (via __init__)
+    memory_profile = False  # Record memory use per phase (with tracemalloc)
+    memory_report = None  # Memory profile JSON filename (None = none)
+    memory_stack = None  # Peaks of the phases in progress (via __init__)
     mode = 3  # GTFS mode code (3 = bus)
+    parent_stations = None  # Cluster stops within metres (None = none)
+    pattern_cache = None  # Stop pattern tuple: pattern_id (via database)
+    pattern_store = False  # Hold stop_times as shared patterns until dump
+    pipeline = False  # Read ahead and write to database in other threads
     pre_times = False  # Currently processing trip pre-stop times sequence
+    progress = None  # Seconds between progress events (None = none)
+    progress_callback = None  # Also called with each progress event dict
+    progress_state = None  # Progress of the file/dump underway (None = off)
     unique_ids = False  # Force unique IDs
     unsupported = {}  # Unsupported ATCO-CIF record ID: Count
     verbose = False  # Provide verbose feedback
+    warning_count = {}  # (file_num, category): count of line warnings
+    warning_limit = 10  # Line warnings logged per file and category
+    write_pending = None  # SQL: [parameters, ...] pending for writer thread
+    writer = None  # Pipeline writer [thread, queue, error] (None = serial)
     route_cache = {}
     """              Route data from the current file, pending processing:
-                     route_id: {agency: id, num: str, inbound: str,
-                         outbound: str}"""
+                     route_id: route_record(agency: id, num: str,
+                         inbound: str, outbound: str)"""
     route_duplicate = []  # List of route_id found in multiple files
     route_used = []  # List of route_id currently used in at least 1 trip
     school_term = None  # List of datetimes (None = data missing)
     sequence = 0  # Incrementing stop sequence
+    trip_buffer = None  # Current trip's stop_times rows, if pattern_store
+    trip_hash = None  # Running fingerprint of trip_open, if duplicates
+    trip_note = None  # trip_headsign of the latest journey
+    trip_open = None  # trip_id with stop_times pending _end_trip()
+    trip_route = None  # (operator_route, direction_id) of latest journey
+    shard = None  # List of [archive filename, route_id, ...] also dumped
+    shard_agency = False  # Also dump one archive per agency
+    skip_unchanged = False  # Skip output if diff() finds no changes
     service = {}
     """          Calendar/calendar_dates entries, processed at EoF
-                     service[trip_id]: {calendar: [calendar_list],
-                     calendar_dates: [[calendar_exception_list], [...]]]}
+                     service[trip_id]: service_record(calendar:
+                     [calendar_list], calendar_dates:
+                     [[calendar_exception_list], [...]]])
                  As respective tables, except no initial service_id"""
     stop_cache = {}
     """             Stop data from the current file, pending processing:
-                    stop_id: {name: str, easting: str, northing: str}"""
+                    stop_id: stop_record(name: str, easting: str,
+                        northing: str)"""
+    stop_cache_limit = None  # Max stop_cache entries (None = no limit)
+    stop_spilled = False  # Current file's stop_cache overflowed to database
+    stop_reference = None  # Stop reference CSV/sqlite filename (None = none)
+    stop_reference_priority = False  # Stop reference overrides ATCO-CIF
     stop_used = []  # List of stop_id currently used in at least 1 trip
     timezone = "Europe/London"  # IANA TZ
     trip_id = 0  # Incrementing trip_id
+    window_end = None  # Last yyyymmdd date to keep (None = no limit)
+    window_start = None  # First yyyymmdd date to keep (None = no limit)
 
     _arg_vars = [
-        "bank_holidays", "epsg", "directional_routes", "final_date",
-        "grid", "gtfs", "mode", "unique_ids",
-        "verbose", "school_term", "timezone"
+        "bank_holidays", "compact_calendar", "epsg", "directional_routes",
+        "exclude_agency", "exclude_route", "final_date", "grid", "gtfs",
+        "include_agency", "include_direction", "include_route", "mode",
+        "output_format", "shard", "shard_agency", "stop_cache_limit",
+        "stop_reference", "stop_reference_priority", "unique_ids", "verbose",
+        "school_term", "timezone", "window_end", "window_start", "columnar",
+        "columnar_format", "pattern_store", "duplicates", "diff",
+        "skip_unchanged", "warning_limit", "pipeline", "memory_report",
+        "progress", "progress_callback", "parent_stations"
     ]  # These variables can be overwritten by arguments of the same name
 
     _gtfs_structure = {
@@ -85,6 +158,8 @@ class atcocif:
             "stop_name": "TEXT",
             "stop_lat": "NUMERIC",  # Convert from ITM/etc Grid
             "stop_lon": "NUMERIC",  # Convert from ITM/etc Grid
+            "location_type": "INTEGER",  # 1 = Generated parent station
+            "parent_station": "TEXT",  # Generated by distance/name stem
         },
         "routes": {
             "route_id": "TEXT",  # 4-Character Operator + Route No
@@ -140,6 +215,46 @@ class atcocif:
        atcocif._gtfs_structure = {nastiness}, that is not accessible
        through arguments, thus only a local vulnerability."""
 
+    _gtfs_indexes = {
+        "agency": [("agency_id",)],
+        "stops": [("stop_id",)],
+        "routes": [("route_id",), ("agency_id",)],
+        "trips": [("trip_id",), ("route_id",), ("service_id",)],
+        "stop_times": [("trip_id", "stop_sequence"), ("stop_id",)],
+        "calendar": [("service_id",)],
+        "calendar_dates": [("service_id", "date")],
+    }  # GTFS table: [(columns indexed together), ...], for sqlite output
+
+    _columnar_types = {
+        "arrival_time": "time",
+        "departure_time": "time",
+        "stop_id": "dictionary",
+        "start_date": "date",
+        "end_date": "date",
+        "date": "date",
+    }  # Column: type for columnar export, where not as _gtfs_structure
+
+    _stop_stem_patterns = [
+        re.compile(r"\s*[(\[][^)\]]*[)\]]\s*$"),  # Bracketed
+        re.compile(
+            r"[\s,/-]+(?:(?:stand|stance|bay|stop|platform|gate)\s*"
+            r"[a-z0-9]{0,3}|[a-z]|\d+[a-z]?)$",
+            re.IGNORECASE,
+        ),  # Designation, letter or number
+    ]  # Removed in turn by stop_name_stem()
+
+    _tracing = {"lock": threading.Lock(), "users": 0, "owned": False}
+    """        Shared by every instance, so tracemalloc is started by the first
+               instance profiling memory, and stopped by the last:
+                   users: instances with a phase running
+                   owned: tracemalloc started here (not by the embedder)"""
+
+    _warm = {}
+    """        Loaded once and shared by every instance, so kept warm by
+               long-running processes (loader serve):
+                   ("dates", filename, mtime, size): [datetime, ...]
+                   ("transformer", epsg): pyproj.Transformer"""
+
     # -{ Init }---------------------------------------------------------------
 
     def __del__(self):
@@ -149,10 +264,21 @@ class atcocif:
             self.db.close()
 
     def __init__(self, args=None):
-        """Initialise with @param args Namespace."""
-
+        """Initialise with @param args Namespace. Containers accumulated
+        across files are created per instance, so that concurrent instances
+        (as loader serve) stay isolated."""
+
+        self.journey_duplicate = []
+        self.memory_phases = {}
+        self.memory_stack = []
+        self.route_duplicate = []
+        self.service = {}
+        self.unsupported = {}
+        self.warning_count = {}
         self.arguments(args=args)
         self.database(where="")
+        if self.stop_reference is not None:
+            self.reference_from_file(filename=self.stop_reference)
 
     def arguments(self, args=None):
         """Process @param args Namespace into internal values."""
@@ -168,24 +294,31 @@ class atcocif:
                         and value is not None
                     ):
                         setattr(
-                            atcocif,
+                            self,
                             key,
                             self.dates_from_file(filename=value)
                         )
                     else:
-                        setattr(atcocif, key, value)
+                        setattr(self, key, value)
 
         if self.final_date is None:
             self.final_date = self.date_years_hence(years_hence=1).strftime(
                 self.date_format
             )
 
+        if self.memory_report is not None:
+            self.memory_profile = True
+
+        if self.progress_callback is not None and self.progress is None:
+            self.progress = 1  # Embedders need only set the callback
+
     def database(self, where=""):
         """@return unpopulated GTFS-structured sqlite database object in
         @param where (by default, empty, so a temporary file that is primarily
         in memory but can use the hard drive if too large for memory)."""
 
-        self.db = sqlite3.connect(where)
+        self.db = sqlite3.connect(where, check_same_thread=False)
+        # Also used by the pipeline writer thread, one thread at a time
         c = self.db.cursor()
 
         for table, fields in self._gtfs_structure.items():
@@ -198,6 +331,9 @@ class atcocif:
                 table, ", ".join(sql_fields)
             ))  # nosec - See _gtfs_structure Security Issue
 
+        self.pattern_cache = {}
+        self.trip_buffer = []
+
         self.db.commit()
 
     def dates_from_file(self, filename=""):
@@ -208,6 +344,13 @@ class atcocif:
         dates = []
 
         try:
+            stat = os.stat(filename)
+            key = (
+                "dates", os.path.abspath(filename), stat.st_mtime, stat.st_size
+            )
+            if key in self._warm:
+                return list(self._warm[key])
+
             with open(filename, "r", newline="") as txt_file:
                 reader = csv.reader(txt_file, delimiter=",")
 
@@ -234,11 +377,105 @@ class atcocif:
                             )
                         )
 
+            self._warm[key] = list(dates)
+
         except Exception as e:
             logging.error("Failed to import dates file %s: %s", filename, e)
 
         return dates
 
+    def reference_from_file(self, filename=""):
+        """Loads external stop reference @param filename once, as the
+        temporary database table stop_reference, indexed by stop_id. The
+        file may be CSV with GTFS stops.txt columns (stop_id, stop_name,
+        stop_lat, stop_lon) or NaPTAN columns (ATCOCode, CommonName,
+        Latitude, Longitude), or a GTFS-structured sqlite database (such as
+        this class's db, saved by an earlier run), which is attached in
+        place rather than copied. @return 0 OK or 1 not."""
+
+        c = self.db.cursor()
+        columns = {
+            "stop_id": ["stop_id", "atcocode"],
+            "stop_name": ["stop_name", "commonname"],
+            "stop_lat": ["stop_lat", "latitude"],
+            "stop_lon": ["stop_lon", "longitude"],
+        }  # Accepted (lowercase) source column names
+
+        try:
+            with open(filename, "rb") as reference_file:
+                is_sqlite = reference_file.read(16) == b"SQLite format 3\x00"
+
+            if is_sqlite:
+                c.execute("""ATTACH DATABASE ? AS reference""", (filename,))
+                c.execute(
+                    """CREATE TEMP VIEW stop_reference AS SELECT stop_id,
+                    stop_name, stop_lat, stop_lon FROM reference.stops"""
+                )
+                return 0
+
+            c.execute(
+                """CREATE TEMP TABLE stop_reference (stop_id TEXT PRIMARY
+                KEY, stop_name TEXT, stop_lat NUMERIC, stop_lon NUMERIC)"""
+            )
+
+            with open(
+                filename, "r", newline="", encoding="utf-8-sig"
+            ) as csv_file:
+                reader = csv.reader(csv_file, delimiter=",")
+                head = [name.strip().lower() for name in next(reader)]
+                index = {}
+
+                for column, names in columns.items():
+                    for name in names:
+                        if name in head:
+                            index[column] = head.index(name)
+                            break
+
+                if "stop_id" not in index:
+                    raise ValueError("No stop_id or ATCOCode column")
+
+                def read(row, column):
+                    if column in index and index[column] < len(row):
+                        value = row[index[column]].strip()
+                        if value != "":
+                            return value
+                    return None
+
+                def rows():
+                    for row in reader:
+                        stop_id = read(row, "stop_id")
+                        if stop_id is None:
+                            continue
+                        try:
+                            stop_lat = float(read(row, "stop_lat") or 0)
+                            stop_lon = float(read(row, "stop_lon") or 0)
+                        except ValueError:
+                            stop_lat = 0
+                            stop_lon = 0
+                        yield (
+                            stop_id,
+                            read(row, "stop_name"),
+                            stop_lat,
+                            stop_lon,
+                        )
+
+                c.executemany(
+                    """INSERT OR REPLACE INTO temp.stop_reference (stop_id,
+                    stop_name, stop_lat, stop_lon) VALUES (?,?,?,?)""",
+                    rows()
+                )  # Streamed, so memory independent of reference size
+
+            self.db.commit()
+            return 0
+
+        except Exception as e:
+            logging.error(
+                "Failed to import stop reference %s: %s", filename, e
+            )
+            c.execute("""DROP TABLE IF EXISTS temp.stop_reference""")
+            self.stop_reference = None
+            return 1
+
     def date_years_hence(self, years_hence=1):
         """@return datetime of a date @param integer years_hence from
         today."""
@@ -256,82 +493,663 @@ class atcocif:
 
     # -{ Core }---------------------------------------------------------------
 
-    def dump(self, filename=None):
-        """Creates GTFS zip archive @param filename and writes in processed
-        data, @return 0 OK or 1 not."""
+    def cluster_stops(self):
+        """Clusters stops into generated parent stations: Stops within
+        self.parent_stations metres of each other (by projected grid
+        reference) whose names share a stem (see stop_name_stem()) are
+        joined, transitively. Stops are bucketed by stem and a grid of cells
+        that size, so only stops in neighbouring cells are compared, not all
+        pairs. Each cluster of 2+ stops gains a parent stop (location_type 1)
+        at their centroid, named by stem, which they reference as
+        parent_station. Replaces any earlier clustering. Run once all files
+        are processed (by default from dump() when self.parent_stations).
+        @return number of parent stations."""
+
+        c = self.db.cursor()
+        c.execute("""DELETE FROM stops WHERE location_type=1""")
+        c.execute(
+            """UPDATE stops SET parent_station=NULL WHERE parent_station IS
+            NOT NULL"""
+        )
+        self.db.commit()
+
+        c.execute(
+            """SELECT name FROM sqlite_temp_master WHERE type=? AND
+            name=?""",
+            ("table", "stop_grid"),
+        )
+        if c.fetchone() is None or self.parent_stations <= 0:
+            logging.warning(
+                "Parent stations need grid references (-e EPSG, with pyproj)"
+                " and a distance over 0. Skipped stop clustering."
+            )
+            return 0
+
+        c.execute(
+            """SELECT stops.stop_id, stop_name, stop_lat, stop_lon, easting,
+            northing FROM stops JOIN temp.stop_grid ON
+            stop_grid.stop_id=stops.stop_id ORDER BY stops.stop_id"""
+        )
+        stops = c.fetchall()
+        distance = float(self.parent_stations)
+        cells = {}  # (stem, cell x, cell y): [stops index, ...]
+        root = list(range(len(stops)))  # Union-find forest
+
+        def find(index):
+            while root[index] != index:
+                root[index] = root[root[index]]  # Path halving
+                index = root[index]
+            return index
+
+        for index, stop in enumerate(stops):
+            stem = self.stop_name_stem(name=stop[1]).lower()
+            if stem in ["", "unknown"]:
+                continue
+            x = int(stop[4] // distance)
+            y = int(stop[5] // distance)
+
+            for neighbour in itertools.product(
+                [x - 1, x, x + 1], [y - 1, y, y + 1]
+            ):
+                for other in cells.get((stem,) + neighbour, []):
+                    if (
+                        (stops[other][4] - stop[4]) ** 2
+                        + (stops[other][5] - stop[5]) ** 2
+                        <= distance ** 2
+                    ):
+                        root[find(index)] = find(other)
+
+            cells.setdefault((stem, x, y), []).append(index)
+
+        clusters = {}  # Root index: [stops index, ...] in stop_id order
+        for index in range(len(stops)):
+            clusters.setdefault(find(index), []).append(index)
+
+        parents = []
+        children = []
+        for members in clusters.values():
+            if len(members) < 2:
+                continue
+            parent_id = "station_{}".format(stops[members[0]][0])
+            parents.append((
+                parent_id,
+                self.stop_name_stem(name=stops[members[0]][1]),
+                round(
+                    sum(stops[index][2] for index in members) / len(members),
+                    8,
+                ),
+                round(
+                    sum(stops[index][3] for index in members) / len(members),
+                    8,
+                ),
+                1,
+            ))
+            children.extend(
+                (parent_id, stops[index][0]) for index in members
+            )
+
+        c.executemany(
+            """INSERT INTO stops (stop_id, stop_name, stop_lat, stop_lon,
+            location_type) VALUES (?,?,?,?,?)""",
+            parents
+        )
+        c.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS stop_parent (stop_id TEXT
+            PRIMARY KEY, parent_station TEXT)"""
+        )
+        c.execute("""DELETE FROM temp.stop_parent""")
+        c.executemany(
+            """INSERT INTO temp.stop_parent (parent_station, stop_id) VALUES
+            (?,?)""",
+            children
+        )
+        c.execute(
+            """UPDATE stops SET parent_station=(SELECT parent_station FROM
+            temp.stop_parent WHERE stop_parent.stop_id=stops.stop_id) WHERE
+            stop_id IN (SELECT stop_id FROM temp.stop_parent)"""
+        )  # Single pass, as stops is unindexed
+        self.db.commit()
+
+        if self.verbose:
+            logging.info(
+                "Clustered %s stops into %s parent stations.",
+                len(children),
+                len(parents),
+            )
+
+        return len(parents)
+
+    def compact(self):
+        """Compacts the whole calendar and calendar_dates tables: Services
+        whose active dates are identical (however expressed) are merged,
+        each remaining service is re-encoded with the fewest calendar_dates
+        rows, and trips service_id references are updated to match. Run once
+        all files are processed (by default from dump() when
+        self.compact_calendar)."""
+
+        c = self.db.cursor()
+
+        c.execute(
+            """SELECT service_id, monday, tuesday, wednesday, thursday,
+            friday, saturday, sunday, start_date, end_date FROM calendar
+            ORDER BY service_id ASC"""
+        )
+        calendars = c.fetchall()
+
+        exceptions = {}  # service_id: [[date, exception_type], [...]]
+        c.execute("""SELECT service_id, date, exception_type FROM
+            calendar_dates""")
+        for service_id, date, exception_type in c.fetchall():
+            if service_id not in exceptions:
+                exceptions[service_id] = []
+            exceptions[service_id].append([date, exception_type])
+
+        unique = {}  # frozenset of active dates: new service_id
+        remap = []  # (new service_id, old service_id)
+        insert_calendar = []
+        insert_dates = []
+
+        for row in calendars:
+            calendar = list(row[1:])
+            active = frozenset(self.calendar_active_dates(
+                calendar=calendar,
+                calendar_dates=exceptions.get(row[0], []),
+            ))
+
+            if active not in unique:
+                unique[active] = len(unique) + 1
+                encoded = self.calendar_encode(dates=active)
+                if encoded is None:  # Never runs
+                    encoded = [([0] * 7) + calendar[7:], []]
+                insert_calendar.append([unique[active]] + encoded[0])
+                for dates in encoded[1]:
+                    insert_dates.append([unique[active]] + dates)
+
+            remap.append((unique[active], row[0]))
+
+        c.execute("""DELETE FROM calendar""")
+        c.execute("""DELETE FROM calendar_dates""")
+        c.executemany(
+            """INSERT INTO calendar (service_id, monday, tuesday, wednesday,
+            thursday, friday, saturday, sunday, start_date, end_date) VALUES
+            (?,?,?,?,?,?,?,?,?,?)""",
+            insert_calendar
+        )
+        c.executemany(
+            """INSERT INTO calendar_dates (service_id, date, exception_type)
+            VALUES (?,?,?)""",
+            insert_dates
+        )
+        c.executemany(
+            """UPDATE trips SET service_id=? WHERE service_id=?""",
+            [ids for ids in remap if ids[0] != ids[1]]
+        )  # Safe in ascending order, since new service_id never exceeds old
+        self.db.commit()
+
+        if self.verbose:
+            logging.info(
+                "Compacted %s calendar(s) into %s, with %s calendar date(s).",
+                len(calendars),
+                len(insert_calendar),
+                len(insert_dates),
+            )
+
+    def diff_changes(self, filename=None):
+        """Compares the processed data with the hash manifest in @param
+        filename (by default self.diff), as written by the previous run's
+        diff_save(), and logs a summary of trips, routes and stops added,
+        removed and modified. The current manifest is held for diff_save().
+        @return dict keyed by manifest section (trips, routes, stops) of
+        dict keyed added, removed, modified, of lists of keys, or None if
+        there is no readable previous manifest."""
 
         if filename is None:
-            if self.gtfs is None:
-                return 1
-            filename = self.gtfs
+            filename = self.diff
+
+        self.diff_manifest = self.feed_manifest()
 
         try:
-            c = self.db.cursor()
-            zip = zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED)
+            with open(filename, "r", encoding="utf-8") as manifest_file:
+                previous = json.load(manifest_file)
+            if previous.get("format") != self.diff_manifest["format"]:
+                raise ValueError("unknown manifest format")
+
+        except FileNotFoundError:
+            logging.info("No previous manifest %s to compare.", filename)
+            return None
+
+        except (ValueError, AttributeError) as e:
+            logging.warning("Unreadable manifest %s: %s", filename, e)
+            return None
+
+        changes = {}
+        summary = []
+
+        for section in ["trips", "routes", "stops"]:
+            old = previous.get(section, {})
+            new = self.diff_manifest[section]
+            changes[section] = {
+                "added": sorted(key for key in new if key not in old),
+                "removed": sorted(key for key in old if key not in new),
+                "modified": sorted(
+                    key for key in new if key in old and new[key] != old[key]
+                ),
+            }
+            summary.append("{} {}".format(section, ", ".join(
+                "{} {}".format(len(keys), change)
+                for change, keys in changes[section].items()
+            )))
 
-            with tempfile.TemporaryDirectory() as temp_dir:
+            if self.verbose:
+                for change, keys in changes[section].items():
+                    for key in keys:
+                        logging.debug("%s %s: %s", section, change, key)
 
-                for table, fields in self._gtfs_structure.items():
-                    arcname = "{}.txt".format(table)
-                    path = os.path.join(temp_dir, arcname)
+        logging.info("Changes since %s: %s.", filename, "; ".join(summary))
 
-                    with open(
-                        path, "w", newline="", encoding="utf-8"
-                    ) as txtfile:
-                        head_names = []
+        return changes
 
-                        for field, type in fields.items():
-                            head_names.append(field)
+    def diff_save(self, filename=None):
+        """Writes the hash manifest last computed by diff_changes() (or the
+        current manifest, if none) to @param filename (by default
+        self.diff), replacing any previous manifest only once complete.
+        @return 0 OK or 1 not."""
 
-                        query = "SELECT {} FROM {}".format(
-                            ", ".join(head_names),
-                            table
-                        )  # nosec - See _gtfs_structure Security Issue
-                        c.execute(query)
-                        txt = csv.writer(
-                            txtfile, delimiter=",", quoting=csv.QUOTE_MINIMAL
-                        )
-                        txt.writerow(head_names)
+        if filename is None:
+            filename = self.diff
+
+        if self.diff_manifest is None:
+            self.diff_manifest = self.feed_manifest()
+
+        try:
+            with open(
+                "{}.tmp".format(filename), "w", encoding="utf-8"
+            ) as manifest_file:
+                json.dump(self.diff_manifest, manifest_file)
+            os.replace("{}.tmp".format(filename), filename)
+            return 0
+
+        except OSError as e:
+            logging.error("Failed to write manifest %s: %s", filename, e)
+            return 1
+
+    def expand_patterns(self):
+        """Writes every trip held in the pattern store (see pattern_store)
+        into the stop_times table, as full rows, then empties the store's
+        trip times. Patterns themselves are retained for reuse. @return
+        number of trips expanded."""
+
+        self._end_trip()
+
+        if not self.pattern_cache:
+            return 0  # Store unused
+
+        c = self.db.cursor()
+        write = self.db.cursor()
+        c.execute(
+            """SELECT trip_id, pattern_id, times FROM temp.trip_times ORDER BY
+            trip_id"""
+        )  # Trip order, as if written directly into stop_times
+        patterns = {}  # pattern_id: [(stop_sequence, ...), ...]
+        trips = 0
+        rows = c.fetchmany(1000)
+
+        while rows:
+            stop_times = []
+
+            for trip_id, pattern_id, times in rows:
+                if pattern_id not in patterns:
+                    write.execute(
+                        """SELECT stop_sequence, stop_id, pickup_type,
+                        drop_off_type, timepoint FROM temp.stop_patterns WHERE
+                        pattern_id=? ORDER BY stop_sequence ASC""",
+                        (pattern_id,),
+                    )
+                    patterns[pattern_id] = write.fetchall()
+
+                hhmm = array.array("h")
+                hhmm.frombytes(times)
+
+                for i, stop in enumerate(patterns[pattern_id]):
+                    stop_times.append(
+                        (
+                            trip_id,
+                            self.time_tuple_to_gtfs_str(
+                                time_tuple=divmod(hhmm[i * 2], 100)
+                            ),
+                            self.time_tuple_to_gtfs_str(
+                                time_tuple=divmod(hhmm[i * 2 + 1], 100)
+                            ),
+                        ) + stop
+                    )
+                trips += 1
+
+            write.executemany(
+                """INSERT INTO stop_times (trip_id, arrival_time,
+                departure_time, stop_sequence, stop_id, pickup_type,
+                drop_off_type, timepoint) VALUES (?,?,?,?,?,?,?,?)""",
+                stop_times,
+            )
+            rows = c.fetchmany(1000)
+
+        write.execute("""DELETE FROM temp.trip_times""")
+        self.db.commit()
+        return trips
+
+    def dump(self, filename=None, shards=None, combined=True):
+        """Creates GTFS zip archive @param filename and writes in processed
+        data. Optionally also writes shards, each a GTFS archive of a subset
+        of trips, referentially closed (only the agency, routes, stops and
+        calendars its trips use): @param shards dict, keyed by archive
+        filename, of dict with one key, agency_id, route_id or trip_range,
+        whose value is a list of such IDs (or of [first, last] trip_id
+        pairs). If shards is None, any shards requested by
+        self.shard_agency or self.shard are written. If @param combined is
+        False, only the shards are written, not filename. Data is read from
+        the database in turn, then archives are completed (compressed, or
+        indexed) in parallel. @return 0 OK or 1 not."""
+
+        with self._memory_phase(phase="dump"):
+            if filename is None and combined:
+                if self.gtfs is None:
+                    return 1
+                filename = self.gtfs
+
+            self.expand_patterns()
+
+            if self.compact_calendar:
+                self.compact()
+
+            if self.parent_stations is not None:
+                self.cluster_stops()
+
+            if shards is None:
+                shards = {}
+                if self.shard_agency:
+                    shards.update(self.shard_by_agency(filename=filename))
+                if self.shard is not None:
+                    for shard in self.shard:
+                        if len(shard) > 1:
+                            shards[shard[0]] = {"route_id": shard[1:]}
+
+            if len(shards) == 0 and not combined:
+                return 0
+
+            archives = list(shards.items())
+            if combined:
+                archives.insert(0, (filename, None))
+            self._progress_start(
+                stage="dump",
+                source=os.path.basename(archives[0][0]),
+                total=self._progress_total() if (
+                    len(shards) == 0 and self.output_format != "sqlite"
+                ) else None,
+            )  # Shard sizes unknown until written, sqlite rows uncounted
+
+            completions = [
+                self._dump_prepare(filename=archive[0], shard=archive[1])
+                for archive in archives
+            ]  # Only this thread uses the database
+            statuses = [1 for completion in completions if completion is None]
+            completions = [
+                completion for completion in completions
+                if completion is not None
+            ]
+
+            if len(completions) == 1:
+                statuses.append(completions[0]())
+            elif len(completions) > 1:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(
+                        len(completions), (os.cpu_count() or 1) + 1
+                    )
+                ) as executor:
+                    statuses += list(executor.map(
+                        lambda context, completion: context.run(completion),
+                        [contextvars.copy_context() for _ in completions],
+                        completions,
+                    ))  # In copies of this context, as loader serve logs
+
+            self._progress(done=True)
+            self.progress_state = None
+
+            return max(statuses)
+
+    def export_columnar(self, directory=None, batch_size=65536):
+        """Exports each GTFS table as a typed columnar file in @param
+        directory (by default self.columnar), as Parquet or Arrow IPC per
+        self.columnar_format: Times as integer seconds, dates as dates, IDs
+        as integers, and stop_id dictionary-encoded. Rows stream from the
+        database in batches of @param batch_size, so memory is bounded.
+        Requires optional module pyarrow. @return 0 OK or 1 not."""
+
+        if directory is None:
+            if self.columnar is None:
+                return 1
+            directory = self.columnar
+
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+
+        except ImportError:
+            logging.warning(
+                "{} {}".format(
+                    "Module pyarrow required (pip install pyarrow).",
+                    "Meantime, skipping columnar export."
+                )
+            )
+            return 1
+
+        arrow_types = {
+            "dictionary": pyarrow.dictionary(
+                pyarrow.int32(), pyarrow.string()
+            ),
+            "date": pyarrow.date32(),
+            "time": pyarrow.int32(),
+            "INTEGER": pyarrow.int64(),
+            "NUMERIC": pyarrow.float64(),
+            "TEXT": pyarrow.string(),
+        }
+
+        def column(values, field, type):
+            kind = self._columnar_types.get(field, type)
+            if kind == "time":
+                values = [
+                    None if value is None else self._gtfs_time_seconds(
+                        time_str=value
+                    ) for value in values
+                ]
+            elif kind == "date":
+                values = [
+                    None if value is None else datetime.datetime.strptime(
+                        value, self.date_format
+                    ).date() for value in values
+                ]
+            elif kind == "dictionary":
+                return pyarrow.array(
+                    values, type=pyarrow.string()
+                ).dictionary_encode()
+            return pyarrow.array(values, type=arrow_types[kind])
+
+        try:
+            os.makedirs(directory, exist_ok=True)
 
-                        line = c.fetchone()
+            for table, fields in self._gtfs_structure.items():
+                schema = pyarrow.schema([
+                    (
+                        field,
+                        arrow_types[self._columnar_types.get(field, type)]
+                    ) for field, type in fields.items()
+                ])
+
+                if self.columnar_format == "arrow":
+                    path = os.path.join(directory, "{}.arrow".format(table))
+                    writer = pyarrow.ipc.new_file(path, schema)
+                else:
+                    path = os.path.join(
+                        directory, "{}.parquet".format(table)
+                    )
+                    writer = pyarrow.parquet.ParquetWriter(path, schema)
 
-                        while line:
-                            txt.writerow(line)
-                            line = c.fetchone()
+                table_rows = self.iter_table(
+                    table=table, batch_size=batch_size
+                )
+                rows = list(itertools.islice(table_rows, batch_size))
+
+                while rows:
+                    batch = pyarrow.Table.from_arrays(
+                        [
+                            column(values, field, type) for (
+                                values, (field, type)
+                            ) in zip(zip(*rows), fields.items())
+                        ],
+                        schema=schema,
+                    )
+                    writer.write_table(batch)
+                    rows = list(itertools.islice(table_rows, batch_size))
 
-                    zip.write(path, arcname)
+                writer.close()
 
-            zip.close()
             return 0
 
         except Exception as e:
-            logging.critical("Failed to write %s: %s", filename, e)
+            logging.critical("Failed to export to %s: %s", directory, e)
             return 1
 
-    def file(self, filename=""):
+    def feed_manifest(self):
+        """@return hash manifest of the processed data: dict keyed format
+        (version), trips, routes, stops. Each section is a dict of stable
+        key: short content hash. Trips are keyed by route_id, direction_id,
+        trip_short_name, first stop_id and first departure_time (so not by
+        trip_id, which depends on processing order), and their hash covers
+        trip_headsign, dates of service (however encoded) and stop times.
+        Rows are streamed in trip order, so memory is bounded by the number
+        of services and manifest keys."""
+
+        def content_hash(values):
+            return hashlib.blake2b(
+                repr(values).encode("utf-8"), digest_size=8
+            ).hexdigest()
+
+        manifest = {"format": 1, "trips": {}, "routes": {}, "stops": {}}
+
+        for section, table in [("routes", "routes"), ("stops", "stops")]:
+            for row in self.iter_table(table=table):
+                manifest[section][row[0]] = content_hash(row[1:])
+
+        c = self.db.cursor()
+        exceptions = {}  # service_id: [[date, exception_type], [...]]
+        c.execute(
+            """SELECT service_id, date, exception_type FROM calendar_dates"""
+        )
+        for service_id, date, exception_type in c.fetchall():
+            exceptions.setdefault(service_id, []).append(
+                [date, exception_type]
+            )
+
+        services = {}  # service_id: hash of active dates
+        for row in self.iter_table(table="calendar"):
+            services[row[0]] = content_hash(sorted(self.calendar_active_dates(
+                calendar=list(row[1:]),
+                calendar_dates=exceptions.get(row[0], []),
+            )))
+        del exceptions
+
+        stop_times = itertools.groupby(
+            self.iter_table(table="stop_times", order=True),
+            key=lambda row: row[0],
+        )
+        stop_trip_id, stop_rows = next(stop_times, (None, None))
+
+        for trip in self.iter_table(table="trips", order=True, named=True):
+            trip_id = trip.trip_id
+            rows = []
+
+            while stop_trip_id is not None and stop_trip_id < trip_id:
+                stop_trip_id, stop_rows = next(stop_times, (None, None))
+            if stop_trip_id == trip_id:
+                rows = [row[1:] for row in stop_rows]
+
+            key = "{}|{}|{}|{}|{}".format(
+                trip.route_id,
+                trip.direction_id,
+                trip.trip_short_name,
+                rows[0][2] if rows else "",
+                rows[0][1] if rows else "",
+            )
+            unique_key = key
+            repeat = 1
+            while unique_key in manifest["trips"]:
+                repeat += 1
+                unique_key = "{}|{}".format(key, repeat)
+
+            manifest["trips"][unique_key] = content_hash(
+                (trip.trip_headsign, services.get(trip.service_id), rows)
+            )
+
+        return manifest
+
+    def file(self, filename="", stream=None, size=None):
         """The main function. Parses expected ATCO-CIF @param filename,
-        processing the data therein. @return 0 if parsing suceeded (with no
+        processing the data therein. If @param stream, parses that readable
+        binary file object instead (such as a zip member or decompressor),
+        named filename, @param size bytes long if known (else taken from a
+        plain file, for progress). @return 0 if parsing suceeded (with no
         worse than warnings), 1 if erroneous (bad file type/strucrure or
         unrecoverable processing error."""
 
         self.agency_cache = {}
         self.agency_used = []
+        self.day_offset = 0
         self.file_num += 1
+        self.last_hour = 0
         self.line_num = 0
         self.route_used = []
         self.route_cache = {}
         self.service = {}
         self.stop_used = []
         self.stop_cache = {}
+        if self.stop_spilled:
+            self.db.cursor().execute("""DELETE FROM temp.stop_spill""")
+            self.stop_spilled = False
+        memory = contextlib.ExitStack()
+        memory.enter_context(self._memory_phase(phase="file"))
 
         try:
             self.base_filename = os.path.basename(filename)
-            with open(filename, "r") as cif:
-                line = cif.readline()
+            if stream is None:
+                stream = open(filename, "rb", buffering=1 << 20)
+            if size is None and isinstance(stream, io.BufferedReader):
+                size = os.fstat(stream.fileno()).st_size  # Plain file
+            if self.pipeline:
+                self._writer_start()
+                consumed = [0]
+                cif = self._read_ahead(
+                    filename=filename, stream=stream, consumed=consumed
+                )
+
+                def position():
+                    return consumed[0]  # As parsed, not read ahead
+
+            else:
+                cif = io.TextIOWrapper(stream)
+                position = stream.tell
+            check = self._progress_start(
+                stage="file",
+                source=self.base_filename,
+                total=size,
+                position=position,
+            )
 
-                while line:
+            with contextlib.closing(cif):
+                for line in cif:
                     self.line_num += 1
 
+                    if self.line_num >= check:  # Rarely: See _progress()
+                        check = self._progress()
+
                     if self.line_num == 1:  # Header
                         if self.header(line=line) == 1:
                             return 1
@@ -390,14 +1208,26 @@ class atcocif:
                                 else:
                                     self.unsupported[id] = 1
 
-                    # End of line
-                    line = cif.readline()
-
             # Post-file reading
-            self.agency()
-            self.calendar()
-            self.route()
-            self.stops()
+            self._end_trip()
+            self._writer_stop()
+            for phase in [self.agency, self.calendar, self.route, self.stops]:
+                with self._memory_phase(phase=phase.__name__):
+                    phase()
+            self._progress(done=True)
+
+            if not self.verbose:
+                for (file_num, category), count in self.warning_count.items():
+                    if (
+                        file_num == self.file_num
+                        and count > self.warning_limit
+                    ):
+                        logging.warning(
+                            "%s further %s problem(s) in %s not logged.",
+                            count - self.warning_limit,
+                            category,
+                            self.base_filename,
+                        )
             return 0
 
         except Exception as e:
@@ -410,10 +1240,166 @@ class atcocif:
             )
             return 1
 
+        finally:
+            if self.writer is not None:  # Only if stopped early
+                try:
+                    self._writer_stop()
+                except Exception:
+                    pass  # Already failed, so already reported
+            self.progress_state = None
+            memory.close()
+
+    def forget(self, first_trip=0, last_trip=0):
+        """Removes trips @param first_trip to @param last_trip (inclusive,
+        as the trip_id range of one or more file() calls, so a changed file
+        can be processed again), their stop_times and calendars, then any
+        agency, route or stop no longer used by a trip. Those still used
+        stay as first processed. Trips dropped as duplicates of those
+        removed are not restored, so process their files again too (as
+        loader watcher). @return number of trips removed."""
+
+        c = self.db.cursor()
+        trip_range = (first_trip, last_trip)
+
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS trips_trip_id ON trips (trip_id)"""
+        )
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS stop_times_trip_id_stop_sequence ON
+            stop_times (trip_id, stop_sequence)"""
+        )  # As _gtfs_indexes
+        c.execute(
+            """DELETE FROM trips WHERE trip_id BETWEEN ? AND ?""", trip_range
+        )
+        removed = c.rowcount
+        c.execute(
+            """DELETE FROM stop_times WHERE trip_id BETWEEN ? AND ?""",
+            trip_range,
+        )
+        c.execute(
+            """SELECT name FROM sqlite_temp_master WHERE type='table' AND name
+            IN ('trip_times', 'trip_fingerprints')"""
+        )
+        for table in c.fetchall():
+            c.execute(
+                """DELETE FROM temp.{} WHERE trip_id BETWEEN ? AND
+                ?""".format(table[0]),
+                trip_range,
+            )  # nosec - Table names from the query above
+
+        for table, column, used in [
+            ("calendar", "service_id", "SELECT service_id FROM trips"),
+            ("calendar_dates", "service_id", "SELECT service_id FROM trips"),
+            ("routes", "route_id", "SELECT route_id FROM trips"),
+            ("agency", "agency_id", "SELECT agency_id FROM routes"),
+        ]:
+            c.execute(
+                """DELETE FROM {} WHERE {} NOT IN ({} WHERE {} IS NOT
+                NULL)""".format(table, column, used, column)
+            )  # nosec - Internal names only
+
+        if self.pattern_cache:
+            c.execute(
+                """DELETE FROM stops WHERE stop_id NOT IN (SELECT stop_id
+                FROM stop_times) AND stop_id NOT IN (SELECT stop_id FROM
+                temp.stop_patterns JOIN temp.trip_times ON
+                stop_patterns.pattern_id=trip_times.pattern_id)"""
+            )
+        else:
+            c.execute(
+                """DELETE FROM stops WHERE stop_id NOT IN (SELECT stop_id
+                FROM stop_times)"""
+            )
+
+        self.journey_duplicate = [
+            pair for pair in self.journey_duplicate
+            if not any(first_trip <= trip <= last_trip for trip in pair)
+        ]
+
+        self.db.commit()
+        return removed
+
+    def iter_table(
+        self, table="", batch_size=1000, order=None, named=False, shard=None
+    ):
+        """@return generator that lazily yields the rows of GTFS @param table
+        (as _gtfs_structure), fetched @param batch_size at a time, as typed
+        tuples in _gtfs_structure column order, or if @param named True, as
+        named tuples. @param order may be a tuple of column names, or True
+        for the table's primary key (as _gtfs_indexes): Ordering is backed by
+        a matching index, created on first use. If @param shard (as dump()),
+        only that subset is yielded. Raises ValueError for unknown tables or
+        columns when called, not when first iterated."""
+
+        if table not in self._gtfs_structure:
+            raise ValueError("Unknown GTFS table {}".format(table))
+
+        fields = list(self._gtfs_structure[table].keys())
+
+        if order is True:
+            order = self._gtfs_indexes[table][0]
+
+        if order:
+            order = tuple(order)
+
+            for field in order:
+                if field not in fields:
+                    raise ValueError(
+                        "Unknown {} column {}".format(table, field)
+                    )
+
+        return self._iter_rows(
+            table=table,
+            fields=fields,
+            batch_size=batch_size,
+            order=order,
+            named=named,
+            shard=shard,
+        )  # Validated above, so bad calls fail here, not on first row
+
+    def iter_tables(self, batch_size=1000, order=None, named=False):
+        """Yields (table name, iter_table() generator) for every GTFS table,
+        with @param batch_size, @param order (True only, or per table dict of
+        column tuples) and @param named as iter_table()."""
+
+        for table in self._gtfs_structure.keys():
+            yield (
+                table,
+                self.iter_table(
+                    table=table,
+                    batch_size=batch_size,
+                    order=order.get(table) if isinstance(
+                        order, dict
+                    ) else order,
+                    named=named,
+                ),
+            )
+
+    def memory_save(self, filename=None):
+        """Writes the memory profile (see _memory_phase()) as JSON to @param
+        filename (by default self.memory_report), replacing any previous
+        profile only once complete. @return 0 OK or 1 not."""
+
+        if filename is None:
+            filename = self.memory_report
+
+        try:
+            with open(
+                "{}.tmp".format(filename), "w", encoding="utf-8"
+            ) as memory_file:
+                json.dump(self.memory_phases, memory_file, indent=2)
+            os.replace("{}.tmp".format(filename), filename)
+            return 0
+
+        except OSError as e:
+            logging.error("Failed to write memory profile %s: %s", filename, e)
+            return 1
+
     def report(self, topic=None):
-        """Logs Quality Assurance summary of data/quirks. All reports if
-        @param topic is None, else topic must be one of 'coords',
-        'duplication', 'unsupported', 'totals'."""
+        """Logs Quality Assurance summary of data/quirks. All reports
+        (except memory, best logged once complete) if @param topic is None,
+        else topic must be one of 'coords', 'duplication', 'memory',
+        'unsupported', 'totals', 'warnings'."""
 
         c = self.db.cursor()
 
@@ -481,6 +1467,43 @@ class atcocif:
                     ", ".join(output),
                 )
 
+            if len(self.journey_duplicate) > 0:
+                logging.info(
+                    "{} {} {}".format(
+                        "%s journey(s) duplicated the route, direction,",
+                        "calendar and stop times of an earlier journey",
+                        "(policy %s). First 10 (trip_id, trip_id): %s."
+                    ),
+                    len(self.journey_duplicate),
+                    self.duplicates,
+                    ", ".join(
+                        "({}, {})".format(*pair)
+                        for pair in self.journey_duplicate[:10]
+                    ),
+                )
+
+        if topic == "memory":
+            for phase, record in self.memory_phases.items():
+                logging.info(
+                    "{} {} {}".format(
+                        "Memory of %s: %s call(s) in %ss, peak %s MB",
+                        "allocated (net %s MB), process peak %s MB. Top",
+                        "sites: %s."
+                    ),
+                    phase,
+                    record["calls"],
+                    round(record["seconds"], 3),
+                    round(record["peak"] / 1048576, 1),
+                    round(record["net"] / 1048576, 1),
+                    "?" if record["rss"] is None else round(
+                        record["rss"] / 1048576, 1
+                    ),
+                    ", ".join(
+                        "{} {} MB".format(site, round(size / 1048576, 1))
+                        for site, size, count in record["top"][:3]
+                    ),
+                )
+
         if topic is None or topic == "unsupported":
             unsupported_count = 0
             output = []
@@ -488,7 +1511,7 @@ class atcocif:
             explanation = {
                 "OB": "AIM timing point detail, use unknown",
                 "QA": "alternative stop location, use unknown",
-                "QC": "stop clusters, unimplemented: stop parent",
+                "QC": "stop clusters, unimplemented: see parent_stations",
                 "QG": "interchange times, unimplemented: transfers",
                 "QH": "bank holiday dates, overwritten by argument -b",
                 "QJ": "interchange times, unimplemented: transfers",
@@ -522,6 +1545,41 @@ class atcocif:
                     ", ".join(output),
                 )
 
+        if topic is None or topic == "warnings":
+            categories = {}  # category: [count, count of files]
+
+            for (file_num, category), count in self.warning_count.items():
+                if category not in categories:
+                    categories[category] = [0, 0]
+                categories[category][0] += count
+                categories[category][1] += 1
+
+            if len(categories) > 0:
+                logging.info(
+                    "Line problems found (category: count in files): %s.",
+                    ", ".join(
+                        "{}: {} in {}".format(category, *counts)
+                        for category, counts in sorted(categories.items())
+                    ),
+                )
+
+    def shard_by_agency(self, filename=""):
+        """@return shards dict, as dump(), of one archive per agency_id,
+        named as @param filename with _agency_id added before the
+        extension."""
+
+        c = self.db.cursor()
+        stem, extension = os.path.splitext(filename)
+        shards = {}
+
+        c.execute("""SELECT agency_id FROM agency ORDER BY agency_id""")
+        for agency_id in c.fetchall():
+            shards["{}_{}{}".format(stem, agency_id[0], extension)] = {
+                "agency_id": [agency_id[0]]
+            }
+
+        return shards
+
     # -{ Record ID Processing }-----------------------------------------------
 
     def date_exceptions(self, line=""):
@@ -542,8 +1600,15 @@ class atcocif:
             else:
                 action = 1  # Add
 
+            if self.window_start is not None:
+                start_date = max(start_date, self.window_start)
+            if self.window_end is not None:
+                end_date = min(end_date, self.window_end)
+            if start_date > end_date:
+                return  # Wholly outside the date window
+
             if self.trip_id not in self.service:
-                self.service[self.trip_id] = {}
+                self.service[self.trip_id] = service_record()
             if "calendar_dates" in self.service[self.trip_id]:
                 dates = self.service[self.trip_id]["calendar_dates"]
             else:
@@ -553,6 +1618,20 @@ class atcocif:
             else:
                 calendar = []  # Malformed. Assume any day
 
+            if action == 2 and len(calendar) == 9:
+                # Trim calendar ends in closed form, not day-by-day
+                calendar, start_date, end_date = self.calendar_clip(
+                    calendar=calendar,
+                    start_date=start_date,
+                    end_date=end_date,
+                )
+                self.service[self.trip_id]["calendar"] = calendar
+                dates = [
+                    date for date in dates if date[1] == 1 or (
+                        date[0] >= calendar[7] and date[0] <= calendar[8]
+                    )
+                ]  # Removals outside the trimmed calendar are redundant
+
             dates += self.calendar_exception_list(
                 exception_dates=[],
                 calendar=calendar,
@@ -570,55 +1649,42 @@ class atcocif:
     def header(self, line=""):
         """Checks for valid header in @param line. @return 0 if OK, 1 not."""
 
-        if not isinstance(line, str) or len(line) < 10:
-            logging.warning(
-                "Unrecognised file type: Skipped %s",
-                self.base_filename
-            )
+        status = self.header_status(line=line)
+        if status is not None:
+            logging.warning("%s: Skipped %s", status, self.base_filename)
             return 1
 
+        return 0
+
+    @staticmethod
+    def header_status(line=""):
+        """@return None if @param line is a valid ATCO-CIF v05 header, else
+        the reason it is not (as used by header(), and by loader scan)."""
+
+        if not isinstance(line, str) or len(line) < 10:
+            return "Unrecognised file type"
+
         if not line.startswith("ATCO-CIF"):
             if line.startswith("HDTPS"):
-                logging.warning(
-                    "Non-ATCO-CIF file, likely railway CIF: Skipped %s",
-                    self.base_filename
-                )
-            else:
-                logging.warning(
-                    "Non-ATCO-CIF file: Skipped %s",
-                    self.base_filename
-                )
-            return 1
+                return "Non-ATCO-CIF file, likely railway CIF"
+            return "Non-ATCO-CIF file"
 
         if line[8:10] != "05":
-            logging.warning(
-                "Unsupported ATCO-CIF version %s: Skipped %s",
-                line[8:10],
-                self.base_filename,
-            )
-            return 1
+            return "Unsupported ATCO-CIF version {}".format(line[8:10])
 
-        return 0
+        return None
 
     def journey(self, line=""):
         """Processes journey header records in @param line."""
 
+        self._end_trip()
+
         if len(line) >= 3 and line[2] == "D":  # Deleted, so skip whole trip
             self.in_trip = False
 
         elif len(line) >= 65:
-            agency_id = self.sanitize_id(
-                id=line[3:7], allow_line_num=False, direction=0
-            )
             route_num = line[38:42].strip()
             direction_id = self.direction_to_gtfs(id=line[64])
-            route_id = self.sanitize_id(
-                id="{}_{}".format(agency_id, route_num),
-                allow_line_num=True,
-                direction=direction_id
-            )
-            trip_short_name = line[42:48].strip()  # Running Board
-
             start_date = self.sanitize_date(
                 date_str=line[13:21],
                 is_commence=True
@@ -627,6 +1693,32 @@ class atcocif:
                 date_str=line[21:29],
                 is_commence=False
             )
+
+            if not self.journey_filter(
+                agency=line[3:7].strip(),
+                route_num=route_num,
+                direction_id=direction_id,
+                start_date=start_date,
+                end_date=end_date,
+            ):  # Skip whole trip, before any data is created
+                self.in_trip = False
+                return 0
+
+            if self.window_start is not None:
+                start_date = max(start_date, self.window_start)
+            if self.window_end is not None:
+                end_date = min(end_date, self.window_end)
+
+            agency_id = self.sanitize_id(
+                id=line[3:7], allow_line_num=False, direction=0
+            )
+            route_id = self.sanitize_id(
+                id="{}_{}".format(agency_id, route_num),
+                allow_line_num=True,
+                direction=direction_id
+            )
+            trip_short_name = line[42:48].strip()  # Running Board
+
             calendar = self.calendar_list(
                 start_date=start_date,
                 end_date=end_date,
@@ -637,6 +1729,24 @@ class atcocif:
             if line[36] == "S":
                 # School term time only: Remove inverse-stt
                 if self.school_term is not None:
+                    term = self.calendar_bounds(
+                        dates=self.school_term,
+                        start_date=start_date,
+                        end_date=end_date,
+                    )
+                    if term is None:  # No term time, so never runs
+                        term = [end_date, start_date]
+                    # Trim holidays before/after first/last term date
+                    calendar = self.calendar_clip(
+                        calendar=calendar,
+                        start_date=start_date,
+                        end_date=self._date_offset(date_str=term[0], days=-1),
+                    )[0]
+                    calendar = self.calendar_clip(
+                        calendar=calendar,
+                        start_date=self._date_offset(date_str=term[1], days=1),
+                        end_date=end_date,
+                    )[0]
                     calendar_dates += self.calendar_exception_list(
                         exception_dates=self.school_term,
                         calendar=calendar,
@@ -710,9 +1820,12 @@ class atcocif:
             self.trip_id += 1
             self.in_trip = True
             self.pre_times = True
+            self.trip_route = (
+                "{}_{}".format(line[3:7].strip(), route_num), direction_id
+            )  # As in ATCO-CIF, so common to all files
 
-            if self.trip_id is not self.service:
-                self.service[self.trip_id] = {}
+            if self.trip_id not in self.service:
+                self.service[self.trip_id] = service_record()
             if len(calendar_dates) > 0:
                 self.service[self.trip_id]["calendar_dates"] = (
                     self._unique_list(list=calendar_dates)
@@ -727,12 +1840,12 @@ class atcocif:
             if route_id not in self.route_used:
                 self.route_used.append(route_id)
             if route_id not in self.route_cache:
-                self.route_cache[route_id] = {}
+                self.route_cache[route_id] = route_record()
             self.route_cache[route_id]["agency"] = agency_id
             self.route_cache[route_id]["num"] = route_num
 
-            c = self.db.cursor()
-            c.execute(
+            self.trip_note = None
+            self._db_write(
                 """INSERT INTO trips (route_id, trip_id, trip_short_name,
                 direction_id) VALUES (?,?,?,?)""",
                 (
@@ -742,11 +1855,12 @@ class atcocif:
                     direction_id,
                 ),
             )  # service_id added at end of file, not here
-            self.db.commit()
 
         else:
             self.in_trip = False  # Else trips may falsely be merged
-            logging.warning(
+            self._warn(
+                "journey",
+                logging.WARNING,
                 "Skipped trip due to malformed header at line %s of %s",
                 self.line_num,
                 self.base_filename,
@@ -767,28 +1881,81 @@ class atcocif:
         if len(line) >= 8 and self.in_trip and self.pre_times:
             note = line[7:].strip()
             if note != "":
-                c = self.db.cursor()
-
-                c.execute(
-                    """SELECT trip_headsign FROM trips WHERE trip_id=?""",
-                    (self.trip_id,),
-                )
-                fetched = c.fetchone()
-                if fetched[0] is not None:
-                    note = "{} | {}".format(fetched[0], note)
+                if self.trip_note is not None:
+                    note = "{} | {}".format(self.trip_note, note)
+                self.trip_note = note
 
-                c.execute(
+                self._db_write(
                     """UPDATE trips SET trip_headsign=? WHERE trip_id=?""",
                     (
                         note,
                         self.trip_id,
                     ),
                 )
-                self.db.commit()
+
+    def journey_filter(
+        self,
+        agency=None,
+        route_num=None,
+        direction_id=None,
+        start_date=None,
+        end_date=None,
+    ):
+        """@return boolean True if a journey passes the include/exclude
+        filters (self.include_agency and similar). @param agency is the
+        ATCO-CIF operator code, @param route_num the route number, @param
+        direction_id the GTFS direction, and @param start_date and end_date
+        YYYYMMDD strings. Parameters left None are not tested. Routes may be
+        filtered by number alone, or as operator_number."""
+
+        if agency is not None:
+            if (
+                self.include_agency is not None
+                and agency not in self.include_agency
+            ):
+                return False
+            if (
+                self.exclude_agency is not None
+                and agency in self.exclude_agency
+            ):
+                return False
+
+        if route_num is not None:
+            names = [route_num, "{}_{}".format(agency, route_num)]
+            if self.include_route is not None and not any(
+                name in self.include_route for name in names
+            ):
+                return False
+            if self.exclude_route is not None and any(
+                name in self.exclude_route for name in names
+            ):
+                return False
+
+        if (
+            direction_id is not None
+            and self.include_direction is not None
+            and self.direction_to_gtfs(id=self.include_direction)
+            != direction_id
+        ):
+            return False
+
+        if (
+            end_date is not None
+            and self.window_start is not None
+            and end_date < self.window_start
+        ) or (
+            start_date is not None
+            and self.window_end is not None
+            and start_date > self.window_end
+        ):
+            return False  # No overlap with date window
+
+        return True
 
     def location(self, line=""):
         """Processes location name or grid records in @param line. Data is
-        held in self.stop_cache and only written to database at file end if
+        held in self.stop_cache (overflowing to the database beyond
+        self.stop_cache_limit) and only written to database at file end if
         in self.stop_used."""
 
         if len(line) >= 16 and line[2] != "D":
@@ -796,7 +1963,7 @@ class atcocif:
                 id=line[3:15], allow_line_num=False, direction=0
             )
             if stop_id not in self.stop_cache:
-                self.stop_cache[stop_id] = {}
+                self.stop_cache[stop_id] = stop_record()
 
             if line.startswith("QL"):
                 if len(line) >= 64:  # Followed by Gazetteer extensions
@@ -820,6 +1987,12 @@ class atcocif:
                     self.stop_cache[stop_id]["easting"] = easting
                     self.stop_cache[stop_id]["northing"] = northing
 
+            if (
+                self.stop_cache_limit is not None
+                and len(self.stop_cache) > self.stop_cache_limit
+            ):
+                self.stop_spill()
+
     def operator(self, line=""):
         """Processes operator records in @param line. Data is held in
         self.agency_cache and only written to database at file end if in
@@ -830,7 +2003,7 @@ class atcocif:
                 id=line[3:7], allow_line_num=False, direction=0
             )
             if agency_id not in self.agency_cache:
-                self.agency_cache[agency_id] = {}
+                self.agency_cache[agency_id] = agency_record()
 
             agency_name = line[7:31].strip()
             if agency_name != "":
@@ -849,6 +2022,8 @@ class atcocif:
         that is often not used in ATCO-CIF files."""
 
         if len(line) >= 31 and self.in_trip:
+            self._end_trip()
+            self._writer_drain()
             c = self.db.cursor()
             prev_id = self.trip_id
 
@@ -859,20 +2034,15 @@ class atcocif:
             )
             prev_trip = c.fetchone()
 
-            c.execute(
-                """SELECT arrival_time, departure_time, stop_id,
-                stop_sequence, pickup_type, drop_off_type, timepoint FROM
-                stop_times WHERE trip_id=? ORDER BY stop_sequence ASC""",
-                (prev_id,),
-            )
-            prev_times = c.fetchall()
+            prev_times = self._trip_stop_times(trip_id=prev_id)
 
             if prev_trip is not None and prev_times is not None:
                 self.trip_id += 1
                 trip_short_name = line[24:30].strip()  # Running Board
                 self.service[self.trip_id] = self.service[prev_id]
+                self.trip_note = prev_trip[1]
 
-                c.execute(
+                self._db_write(
                     """INSERT INTO trips (route_id, trip_id, trip_headsign,
                     trip_short_name, direction_id) VALUES (?,?,?,?,?)""",
                     (
@@ -921,11 +2091,8 @@ class atcocif:
                         )
                     )
 
-                    c.execute(
-                        """INSERT INTO stop_times (trip_id, arrival_time,
-                        departure_time, stop_id, stop_sequence, pickup_type,
-                        drop_off_type, timepoint) VALUES (?,?,?,?,?,?,?,?)""",
-                        (
+                    self._stop_time_insert(
+                        stop_time=(
                             self.trip_id,
                             arrival_gtfs,
                             departure_gtfs,
@@ -934,17 +2101,19 @@ class atcocif:
                             stoptime[4],
                             stoptime[5],
                             stoptime[6],
-                        ),
+                        )
                     )
 
-                self.db.commit()
-
     def route_description(self, line=""):
         """Processes route descriptions in @param line. Data is held in
         self.route_cache and only written to database at file end if in
         self.route_used."""
 
-        if len(line) >= 13 and line[2] != "D":
+        if (
+            len(line) >= 13
+            and line[2] != "D"
+            and self.journey_filter(agency=line[3:7].strip())
+        ):
             agency_id = self.sanitize_id(
                 id=line[3:7], allow_line_num=False, direction=0
             )
@@ -967,7 +2136,7 @@ class atcocif:
             route_name = line[12:].strip()
 
             if route_id not in self.route_cache:
-                self.route_cache[route_id] = {}
+                self.route_cache[route_id] = route_record()
             # Any duplication defaults to last entry
             self.route_cache[route_id]["agency"] = agency_id
             self.route_cache[route_id]["num"] = route_num
@@ -997,6 +2166,9 @@ class atcocif:
                 self.stop_used.append(stop_id)
             # Stop details are added via QL and QB, not here
 
+            if line.startswith("QO"):
+                self.day_offset = 0  # Before conversion, not last trip's
+
             arrival = self.time_str_to_time_tuple(
                 time_str=line[14:18],
                 is_gtfs=False
@@ -1006,7 +2178,6 @@ class atcocif:
                 self.pre_times = False
                 self.sequence = 1
                 self.last_hour = arrival[0]
-                self.day_offset = 0
                 # QUIRK: Offset uncertain if 24+ hours between stops
             else:
                 self.sequence += 1
@@ -1051,12 +2222,8 @@ class atcocif:
                 elif line.startswith("QT"):
                     pickup = 1
 
-            c = self.db.cursor()
-            c.execute(
-                """INSERT INTO stop_times (trip_id, arrival_time,
-                    departure_time, stop_id, stop_sequence, pickup_type,
-                    drop_off_type, timepoint) VALUES (?,?,?,?,?,?,?,?)""",
-                (
+            self._stop_time_insert(
+                stop_time=(
                     self.trip_id,
                     self.time_tuple_to_gtfs_str(time_tuple=arrival),
                     self.time_tuple_to_gtfs_str(time_tuple=departure),
@@ -1065,9 +2232,8 @@ class atcocif:
                     pickup,
                     drop_off,
                     timepoint,
-                ),
+                )
             )
-            self.db.commit()
 
     # -{ End of File Processing }---------------------------------------------
 
@@ -1158,72 +2324,99 @@ class atcocif:
     def calendar(self):
         """Processes file's accumulated calendars, as held in self.service,
         to merge identical patterns together, write them into calendar and
-        calendar_date tables, and update table trip service_id references."""
+        calendar_date tables, and update table trip service_id references
+        (all at once, via a temporary trip_id to service_id mapping)."""
 
         c = self.db.cursor()
-        unique = []  # Dict of unique self.service.trip_id entries
+        unique = {}  # Hashable key of each unique self.service entry: index
+        patterns = []  # Unique self.service.trip_id entries
         trips = []  # Corresponding lists of trip_ids matching each unique
 
         for trip_id in self.service:
             seek = self.service[trip_id]
-            if seek in unique:
-                trips[unique.index(seek)].append(trip_id)
+            calendar = seek["calendar"]
+            if len(calendar) == 9 and calendar[7] > calendar[8]:
+                # Collapsed by calendar_clip(): Valid GTFS, yet never runs
+                seek["calendar"] = [0] * 7 + [calendar[7], calendar[7]]
+            key = (
+                tuple(seek["calendar"]),
+                tuple(
+                    tuple(dates) for dates in seek.get("calendar_dates", [])
+                ),
+            )
+            if key in unique:
+                trips[unique[key]].append(trip_id)
             else:
-                unique.append(seek)
+                unique[key] = len(patterns)
+                patterns.append(seek)
                 trips.append([trip_id])
 
-        for i in range(len(unique)):
+        c.execute("""SELECT MAX(service_id) FROM calendar""")
+        next_id = 1 + (c.fetchone()[0] or 0)
+        service_map = []  # (trip_id, service_id)
+
+        for i in range(len(patterns)):
             match_id = -1
             c.execute(
                 """SELECT service_id FROM calendar WHERE monday=? AND
                 tuesday=? AND wednesday=? AND thursday=? AND friday=? AND
                 saturday=? AND sunday=? AND start_date=? AND end_date=?""",
-                unique[i]["calendar"],
+                patterns[i]["calendar"],
             )
             calendars = c.fetchall()  # 1+ may match, some with calendar_dates
 
             for result in calendars:
                 c.execute(
                     """SELECT date, exception_type FROM
-                    calendar_dates WHERE service_id=? ORDER BY date DESC,
-                    exception_type DESC""",
+                    calendar_dates WHERE service_id=? ORDER BY date ASC,
+                    exception_type ASC""",
                     result,
                 )
-                dates = c.fetchall()
-                if (
-                    "calendar_dates" in unique[i]
-                    and unique[i]["calendar_dates"] == dates
-                ) or ("calendar_dates" not in unique[i] and len(dates) == 0):
+                dates = [list(date) for date in c.fetchall()]
+                if dates == patterns[i].get("calendar_dates", []):
                     match_id = result[0]
                     break
 
             if match_id == -1:
-                c.execute("""SELECT COUNT(*) FROM calendar""")
-                match_id = 1 + (c.fetchone()[0])
+                match_id = next_id
+                next_id += 1
                 c.execute(
                     """INSERT INTO calendar (service_id, monday,
                     tuesday, wednesday, thursday, friday, saturday, sunday,
                     start_date, end_date) VALUES (?,?,?,?,?,?,?,?,?,?)""",
-                    ([match_id] + unique[i]["calendar"]),
+                    ([match_id] + patterns[i]["calendar"]),
                 )
-                if "calendar_dates" in unique[i]:
-                    for dates in unique[i]["calendar_dates"]:
-                        c.execute(
-                            """INSERT INTO calendar_dates (service_id,
-                            date, exception_type) VALUES (?,?,?)""",
-                            ([match_id] + dates),
-                        )
+                if "calendar_dates" in patterns[i]:
+                    c.executemany(
+                        """INSERT INTO calendar_dates (service_id,
+                        date, exception_type) VALUES (?,?,?)""",
+                        [
+                            [match_id] + dates
+                            for dates in patterns[i]["calendar_dates"]
+                        ],
+                    )
 
             for trip_id in trips[i]:
-                c.execute(
-                    """UPDATE trips SET service_id=? WHERE trip_id=?""",
-                    (
-                        match_id,
-                        trip_id,
-                    ),
-                )
+                service_map.append((trip_id, match_id))
 
-            self.db.commit()
+        if len(service_map) > 0:
+            c.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS service_map (trip_id
+                INTEGER PRIMARY KEY, service_id INTEGER)"""
+            )
+            c.execute("""DELETE FROM temp.service_map""")
+            c.executemany(
+                """INSERT OR REPLACE INTO temp.service_map (trip_id,
+                service_id) VALUES (?,?)""",
+                service_map
+            )
+            c.execute(
+                """UPDATE trips SET service_id=(SELECT service_id FROM
+                temp.service_map WHERE service_map.trip_id=trips.trip_id)
+                WHERE trip_id IN (SELECT trip_id FROM temp.service_map)"""
+            )  # Single pass through trips, per file
+
+        self.db.commit()
 
     def route(self):
         """Processes file's accumulated route data, adding self.route_cache to
@@ -1314,33 +2507,86 @@ class atcocif:
 
     def stops(self):
         """Processes file's accumulated stop data, adding self.stop_cache to
-        database where in self.stop_used."""
+        database where in self.stop_used. If self.stop_cache overflowed, only
+        the stops used are read back from the database, via an indexed
+        join. Any self.stop_reference fills in missing names or coordinates
+        (or replaces them, if self.stop_reference_priority). If
+        self.parent_stations, projected grid references are kept for
+        cluster_stops()."""
 
         c = self.db.cursor()
 
+        if self.stop_spilled or self.stop_reference is not None:
+            c.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS stop_need (stop_id TEXT
+                PRIMARY KEY, reference_id TEXT)"""
+            )
+            c.execute("""DELETE FROM temp.stop_need""")
+            c.executemany(
+                """INSERT OR IGNORE INTO temp.stop_need (stop_id,
+                reference_id) VALUES (?,?)""",
+                [
+                    (stop_id, self._raw_id(id=stop_id))
+                    for stop_id in self.stop_used
+                ]
+            )
+
+        if self.stop_spilled:
+            self.stop_spill()
+            c.execute(
+                """SELECT stop_spill.stop_id, name, easting, northing FROM
+                temp.stop_need JOIN temp.stop_spill ON
+                stop_spill.stop_id=stop_need.stop_id"""
+            )
+            stop_cache = {}
+            for stop_id, name, easting, northing in c.fetchall():
+                stop_cache[stop_id] = stop_record()
+                if name is not None:
+                    stop_cache[stop_id]["name"] = name
+                if easting is not None and northing is not None:
+                    stop_cache[stop_id]["easting"] = easting
+                    stop_cache[stop_id]["northing"] = northing
+        else:
+            stop_cache = self.stop_cache
+
+        reference = {}  # stop_id: (stop_name, stop_lat, stop_lon)
+        if self.stop_reference is not None:
+            c.execute(
+                """SELECT stop_need.stop_id, stop_reference.stop_name,
+                stop_reference.stop_lat, stop_reference.stop_lon FROM
+                temp.stop_need JOIN stop_reference ON
+                stop_reference.stop_id=stop_need.reference_id"""
+            )
+            for stop_id, stop_name, stop_lat, stop_lon in c.fetchall():
+                reference[stop_id] = (stop_name, stop_lat, stop_lon)
+
         out_of_bounds = 0  # Count of coordinates outside EPSG
         unknown_name = "Unknown"
         insert = []
         update = []
+        grid = []  # (stop_id, easting, northing) metres, if parent_stations
 
         c.execute("""SELECT stop_id from stops""")
-        known_stop_id = c.fetchall()
+        known_stop_id = set(c.fetchall())
 
         c.execute(
             """SELECT stop_id from stops WHERE stop_name=? OR
             (stop_lat=? AND stop_lon=?)""",
             (unknown_name, 0, 0),
         )
-        known_empty_stop_id = c.fetchall()
+        known_empty_stop_id = set(c.fetchall())
 
         if self.epsg is not None:
 
             try:
                 import pyproj
 
-                transformer = pyproj.Transformer.from_crs(
-                    "epsg:{}".format(self.epsg), "epsg:4326"
-                )
+                key = ("transformer", self.epsg)
+                if key not in self._warm:  # pyproj 3.1+ is thread-safe
+                    self._warm[key] = pyproj.Transformer.from_crs(
+                        "epsg:{}".format(self.epsg), "epsg:4326"
+                    )
+                transformer = self._warm[key]
 
             except ImportError:
                 logging.warning(
@@ -1370,32 +2616,31 @@ class atcocif:
                 stop_lat = 0
                 stop_log = 0
 
-                if stop_id in self.stop_cache:
+                if stop_id in stop_cache:
 
-                    if "name" in self.stop_cache[stop_id]:
-                        stop_name = self.stop_cache[stop_id]["name"]
+                    if "name" in stop_cache[stop_id]:
+                        stop_name = stop_cache[stop_id]["name"]
 
                     if (
                         self.epsg is not None
-                        and "easting" in self.stop_cache[stop_id]
-                        and "northing" in self.stop_cache[stop_id]
+                        and "easting" in stop_cache[stop_id]
+                        and "northing" in stop_cache[stop_id]
                     ):
                         if self.grid is None:
                             # Assume accuracy of first applies to all
                             self.grid = max(len(
-                                self.stop_cache[stop_id]["easting"].strip()
+                                stop_cache[stop_id]["easting"].strip()
                             ), len(
-                                self.stop_cache[stop_id]["northing"].strip()
+                                stop_cache[stop_id]["northing"].strip()
                             ))
 
-                        latlog = transformer.transform(
-                            self.sanitize_grid_ref(
-                                ref=self.stop_cache[stop_id]["easting"]
-                            ),
-                            self.sanitize_grid_ref(
-                                ref=self.stop_cache[stop_id]["northing"]
-                            ),
+                        easting = self.sanitize_grid_ref(
+                            ref=stop_cache[stop_id]["easting"]
+                        )
+                        northing = self.sanitize_grid_ref(
+                            ref=stop_cache[stop_id]["northing"]
                         )
+                        latlog = transformer.transform(easting, northing)
 
                         if (
                             latlog[0] <= 90
@@ -1405,9 +2650,25 @@ class atcocif:
                         ):  # Pyproj returns inf if out of bounds
                             stop_lat = round(latlog[0], 8)
                             stop_log = round(latlog[1], 8)
+                            grid.append((stop_id, easting, northing))
                         else:
                             out_of_bounds += 1
 
+                if stop_id in reference:
+                    if reference[stop_id][0] is not None and (
+                        self.stop_reference_priority
+                        or stop_name == unknown_name
+                    ):
+                        stop_name = reference[stop_id][0]
+                    if (
+                        reference[stop_id][1] or reference[stop_id][2]
+                    ) and (
+                        self.stop_reference_priority
+                        or (stop_lat == 0 and stop_log == 0)
+                    ):
+                        stop_lat = reference[stop_id][1]
+                        stop_log = reference[stop_id][2]
+
                 if (stop_id,) not in known_stop_id:
                     insert.append(
                         (
@@ -1460,10 +2721,674 @@ class atcocif:
                     update
                 )
 
+            if len(grid) > 0 and self.parent_stations is not None:
+                c.execute(
+                    """CREATE TEMP TABLE IF NOT EXISTS stop_grid (stop_id
+                    TEXT PRIMARY KEY, easting REAL, northing REAL)"""
+                )
+                c.executemany(
+                    """INSERT OR REPLACE INTO temp.stop_grid (stop_id,
+                    easting, northing) VALUES (?,?,?)""",
+                    grid
+                )
+
             self.db.commit()
 
     # -{ Helpers }------------------------------------------------------------
 
+    def _db_write(self, sql="", parameters=()):
+        """Executes write @param sql with @param parameters and commits, or
+        if a pipeline writer is running (see _writer_start()), queues them in
+        batches for the writer thread, which executes them in order."""
+
+        if self.writer is None:
+            self.db.cursor().execute(sql, parameters)
+            self.db.commit()
+            return
+
+        self.write_pending.append((sql, parameters))
+        if len(self.write_pending) >= 5000:
+            self._writer_flush()
+
+    def _dump_csv(self, directory="", shard=None):
+        """Writes each GTFS table as a .txt CSV file in @param directory,
+        containing all processed data, or if @param shard (as dump()), only
+        that subset. @return list of filenames written."""
+
+        arcnames = []
+
+        for table, fields in self._gtfs_structure.items():
+            arcname = "{}.txt".format(table)
+            path = os.path.join(directory, arcname)
+
+            with open(
+                path, "w", newline="", encoding="utf-8"
+            ) as txtfile:
+                txt = csv.writer(
+                    txtfile, delimiter=",", quoting=csv.QUOTE_MINIMAL
+                )
+                txt.writerow(fields.keys())
+                rows = self.iter_table(table=table, shard=shard)
+                if self.progress_state is None:
+                    txt.writerows(rows)
+                else:  # Counted in batches, to keep throughput
+                    for batch in iter(
+                        lambda: list(itertools.islice(rows, 10000)), []
+                    ):
+                        txt.writerows(batch)
+                        self._progress(rows=len(batch))
+
+            arcnames.append(arcname)
+
+        return arcnames
+
+    def _dump_prepare(self, filename="", shard=None):
+        """Starts a single GTFS output @param filename, in the form set by
+        self.output_format, containing all processed data, or if @param
+        shard (as dump()), only that subset: Everything needed from self.db
+        is read in this thread, leaving only work on the output itself. A
+        zip filename of - is written to stdout. @return callable that
+        completes the output, returning 0 OK or 1 not, which is safe to run
+        in parallel threads, or None if failed."""
+
+        try:
+            if self.output_format == "sqlite":
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+                output = sqlite3.connect(filename, check_same_thread=False)
+                # Then used only by the thread completing it
+                try:
+                    self.db.commit()  # Backup waits on any open write
+                    self.db.backup(output)  # Main database, not temp tables
+                except Exception:
+                    output.close()
+                    raise
+
+                return functools.partial(
+                    self._dump_sqlite,
+                    filename=filename,
+                    output=output,
+                    shard=shard,
+                )
+
+            if self.output_format == "directory":
+                os.makedirs(filename, exist_ok=True)
+                self._dump_csv(directory=filename, shard=shard)
+                return lambda: 0  # Nothing left to do
+
+            temp_dir = tempfile.mkdtemp()
+            try:
+                arcnames = self._dump_csv(directory=temp_dir, shard=shard)
+            except Exception:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+
+            return functools.partial(
+                self._dump_zip,
+                filename=filename,
+                directory=temp_dir,
+                arcnames=arcnames,
+            )
+
+        except Exception as e:
+            logging.critical("Failed to write %s: %s", filename, e)
+            return None
+
+    def _dump_sqlite(self, filename="", output=None, shard=None):
+        """Completes standalone GTFS-structured sqlite database @param
+        filename, open as connection @param output (copied from self.db by
+        _dump_prepare()): If @param shard (as dump()), records outside that
+        subset are removed. Then indexed per self._gtfs_indexes. Uses only
+        output, not self.db. @return 0 OK or 1 not."""
+
+        try:
+            c = output.cursor()
+
+            if shard is not None:
+                for table in [
+                    "stop_times", "stops", "calendar", "calendar_dates",
+                    "agency", "routes", "trips",
+                ]:  # Ordered so trips (referenced by all) go last
+                    where, parameters = self._shard_where(
+                        table=table, shard=shard
+                    )
+                    c.execute(
+                        "DELETE FROM {} WHERE NOT ({})".format(table, where),
+                        parameters
+                    )  # nosec - See _gtfs_structure Security Issue
+
+            for table, indexes in self._gtfs_indexes.items():
+                for index in indexes:
+                    c.execute(
+                        "CREATE INDEX IF NOT EXISTS {}_{} ON {} ({})".format(
+                            table, "_".join(index), table, ", ".join(index)
+                        )
+                    )  # nosec - See _gtfs_structure Security Issue
+
+            output.commit()
+            output.execute("""VACUUM""")
+            return 0
+
+        except Exception as e:
+            logging.critical("Failed to write %s: %s", filename, e)
+            return 1
+
+        finally:
+            output.close()
+
+    def _dump_zip(self, filename="", directory="", arcnames=[]):
+        """Completes GTFS zip archive @param filename (- for stdout) from
+        the files @param arcnames in @param directory (as written by
+        _dump_csv()), then removes that directory. Uses no database.
+        @return 0 OK or 1 not."""
+
+        try:
+            if filename == "-":
+                output = sys.stdout.buffer  # Streamed, for piping
+            else:
+                output = filename
+
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip:
+                for arcname in arcnames:
+                    zip.write(os.path.join(directory, arcname), arcname)
+
+            return 0
+
+        except Exception as e:
+            logging.critical("Failed to write %s: %s", filename, e)
+            return 1
+
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _end_trip(self):
+        """Completes the trip whose stop_times rows were last added: If
+        self.duplicates, the trip may be dropped as a duplicate (see
+        _trip_duplicate()). Then if self.pattern_store, moves its buffered
+        rows into the pattern store: The trip's sequence of (stop_sequence,
+        stop_id, pickup_type, drop_off_type, timepoint) is held once as a
+        shared pattern, then the trip holds only the pattern's ID and a packed
+        array of HHMM arrival and departure times."""
+
+        if self.trip_open is None:
+            return
+
+        trip_id = self.trip_open
+        self.trip_open = None
+
+        if self.duplicates is not None or self.trip_buffer:
+            self._writer_drain()  # Database read/written in this thread
+
+        if self.duplicates is not None and self._trip_duplicate(
+            trip_id=trip_id
+        ):
+            self.trip_buffer = []
+            return
+
+        if not self.trip_buffer:
+            return
+
+        key = tuple(
+            (stop[4], stop[3], stop[5], stop[6], stop[7])
+            for stop in self.trip_buffer
+        )
+        hhmm = array.array("h")
+
+        for stop in self.trip_buffer:
+            for time_str in stop[1:3]:
+                hhmm.append(
+                    int(time_str[:-6]) * 100 + int(time_str[-5:-3])
+                )  # Hours may exceed 2 digits, but never 99
+
+        c = self.db.cursor()
+
+        if not self.pattern_cache:
+            c.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS stop_patterns (pattern_id
+                INTEGER, stop_sequence INTEGER, stop_id TEXT, pickup_type
+                INTEGER, drop_off_type INTEGER, timepoint INTEGER, PRIMARY KEY
+                (pattern_id, stop_sequence))"""
+            )
+            c.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS trip_times (trip_id INTEGER
+                PRIMARY KEY, pattern_id INTEGER, times BLOB)"""
+            )
+
+        pattern_id = self.pattern_cache.get(key)
+
+        if pattern_id is None:
+            pattern_id = len(self.pattern_cache) + 1
+            self.pattern_cache[key] = pattern_id
+            c.executemany(
+                """INSERT INTO temp.stop_patterns (pattern_id, stop_sequence,
+                stop_id, pickup_type, drop_off_type, timepoint) VALUES
+                (?,?,?,?,?,?)""",
+                [(pattern_id,) + stop for stop in key],
+            )
+
+        c.execute(
+            """INSERT OR REPLACE INTO temp.trip_times (trip_id, pattern_id,
+            times) VALUES (?,?,?)""",
+            (trip_id, pattern_id, hhmm.tobytes()),
+        )
+        self.db.commit()
+        self.trip_buffer = []
+
+    def _date_offset(self, date_str="", days=0):
+        """@return YYYYMMDD string @param integer days after YYYYMMDD
+        @param date_str (or date_str unchanged if unparsable)."""
+
+        try:
+            return (
+                datetime.datetime.strptime(date_str, self.date_format)
+                + datetime.timedelta(days=days)
+            ).strftime(self.date_format)
+
+        except ValueError:
+            return date_str
+
+    def _iter_rows(
+        self,
+        table="",
+        fields=[],
+        batch_size=1000,
+        order=None,
+        named=False,
+        shard=None,
+    ):
+        """Yields the rows of @param table, as iter_table(), once that has
+        validated the arguments: @param fields list of its columns, and
+        @param order tuple of columns (or None)."""
+
+        if table == "stop_times":
+            self.expand_patterns()
+
+        c = self.db.cursor()
+
+        if order:
+            c.execute(
+                "CREATE INDEX IF NOT EXISTS {}_{} ON {} ({})".format(
+                    table, "_".join(order), table, ", ".join(order)
+                )
+            )  # nosec - See _gtfs_structure Security Issue
+            self.db.commit()
+
+        where, parameters = self._shard_where(table=table, shard=shard)
+        c.execute(
+            "SELECT {} FROM {}{}{}".format(
+                ", ".join(fields),
+                table,
+                "" if where == "" else " WHERE {}".format(where),
+                "" if not order else " ORDER BY {}".format(", ".join(order)),
+            ),
+            parameters,
+        )  # nosec - See _gtfs_structure Security Issue
+
+        if named:
+            row_type = collections.namedtuple(table, fields)
+
+        rows = c.fetchmany(batch_size)
+
+        while rows:
+            for row in rows:
+                yield row_type._make(row) if named else row
+
+            rows = c.fetchmany(batch_size)
+
+    @contextlib.contextmanager
+    def _memory_phase(self, phase=""):
+        """Context recording the memory use of @param phase (if
+        self.memory_profile) into self.memory_phases[phase]: calls, seconds,
+        peak (most bytes allocated above the start of any call, as traced
+        by tracemalloc, which runs only during phases), net (bytes still
+        allocated at the end, summed over calls), rss (peak process
+        resident set size by the end, None if unknown), top (largest live
+        allocation sites at the end of the call with the highest peak:
+        [file:line, bytes, blocks]). Phases may nest. Before Python 3.9,
+        tracemalloc cannot reset its peak, so the peak (and top) of a phase
+        that did not start tracing is None. Tracing is shared by concurrent
+        instances (see self._tracing), whose allocations then overlap."""
+
+        if not self.memory_profile:
+            yield
+            return
+
+        outer = len(self.memory_stack) == 0
+        started = False  # Tracing started by this phase, so peak is its own
+        if outer:
+            with self._tracing["lock"]:
+                if self._tracing["users"] == 0:
+                    self._tracing["owned"] = not tracemalloc.is_tracing()
+                    if self._tracing["owned"]:
+                        tracemalloc.start()
+                        started = True
+                self._tracing["users"] += 1
+        else:  # Outer peak so far
+            self.memory_stack[-1] = max(
+                self.memory_stack[-1], tracemalloc.get_traced_memory()[1]
+            )
+        if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+            tracemalloc.reset_peak()
+
+        self.memory_stack.append(0)
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.memory_stack.pop())
+            if len(self.memory_stack) > 0:
+                self.memory_stack[-1] = max(self.memory_stack[-1], peak)
+
+            if phase not in self.memory_phases:
+                self.memory_phases[phase] = {
+                    "calls": 0,
+                    "seconds": 0,
+                    "peak": 0,
+                    "net": 0,
+                    "rss": None,
+                    "top": [],
+                }
+            record = self.memory_phases[phase]
+            record["calls"] += 1
+            record["seconds"] += time.perf_counter() - start_time
+            record["net"] += current - start_memory
+
+            try:
+                import resource
+
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                if sys.platform != "darwin":
+                    rss *= 1024  # KiB, except macOS bytes
+                record["rss"] = max(record["rss"] or 0, rss)
+            except ImportError:
+                pass  # Windows
+
+            if not started and not hasattr(tracemalloc, "reset_peak"):
+                record["peak"] = None  # Peak since tracing began, not phase
+            elif record["peak"] is None:
+                pass  # Unmeasured by another call
+            elif peak - start_memory >= record["peak"]:
+                record["peak"] = peak - start_memory
+                snapshot = tracemalloc.take_snapshot().filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__)]
+                )  # Taken after measurement, so not measured
+                record["top"] = [
+                    [
+                        "{}:{}".format(
+                            os.path.basename(stat.traceback[0].filename),
+                            stat.traceback[0].lineno,
+                        ),
+                        stat.size,
+                        stat.count,
+                    ]
+                    for stat in snapshot.statistics("lineno")[:10]
+                ]
+                del snapshot
+
+            if outer:
+                with self._tracing["lock"]:
+                    self._tracing["users"] -= 1
+                    if self._tracing["users"] == 0 and self._tracing["owned"]:
+                        tracemalloc.stop()
+                        self._tracing["owned"] = False
+            if tracemalloc.is_tracing() and hasattr(
+                tracemalloc, "reset_peak"
+            ):
+                tracemalloc.reset_peak()
+
+    def _progress(self, done=False, rows=0):
+        """Counts @param rows written (if self.progress_state), and if
+        self.progress seconds have passed since the last progress event (or
+        @param done), logs and passes to self.progress_callback a new event
+        dict: stage (file or dump), source, seconds, bytes (read), total
+        (bytes to read, or to dump rows to write, None if unknown), lines,
+        journeys, rows (written), each of those three per_second, percent
+        and eta (seconds, None if unknown), and done. Safe to call from
+        parallel dump threads. file() calls this only every 1024 lines,
+        keeping the cost negligible. @return line_num of next call."""
+
+        state = self.progress_state
+        if state is None:
+            return sys.maxsize
+
+        with state["lock"]:
+            state["rows"] += rows
+            now = time.monotonic()
+            if now < state["due"] and not done:
+                return self.line_num + 1024
+            state["due"] = now + self.progress
+
+            seconds = max(now - state["start"], 1e-6)
+            position = None
+            if state["position"] is not None:
+                try:
+                    position = state["position"]()
+                except (OSError, ValueError):
+                    pass  # Unseekable or closed stream
+            if done and state["stage"] == "file" and position is None:
+                position = state["total"]  # Stream since closed
+            event = {
+                "stage": state["stage"],
+                "source": state["source"],
+                "seconds": round(seconds, 1),
+                "bytes": position,
+                "total": state["total"],
+                "lines": self.line_num - state["lines"],
+                "journeys": self.trip_id - state["journeys"],
+                "rows": state["rows"],
+                "percent": None,
+                "eta": None,
+                "done": done,
+            }
+            for count in ["lines", "journeys", "rows"]:
+                event["{}_per_second".format(count)] = round(
+                    event[count] / seconds
+                )
+
+            done_amount = position if state["stage"] == "file" else (
+                state["rows"]
+            )
+            if done:
+                event["percent"] = 100
+                event["eta"] = 0
+            elif state["total"] and done_amount is not None:
+                event["percent"] = round(
+                    100 * min(done_amount / state["total"], 1), 1
+                )
+                event["eta"] = round(
+                    seconds * max(state["total"] - done_amount, 0)
+                    / done_amount
+                )
+
+            if state["stage"] == "file":
+                if position is None:
+                    amount = "{} lines read".format(event["lines"])
+                else:
+                    amount = "{} bytes read".format(position)
+                rates = "{} lines/s, {} journeys/s".format(
+                    event["lines_per_second"], event["journeys_per_second"]
+                )
+            else:
+                amount = "{} rows written".format(event["rows"])
+                rates = "{} rows/s".format(event["rows_per_second"])
+            if event["percent"] is not None:
+                amount = "{}% ({})".format(event["percent"], amount)
+            logging.info(
+                "%s: %s, %s%s",
+                event["source"],
+                amount,
+                rates,
+                "" if event["eta"] is None else ", ETA {}s".format(
+                    event["eta"]
+                ),
+            )
+
+            if self.progress_callback is not None:
+                self.progress_callback(event)
+
+        return self.line_num + 1024
+
+    def _progress_start(self, stage="", source="", total=None, position=None):
+        """Starts progress events (if self.progress) for @param stage, file
+        or dump, of @param source name, of @param total bytes or rows (None
+        if unknown), with bytes read so far returned by @param position
+        callable (if any). @return line_num at which file() should next call
+        _progress()."""
+
+        if self.progress is None:
+            self.progress_state = None
+            return sys.maxsize
+
+        now = time.monotonic()
+        self.progress_state = {
+            "stage": stage,
+            "source": source,
+            "total": total,
+            "position": position,
+            "start": now,
+            "due": now + self.progress,
+            "lines": self.line_num,
+            "journeys": self.trip_id,
+            "rows": 0,
+            "lock": threading.Lock(),
+        }
+        return self.line_num + 1024
+
+    def _progress_total(self):
+        """@return number of rows in all GTFS tables (stop_times expanded),
+        if progress events are wanted, else None."""
+
+        if self.progress is None:
+            return None
+
+        c = self.db.cursor()
+        total = 0
+        for table in self._gtfs_structure.keys():
+            c.execute("SELECT COUNT(*) FROM {}".format(table))
+            # nosec - See _gtfs_structure Security Issue
+            total += c.fetchone()[0]
+
+        return total
+
+    def _raw_id(self, id=""):
+        """@return @param id less any file suffix added by self.sanitize_id()
+        for self.unique_ids, as found in the current ATCO-CIF file."""
+
+        suffix = "_{:04d}".format(self.file_num)
+
+        if self.unique_ids and id.endswith(suffix):
+            return id[:-len(suffix)]
+
+        return id
+
+    def _shard_where(self, table="", shard=None):
+        """@return list [sql WHERE condition (empty string if none), list of
+        parameters] that limits GTFS @param table to the trips of @param
+        shard (as dump()) and the records they reference."""
+
+        if shard is None or len(shard) == 0:
+            return ["", []]
+
+        key, ids = list(shard.items())[0]
+        placeholders = ", ".join(["?"] * len(ids))
+
+        if key == "agency_id":
+            trips = """SELECT trip_id FROM trips WHERE route_id IN (SELECT
+                route_id FROM routes WHERE agency_id IN ({}))""".format(
+                placeholders
+            )
+        elif key == "route_id":
+            trips = """SELECT trip_id FROM trips WHERE route_id IN
+                ({})""".format(placeholders)
+        elif key == "trip_range":
+            trips = """SELECT trip_id FROM trips WHERE {}""".format(
+                " OR ".join(["trip_id BETWEEN ? AND ?"] * len(ids)) or "0"
+            )
+            ids = [trip_id for trip_range in ids for trip_id in trip_range]
+        else:
+            raise ValueError("Unknown shard key {}".format(key))
+
+        where = {
+            "agency": """agency_id IN (SELECT agency_id FROM routes WHERE
+                route_id IN (SELECT route_id FROM trips WHERE trip_id IN
+                ({})))""",
+            "stops": """stop_id IN (SELECT stop_id FROM stop_times WHERE
+                trip_id IN ({0})) OR stop_id IN (SELECT parent_station FROM
+                stops WHERE parent_station IS NOT NULL AND stop_id IN (SELECT
+                stop_id FROM stop_times WHERE trip_id IN ({0})))""",
+            # Including their parents (NULL would make NOT IN unknown)
+            "routes": """route_id IN (SELECT route_id FROM trips WHERE
+                trip_id IN ({}))""",
+            "trips": """trip_id IN ({})""",
+            "stop_times": """trip_id IN ({})""",
+            "calendar": """service_id IN (SELECT service_id FROM trips WHERE
+                trip_id IN ({}))""",
+            "calendar_dates": """service_id IN (SELECT service_id FROM trips
+                WHERE trip_id IN ({}))""",
+        }
+
+        return [
+            where[table].format(trips),
+            list(ids) * max(where[table].count("{0}"), 1),
+        ]  # Parameters repeated for each use of trips
+
+    def _stop_time_insert(self, stop_time=()):
+        """Adds @param stop_time tuple (trip_id, arrival_time,
+        departure_time, stop_id, stop_sequence, pickup_type, drop_off_type,
+        timepoint) to the stop_times table, or if self.pattern_store, to
+        self.trip_buffer pending _end_trip()."""
+
+        if self.trip_open != stop_time[0]:
+            self._end_trip()
+            self.trip_open = stop_time[0]
+            if self.duplicates is not None:
+                self.trip_hash = hashlib.sha1()  # nosec - Not security
+
+        if self.duplicates is not None:
+            self.trip_hash.update(
+                "{}\x1f{}\x1f{}\x1f{}\x1f{}\x1f{}\x1e".format(
+                    self._raw_id(id=stop_time[3]),
+                    stop_time[1],
+                    stop_time[2],
+                    stop_time[5],
+                    stop_time[6],
+                    stop_time[7],
+                ).encode("utf-8")
+            )  # In stop_sequence order, so sequence is implicit
+
+        if self.pattern_store:
+            self.trip_buffer.append(stop_time)
+
+        else:
+            self._db_write(
+                """INSERT INTO stop_times (trip_id, arrival_time,
+                departure_time, stop_id, stop_sequence, pickup_type,
+                drop_off_type, timepoint) VALUES (?,?,?,?,?,?,?,?)""",
+                stop_time,
+            )
+
+    def _gtfs_time_seconds(self, time_str=""):
+        """@return integer seconds since notional midnight of @param
+        time_str, a GTFS (H:MM:SS) string as stored, so without adding any
+        active day_offset, or None if malformed."""
+
+        time_tuple = timecodec.gtfs_tuples.get(time_str[:5])
+        if time_tuple is not None and time_str[5:] in ["", ":00"]:
+            return (time_tuple[0] * 60 + time_tuple[1]) * 60  # As created
+
+        try:
+            parts = [int(part) for part in time_str.split(":")]
+        except ValueError:
+            return None
+        if len(parts) not in [2, 3]:
+            return None
+        return parts[0] * 3600 + parts[1] * 60 + sum(parts[2:])
+
     def _time_str_to_minutes(self, time_str="", is_gtfs=False):
         """@return integer minutes since notional midnight of @param time_str
         string in ATCO-CIF (HHMM), or if @param is_gtfs boolean True, GTFS
@@ -1476,6 +3401,306 @@ class atcocif:
 
         return (time_tuple[0] * 60) + time_tuple[1]
 
+    def _trip_stop_times(self, trip_id=0):
+        """@return list of (arrival_time, departure_time, stop_id,
+        stop_sequence, pickup_type, drop_off_type, timepoint) of @param
+        trip_id, in stop_sequence order, from the stop_times table or the
+        pattern store."""
+
+        c = self.db.cursor()
+
+        self._end_trip()
+
+        if self.pattern_cache:
+            c.execute(
+                """SELECT pattern_id, times FROM temp.trip_times WHERE
+                trip_id=?""",
+                (trip_id,),
+            )
+            trip = c.fetchone()
+
+            if trip is not None:
+                hhmm = array.array("h")
+                hhmm.frombytes(trip[1])
+                c.execute(
+                    """SELECT stop_id, stop_sequence, pickup_type,
+                    drop_off_type, timepoint FROM temp.stop_patterns WHERE
+                    pattern_id=? ORDER BY stop_sequence ASC""",
+                    (trip[0],),
+                )
+                return [
+                    (
+                        self.time_tuple_to_gtfs_str(
+                            time_tuple=divmod(hhmm[i * 2], 100)
+                        ),
+                        self.time_tuple_to_gtfs_str(
+                            time_tuple=divmod(hhmm[i * 2 + 1], 100)
+                        ),
+                    ) + stop
+                    for i, stop in enumerate(c.fetchall())
+                ]
+
+        c.execute(
+            """SELECT arrival_time, departure_time, stop_id, stop_sequence,
+            pickup_type, drop_off_type, timepoint FROM stop_times WHERE
+            trip_id=? ORDER BY stop_sequence ASC""",
+            (trip_id,),
+        )
+        return c.fetchall()
+
+    def _trip_delete(self, trip_id=0):
+        """Removes @param trip_id, its stop_times, its pending service, and
+        any calendar no longer used by any trip."""
+
+        c = self.db.cursor()
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS trips_trip_id ON trips (trip_id)"""
+        )
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS stop_times_trip_id_stop_sequence ON
+            stop_times (trip_id, stop_sequence)"""
+        )  # As _gtfs_indexes
+        c.execute(
+            """SELECT service_id FROM trips WHERE trip_id=?""", (trip_id,)
+        )
+        service_id = c.fetchone()
+        c.execute("""DELETE FROM trips WHERE trip_id=?""", (trip_id,))
+        c.execute("""DELETE FROM stop_times WHERE trip_id=?""", (trip_id,))
+        if self.pattern_cache:
+            c.execute(
+                """DELETE FROM temp.trip_times WHERE trip_id=?""", (trip_id,)
+            )
+        self.service.pop(trip_id, None)
+
+        if service_id is not None and service_id[0] is not None:
+            c.execute(
+                """SELECT 1 FROM trips WHERE service_id=? LIMIT 1""",
+                service_id,
+            )
+            if c.fetchone() is None:
+                c.execute(
+                    """DELETE FROM calendar WHERE service_id=?""", service_id
+                )
+                c.execute(
+                    """DELETE FROM calendar_dates WHERE service_id=?""",
+                    service_id,
+                )
+
+        self.db.commit()
+
+    def _trip_duplicate(self, trip_id=0):
+        """Completes the fingerprint of @param trip_id (its stop_times, plus
+        its operator, route number, direction and calendar, all without
+        unique_ids suffixes) and checks it against those of all prior trips.
+        Where matched, the self.duplicates policy applies: first keeps the
+        earlier trip, last keeps this trip, and report keeps both. Matches
+        are recorded in self.journey_duplicate. @return True if trip_id was
+        dropped."""
+
+        service = self.service.get(trip_id)
+        self.trip_hash.update(
+            "{}\x1f{}\x1f{}\x1f{}".format(
+                *(self.trip_route or ("", "")),
+                None if service is None else service.get("calendar"),
+                None if service is None else service.get("calendar_dates"),
+            ).encode("utf-8")
+        )
+        fingerprint = self.trip_hash.digest()
+        c = self.db.cursor()
+        c.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS trip_fingerprints (fingerprint
+            BLOB PRIMARY KEY, trip_id INTEGER)"""
+        )
+        c.execute(
+            """SELECT trip_id FROM temp.trip_fingerprints WHERE
+            fingerprint=?""",
+            (fingerprint,),
+        )
+        match = c.fetchone()
+
+        if match is None:
+            c.execute(
+                """INSERT INTO temp.trip_fingerprints (fingerprint, trip_id)
+                VALUES (?,?)""",
+                (fingerprint, trip_id),
+            )
+            return False
+
+        self.journey_duplicate.append((match[0], trip_id))
+        logging.debug(
+            "Journey ending line %s of %s duplicates trip_id %s",
+            self.line_num,
+            self.base_filename,
+            match[0],
+        )
+
+        if self.duplicates == "first":
+            self._trip_delete(trip_id=trip_id)
+            return True
+
+        if self.duplicates == "last":
+            self._trip_delete(trip_id=match[0])
+            c.execute(
+                """UPDATE temp.trip_fingerprints SET trip_id=? WHERE
+                fingerprint=?""",
+                (trip_id, fingerprint),
+            )
+
+        return False
+
+    def _read_ahead(self, filename="", stream=None, consumed=None):
+        """Yields the lines of @param filename (or of binary @param stream,
+        as file()), read in large blocks by a reader thread up to a few
+        blocks ahead of the consumer (a bounded queue provides
+        backpressure), which also decompresses any compressed stream.
+        If @param consumed list, its first item is set to the position in
+        the binary stream (bytes, as stream.tell()) at the end of each block
+        as its lines are yielded, or None if unknown. Reader errors are
+        raised here."""
+
+        blocks = queue.Queue(maxsize=4)
+        stop = threading.Event()
+
+        def put(block):
+            while not stop.is_set():
+                try:
+                    blocks.put(block, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read():
+            try:
+                if stream is None:
+                    binary = open(filename, "rb", buffering=1 << 20)
+                else:
+                    binary = stream
+                with io.TextIOWrapper(binary) as cif:
+                    block = cif.readlines(1 << 20)
+                    while block and not stop.is_set():
+                        try:
+                            position = binary.tell()  # Not decoded length
+                        except (AttributeError, OSError, ValueError):
+                            position = None  # Unseekable stream
+                        put((block, position))
+                        block = cif.readlines(1 << 20)
+                put(([], None))  # End of file
+            except Exception as e:
+                put(e)
+
+        reader = threading.Thread(
+            target=contextvars.copy_context().run, args=(read,), daemon=True
+        )
+        reader.start()
+
+        try:
+            while True:
+                block = blocks.get()
+                if isinstance(block, Exception):
+                    raise block
+                lines, position = block
+                if not lines:
+                    break
+                if consumed is not None:
+                    consumed[0] = position
+                yield from lines
+
+        finally:
+            stop.set()
+            reader.join()
+
+    def _warn(self, category="", level=logging.WARNING, message="", *args):
+        """Logs a per-line problem: @param message with @param args, at
+        @param level, counted in self.warning_count by file and @param
+        category. Beyond self.warning_limit per file and category, further
+        problems are only counted (unless self.verbose), and summarised by
+        file() and report(), so corrupt files do not flood the log."""
+
+        key = (self.file_num, category)  # Not name, which may repeat
+        count = self.warning_count.get(key, 0) + 1
+        self.warning_count[key] = count
+
+        if self.verbose or count <= self.warning_limit:
+            logging.log(level, message, *args)
+
+    def _writer_drain(self):
+        """Waits until the pipeline writer (if any) has written everything
+        queued, so the database can be used in this thread. Raises any error
+        the writer met."""
+
+        if self.writer is None:
+            return
+
+        self._writer_flush()
+        self.writer[1].join()
+
+        if self.writer[2]:
+            raise self.writer[2][0]
+
+    def _writer_flush(self):
+        """Queues pending writes for the pipeline writer thread, which
+        executes each run of the same SQL as one batch, then commits. Blocks
+        while the writer's queue is full."""
+
+        batches = []
+        for sql, parameters in self.write_pending:
+            if batches and batches[-1][0] == sql:
+                batches[-1][1].append(parameters)
+            else:
+                batches.append((sql, [parameters]))
+        self.write_pending = []
+
+        if batches:
+            self.writer[1].put(batches)
+
+    def _writer_start(self):
+        """Starts the pipeline writer thread, which receives batched writes
+        via _db_write(), through a bounded queue."""
+
+        writes = queue.Queue(maxsize=4)
+        errors = []
+
+        def write():
+            batches = writes.get()
+            while batches is not None:
+                try:
+                    if not errors:
+                        c = self.db.cursor()
+                        for sql, parameters in batches:
+                            c.executemany(sql, parameters)
+                        self.db.commit()
+                except Exception as e:
+                    errors.append(e)
+                writes.task_done()
+                batches = writes.get()
+            writes.task_done()
+
+        self.write_pending = []
+        self.writer = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(write,),
+                daemon=True,
+            ),
+            writes,
+            errors,
+        ]
+        self.writer[0].start()
+
+    def _writer_stop(self):
+        """Drains then stops the pipeline writer thread (if any). Raises any
+        error the writer met."""
+
+        if self.writer is None:
+            return
+
+        try:
+            self._writer_drain()
+        finally:
+            self.writer[1].put(None)
+            self.writer[0].join()
+            self.writer = None
+
     def _unique_list(self, list=[]):
         """@return list consisting the unique parts of @param list."""
 
@@ -1490,6 +3715,177 @@ class atcocif:
 
         return unique
 
+    def calendar_active_dates(self, calendar=[], calendar_dates=[]):
+        """@return set of YYYYMMDD date strings on which a service runs,
+        expanded day-by-day from @param calendar (as self.calendar_list())
+        and @param calendar_dates (as self.calendar_exception_list()). Where
+        a date is both added and removed, the addition wins."""
+
+        active = set()
+
+        if len(calendar) == 9:
+            try:
+                check_dt = datetime.datetime.strptime(
+                    calendar[7],
+                    self.date_format
+                )
+                end_dt = datetime.datetime.strptime(
+                    calendar[8],
+                    self.date_format
+                )
+                step = datetime.timedelta(days=1)
+
+                while check_dt <= end_dt:
+                    if calendar[check_dt.weekday()] == 1:
+                        active.add(check_dt.strftime(self.date_format))
+                    check_dt += step
+
+            except ValueError:
+                pass
+
+        for date in calendar_dates:
+            if date[1] == 2:
+                active.discard(date[0])
+        for date in calendar_dates:
+            if date[1] == 1:
+                active.add(date[0])
+
+        return active
+
+    def calendar_bounds(self, dates=None, start_date="", end_date=""):
+        """@return list [first, last] of the YYYYMMDD date strings within
+        @param dates (array of datetimes, as self.school_term) that fall
+        between @param start_date and @param end_date (YYYYMMDD strings)
+        inclusive, or None if no dates fall within that period."""
+
+        if dates is None:
+            return None
+
+        try:
+            start_dt = datetime.datetime.strptime(start_date, self.date_format)
+            end_dt = datetime.datetime.strptime(end_date, self.date_format)
+
+        except ValueError:
+            return None
+
+        within = [date for date in dates if start_dt <= date <= end_dt]
+
+        if len(within) == 0:
+            return None
+
+        return [
+            min(within).strftime(self.date_format),
+            max(within).strftime(self.date_format),
+        ]
+
+    def calendar_clip(self, calendar=[], start_date="", end_date=""):
+        """Removes the period @param start_date to @param end_date (YYYYMMDD
+        strings) from @param calendar (as self.calendar_list()) in closed
+        form, by moving the calendar's start or end date inward where the
+        period overlaps either end of the calendar. @return list [calendar,
+        start_date, end_date], where the returned dates bound any remainder
+        of the period that still needs removing day-by-day (start_date after
+        end_date if nothing remains). A wholly removed calendar is collapsed
+        to end before it starts. The calendar is copied, not altered."""
+
+        if len(calendar) != 9:
+            return [calendar, start_date, end_date]
+
+        try:
+            calendar_start = datetime.datetime.strptime(
+                calendar[7],
+                self.date_format
+            )
+            calendar_end = datetime.datetime.strptime(
+                calendar[8],
+                self.date_format
+            )
+            remove_start = max(
+                datetime.datetime.strptime(start_date, self.date_format),
+                calendar_start,
+            )
+            remove_end = min(
+                datetime.datetime.strptime(end_date, self.date_format),
+                calendar_end,
+            )
+
+        except ValueError:
+            return [calendar, start_date, end_date]
+
+        calendar = calendar[:]
+        step = datetime.timedelta(days=1)
+        nothing = [
+            calendar,
+            (calendar_end + step).strftime(self.date_format),
+            calendar_end.strftime(self.date_format),
+        ]  # Start after end
+
+        if remove_start > remove_end:
+            return nothing  # Period falls outside calendar
+
+        if remove_start == calendar_start and remove_end == calendar_end:
+            # Whole calendar: Empty range, weekdays still filter additions
+            calendar[8] = (calendar_start - step).strftime(self.date_format)
+            return nothing
+
+        elif remove_start == calendar_start:
+            calendar[7] = (remove_end + step).strftime(self.date_format)
+            return nothing
+
+        elif remove_end == calendar_end:
+            calendar[8] = (remove_start - step).strftime(self.date_format)
+            return nothing
+
+        return [
+            calendar,
+            remove_start.strftime(self.date_format),
+            remove_end.strftime(self.date_format),
+        ]
+
+    def calendar_encode(self, dates=set()):
+        """@return list [calendar, calendar_dates] (as self.calendar_list()
+        and self.calendar_exception_list()) that runs on exactly the set of
+        YYYYMMDD strings @param dates, using the fewest calendar_dates rows:
+        The calendar spans first to last date, and each weekday is flagged
+        if that needs fewer removals than it would additions. @return None
+        if dates is empty."""
+
+        if len(dates) == 0:
+            return None
+
+        ordered = sorted(dates)
+        check_dt = datetime.datetime.strptime(ordered[0], self.date_format)
+        end_dt = datetime.datetime.strptime(ordered[-1], self.date_format)
+        step = datetime.timedelta(days=1)
+        active = [[] for weekday in range(7)]
+        inactive = [[] for weekday in range(7)]
+
+        while check_dt <= end_dt:
+            date = check_dt.strftime(self.date_format)
+            if date in dates:
+                active[check_dt.weekday()].append(date)
+            else:
+                inactive[check_dt.weekday()].append(date)
+            check_dt += step
+
+        calendar = []
+        calendar_dates = []
+
+        for weekday in range(7):
+            if (
+                len(active[weekday]) > 0
+                and len(inactive[weekday]) <= len(active[weekday])
+            ):
+                calendar.append(1)
+                calendar_dates += [[date, 2] for date in inactive[weekday]]
+            else:
+                calendar.append(0)
+                calendar_dates += [[date, 1] for date in active[weekday]]
+
+        calendar_dates.sort()
+
+        return [calendar + [ordered[0], ordered[-1]], calendar_dates]
+
     def calendar_exception_list(
         self,
         exception_dates=None,
@@ -1507,10 +3903,12 @@ class atcocif:
         by self.calendar_list(), or [] for any day. @param start_date and
         end_date are YYYYMMDD strings. @param action integer is 1 to add
         dates, 2 to remove. @param invert boolean True to process the inverse
-        of exception_dates (between start_date and end_date)."""
+        of exception_dates (between start_date and end_date). Removals are
+        limited to the period of any calendar, since other dates never run."""
 
         if exception_dates is None:  # Bank holiday/school dates missing
             exception_dates = []
+        exception_dates = set(exception_dates)
 
         try:
             dates = []
@@ -1521,6 +3919,19 @@ class atcocif:
             end_dt = datetime.datetime.strptime(end_date, self.date_format)
             step = datetime.timedelta(days=1)
 
+            if action == 2 and len(calendar) == 9:
+                try:
+                    check_dt = max(check_dt, datetime.datetime.strptime(
+                        calendar[7],
+                        self.date_format
+                    ))
+                    end_dt = min(end_dt, datetime.datetime.strptime(
+                        calendar[8],
+                        self.date_format
+                    ))
+                except ValueError:
+                    pass  # Malformed calendar, so remove whole period
+
             while check_dt <= end_dt:
                 if (
                     (
@@ -1540,7 +3951,9 @@ class atcocif:
             return dates
 
         except ValueError:
-            logging.error(
+            self._warn(
+                "calendar_dates",
+                logging.ERROR,
                 "Failed to create calendar_dates on line %s of %s",
                 self.line_num,
                 self.base_filename,
@@ -1568,7 +3981,9 @@ class atcocif:
             ]
 
         except ValueError:
-            logging.error(
+            self._warn(
+                "calendar",
+                logging.ERROR,
                 "Failed to create service calendar on line %s of %s",
                 self.line_num,
                 self.base_filename,
@@ -1591,7 +4006,7 @@ class atcocif:
 
         try:
             if len(date_str) != 8:
-                raise
+                raise ValueError("date length")
 
             if date_str in [(" " * 8), ("9" * 8)]:
                 if is_commence:
@@ -1601,7 +4016,9 @@ class atcocif:
             return date_str
 
         except ValueError:
-            logging.error(
+            self._warn(
+                "date",
+                logging.ERROR,
                 "Failed to sanitize date %s on line %s of %s",
                 date_str,
                 self.line_num,
@@ -1650,6 +4067,56 @@ class atcocif:
 
         return id
 
+    def stop_name_stem(self, name=""):
+        """@return @param name less any trailing bracketed text, stand, bay,
+        stop, platform or gate designation, or lone letter or number, such
+        that the stops of one place share a stem (compared lowercase)."""
+
+        stem = name.strip()
+        for pattern in self._stop_stem_patterns:
+            stem = pattern.sub("", stem)
+
+        return stem.strip(" ,/-")
+
+    def stop_spill(self):
+        """Moves all of self.stop_cache into a temporary database table,
+        indexed by stop_id, merging with any stop data already moved there,
+        then empties self.stop_cache (thus bounding its memory)."""
+
+        self._writer_drain()
+        c = self.db.cursor()
+
+        if not self.stop_spilled:
+            c.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS stop_spill (stop_id TEXT
+                PRIMARY KEY, name TEXT, easting TEXT, northing TEXT)"""
+            )
+            self.stop_spilled = True
+
+        spill = []
+        for stop_id, stop in self.stop_cache.items():
+            spill.append(
+                (
+                    stop.get("name"),
+                    stop.get("easting"),
+                    stop.get("northing"),
+                    stop_id,
+                )
+            )
+
+        c.executemany(
+            """INSERT OR IGNORE INTO temp.stop_spill (stop_id) VALUES (?)""",
+            [(stop[3],) for stop in spill]
+        )
+        c.executemany(
+            """UPDATE temp.stop_spill SET name=COALESCE(?, name),
+            easting=COALESCE(?, easting), northing=COALESCE(?, northing)
+            WHERE stop_id=?""",
+            spill
+        )
+        self.db.commit()
+        self.stop_cache = {}
+
     def time_str_to_time_tuple(self, time_str="", is_gtfs=False):
         """Converts @param time_str in ATCO-CIF (HHMM), or if @param is_gtfs
         boolean True, GTFS (HH:MM:SS) format to @return time_tuple
@@ -1658,6 +4125,19 @@ class atcocif:
         datetime functions. Seconds are always 0 because ATCO-CIF cannot hold
         seconds, so any created GTFS time must have 0 seconds."""
 
+        if is_gtfs:
+            time_tuple = timecodec.gtfs_tuples.get(time_str[:5])
+        else:
+            time_tuple = timecodec.atco_tuples.get(time_str[:4])
+
+        if time_tuple is not None:  # Else malformed, so parse the slow way
+            if self.day_offset == 0:
+                return time_tuple
+            return (
+                min(time_tuple[0] + 24 * self.day_offset, 99),
+                time_tuple[1],
+            )  # Neither format allows >99 hours
+
         try:
             if is_gtfs:
                 hour = int(time_str[3:5])
@@ -1675,7 +4155,9 @@ class atcocif:
             )
 
         except ValueError:
-            logging.error(
+            self._warn(
+                "time",
+                logging.ERROR,
                 "Failed to convert time %s on line %s of %s",
                 time_str,
                 self.line_num,
@@ -1696,13 +4178,19 @@ class atcocif:
         """Converts @param time_tuple (hour, minute) into @return
         string GTFS time (HH:MM:SS)."""
 
+        gtfs_str = timecodec.gtfs_strings.get(tuple(time_tuple))
+        if gtfs_str is not None:
+            return gtfs_str
+
         try:
             return "{:02d}:{:02d}:{:02d}".format(
                 time_tuple[0], time_tuple[1], 0  # hour, minute, second
             )
 
         except ValueError:
-            logging.error(
+            self._warn(
+                "time",
+                logging.ERROR,
                 "Failed to create GTFS time on line %s of %s",
                 self.line_num,
                 self.base_filename,
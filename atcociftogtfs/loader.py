@@ -5,8 +5,21 @@ an output GTFS archive."""
 
 
 import argparse
+import base64
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import gzip
+import http.server
+import io
+import json
 import logging
+import lzma
 import os
+import threading
+import urllib.parse
 import urllib.request
 import shutil
 import tempfile
@@ -21,12 +34,13 @@ def main(args=None):
     """Entry point: Start here. @param args namespace may contain processed
     arguments. If None, argparse will instead read command line arguments."""
 
-    start_time = time.time()
     if args is None:
         args = arguments()
 
     if hasattr(args, "verbose") and args.verbose:
         logging_level = logging.DEBUG
+    elif getattr(args, "progress", None) is not None:
+        logging_level = logging.INFO  # Progress, without debug detail
     else:
         logging_level = logging.WARNING
 
@@ -39,12 +53,34 @@ def main(args=None):
     else:
         logging.basicConfig(level=logging_level, format="%(message)s")
 
-    processor = atcocif(args=args)  # Same class instance throughout
+    if getattr(args, "feeds", None) is not None:
+        return feeds(filename=args.feeds)
+
+    if getattr(args, "serve", None) is not None:
+        return serve(address=args.serve)
+
+    if getattr(args, "watch", None) is not None:
+        return watcher(args=args, settle=args.watch).run(interval=args.watch)
+
+    return run(args=args)
 
-    if not hasattr(args, "source"):
+
+def run(args=None):
+    """Runs a single conversion of @param args namespace (as main(), once
+    logging is set up). @return 0 if OK, 1 not."""
+
+    start_time = time.time()
+
+    if len(getattr(args, "source", None) or []) == 0:
         logging.error("No sources to process.")
         return 1
 
+    if getattr(args, "scan", False):
+        print(json.dumps(scan(sources=args.source), indent=2))
+        return 0
+
+    processor = atcocif(args=args)  # Same class instance throughout
+
     logging.info("Gathering data from %s...", ", ".join(args.source))
 
     for source in args.source:
@@ -57,8 +93,33 @@ def main(args=None):
         logging.error("No output file specified.")
         return 1
 
+    if getattr(args, "diff", None) is not None:
+        changes = processor.diff_changes(filename=args.diff)
+
+        if (
+            getattr(args, "skip_unchanged", False)
+            and changes is not None
+            and not any(
+                keys for section in changes.values()
+                for keys in section.values()
+            )
+        ):
+            logging.info("No changes since %s. Skipped output.", args.diff)
+            return 0
+
     status = processor.dump(filename=args.gtfs)
 
+    if status == 0 and getattr(args, "columnar", None) is not None:
+        status = processor.export_columnar(directory=args.columnar)
+
+    if status == 0 and getattr(args, "diff", None) is not None:
+        status = processor.diff_save(filename=args.diff)
+
+    if getattr(args, "memory_report", None) is not None:
+        if hasattr(args, "verbose") and args.verbose:
+            processor.report(topic="memory")
+        status = max(status, processor.memory_save())
+
     if status == 0:
         if processor.file_num > 1:
             logging.info(
@@ -79,9 +140,9 @@ def main(args=None):
     return status
 
 
-def arguments():
-    """Parses @param arg command line arguments into raw @return args
-    Namespace."""
+def arguments(argv=None):
+    """Parses @param argv list of command line arguments (None = sys.argv)
+    into raw @return args Namespace."""
 
     parser = argparse.ArgumentParser(
         description="Converts ATCO.CIF files into GTFS format.",
@@ -97,10 +158,11 @@ def arguments():
     )
     parser.add_argument(
         "source",
-        nargs="+",
-        help="""One or more ATCO.CIF data sources: directory, cif, url, zip
-        (mixed sources, or sources containing a mixture, are fine).
-        Required.""",
+        nargs="*",
+        help="""One or more ATCO.CIF data sources: directory, cif, url, zip,
+        any file optionally gzip, bzip2 or xz compressed (mixed sources, or
+        sources containing a mixture, are fine).
+        Required, except with --feeds or --serve.""",
     )
     parser.add_argument(
         "-b",
@@ -111,6 +173,32 @@ def arguments():
         yyyymmdd bank (public) holidays, one per line. Optional, defaults to
         treating all days as non-holiday.""",
     )
+    parser.add_argument(
+        "-c",
+        "--compact_calendar",
+        dest="compact_calendar",
+        action="store_true",
+        help="""Merge services that run on identical dates and re-encode
+        each with the fewest calendar_dates, before writing the GTFS.
+        Optional, defaults to calendars as accumulated file by file.""",
+    )
+    parser.add_argument(
+        "--columnar",
+        nargs="?",
+        dest="columnar",
+        help="""Also export each GTFS table, typed (integer seconds times,
+        dates, integer IDs), into this directory for analytics tools.
+        Requires pyarrow. Optional, defaults to no export.""",
+    )
+    parser.add_argument(
+        "--columnar_format",
+        nargs="?",
+        default="parquet",
+        choices=["parquet", "arrow"],
+        dest="columnar_format",
+        help="""Columnar export as Parquet or Arrow IPC files. Optional,
+        defaults to parquet.""",
+    )
     parser.add_argument(
         "-d",
         "--directional_routes",
@@ -120,6 +208,25 @@ def arguments():
         different routes. Optional, defaults to combining inbound and
         outbound into the same route.""",
     )
+    parser.add_argument(
+        "--diff",
+        nargs="?",
+        dest="diff",
+        help="""Filename (directory optional) for a hash manifest of trips,
+        routes and stops. Changes since the manifest written by the previous
+        run are reported (with -v), then the manifest is replaced once the
+        GTFS is written. Optional, defaults to no comparison.""",
+    )
+    parser.add_argument(
+        "--duplicates",
+        nargs="?",
+        choices=["first", "last", "report"],
+        dest="duplicates",
+        help="""Detect journeys identical to an earlier journey (route,
+        direction, calendar and stop times), as where source files overlap,
+        then keep the first copy, keep the last copy, or keep both but report
+        them. Optional, defaults to no detection.""",
+    )
     parser.add_argument(
         "-e",
         "--epsg",
@@ -130,6 +237,31 @@ def arguments():
         Great Britain, 27700. Optional, but GTFS stop lat and lng will be 0
         if argument is omitted.""",
     )
+    parser.add_argument(
+        "--exclude_agency",
+        nargs="+",
+        dest="exclude_agency",
+        help="""Skip journeys by these ATCO-CIF operator codes. Optional,
+        defaults to none skipped.""",
+    )
+    parser.add_argument(
+        "--exclude_route",
+        nargs="+",
+        dest="exclude_route",
+        help="""Skip journeys on these route numbers (or operator_number).
+        Optional, defaults to none skipped.""",
+    )
+    parser.add_argument(
+        "--feeds",
+        nargs="?",
+        dest="feeds",
+        help="""Filename (directory optional) for a JSON manifest of feeds
+        to build instead, {"feeds": [{"args": [command line arguments
+        including sources and -g]}, ...]}. Feeds with the same parsing
+        options share one parse of their sources, then each is written from
+        the trips of its own sources. Optional, defaults to a single
+        conversion.""",
+    )
     parser.add_argument(
         "-f",
         "--final_date",
@@ -155,8 +287,30 @@ def arguments():
         nargs="?",
         default="gtfs.zip",
         dest="gtfs",
-        help="""Output GTFS zip filename (directory optional). Optional,
-        defaults in gtfs.zip.""",
+        help="""Output GTFS zip filename (directory optional), or - for
+        stdout. Optional, defaults in gtfs.zip.""",
+    )
+    parser.add_argument(
+        "--include_agency",
+        nargs="+",
+        dest="include_agency",
+        help="""Only keep journeys by these ATCO-CIF operator codes.
+        Optional, defaults to all operators.""",
+    )
+    parser.add_argument(
+        "--include_direction",
+        nargs="?",
+        choices=["I", "O"],
+        dest="include_direction",
+        help="""Only keep journeys in this direction: I (inbound) or O
+        (outbound). Optional, defaults to both directions.""",
+    )
+    parser.add_argument(
+        "--include_route",
+        nargs="+",
+        dest="include_route",
+        help="""Only keep journeys on these route numbers (or
+        operator_number). Optional, defaults to all routes.""",
     )
     parser.add_argument(
         "-l",
@@ -175,6 +329,70 @@ def arguments():
         type=int,
         help="""GTFS mode integer code. Optional, defaults to 3 (bus).""",
     )
+    parser.add_argument(
+        "--memory_report",
+        nargs="?",
+        dest="memory_report",
+        help="""Filename (directory optional) for a JSON profile of memory
+        use by phase (file, agency, calendar, route, stops, dump): Calls,
+        time, peak and net bytes allocated, process peak resident memory,
+        and the largest allocation sites. Profiling slows conversion.
+        Optional, defaults to no profiling.""",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_format",
+        nargs="?",
+        default="zip",
+        choices=["zip", "directory", "sqlite"],
+        dest="output_format",
+        help="""Output GTFS as a zip file, an uncompressed directory of .txt
+        files, or an indexed GTFS-structured sqlite file. A zip GTFS filename
+        of - writes to stdout. Optional, defaults to zip.""",
+    )
+    parser.add_argument(
+        "--parent_stations",
+        nargs="?",
+        const=50,
+        dest="parent_stations",
+        type=float,
+        help="""Cluster stops within this many metres of each other whose
+        names share a stem (less any stand, bay or similar suffix) into
+        generated parent stations. Needs grid references (-e). Optional,
+        defaults to 50 if given without a value, else no parent
+        stations.""",
+    )
+    parser.add_argument(
+        "-p",
+        "--pattern_store",
+        dest="pattern_store",
+        action="store_true",
+        help="""Hold each trip's stop times as a shared stop pattern plus
+        packed times while processing, only expanding them when writing the
+        GTFS. Shrinks the working database on networks where many trips
+        repeat the same stops. Optional, defaults to full stop_times rows
+        throughout.""",
+    )
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        action="store_true",
+        help="""Read each ATCO-CIF file ahead, and write to the working
+        database, in threads alongside parsing. Helps most where sources are
+        on slow or network storage. Output is unchanged. Optional, defaults to
+        a single thread.""",
+    )
+    parser.add_argument(
+        "--progress",
+        nargs="?",
+        const=10,
+        dest="progress",
+        type=float,
+        help="""Log progress every this many seconds while reading each
+        ATCO-CIF file and writing the GTFS: Bytes read, lines and journeys
+        per second, rows written and estimated time remaining. Optional,
+        defaults to 10 if given without a value, else no progress.""",
+    )
     parser.add_argument(
         "-u",
         "--unique_ids",
@@ -194,6 +412,78 @@ def arguments():
         help="""Verbose feedback of all progress to log or console. Optional,
         defaults to warnings and errors only.""",
     )
+    parser.add_argument(
+        "--scan",
+        dest="scan",
+        action="store_true",
+        help="""Only inventory the sources, in parallel and without
+        converting: Print a JSON summary of each file (valid ATCO-CIF v05 or
+        not, record counts by type, journeys, stops, operators, date range)
+        and of the whole. Optional, defaults to conversion.""",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        dest="serve",
+        metavar="[HOST:]PORT",
+        help="""Run as a conversion service on this port (of localhost, or
+        host), keeping imports, holiday files and pyproj set up between
+        jobs. POST /convert a JSON object {"args": [command line arguments
+        including sources]}, for a JSON response of status, log lines and
+        the base64 GTFS zip. Jobs run concurrently. Optional, defaults to a
+        single conversion.""",
+    )
+    parser.add_argument(
+        "--shard",
+        nargs="+",
+        action="append",
+        dest="shard",
+        metavar=("SHARD_FILENAME", "ROUTE_ID"),
+        help="""Also output a GTFS zip filename containing only the listed
+        route_ids (and the agency, stops and calendars they use). Repeat for
+        more shards. Optional, defaults to a single combined output.""",
+    )
+    parser.add_argument(
+        "--shard_agency",
+        dest="shard_agency",
+        action="store_true",
+        help="""Also output one GTFS zip per agency, named as the output
+        filename plus _agency_id. Optional, defaults to a single combined
+        output.""",
+    )
+    parser.add_argument(
+        "--skip_unchanged",
+        dest="skip_unchanged",
+        action="store_true",
+        help="""With --diff, write no GTFS if nothing has changed since the
+        previous run. Optional, defaults to always writing.""",
+    )
+    parser.add_argument(
+        "--stop_cache_limit",
+        nargs="?",
+        dest="stop_cache_limit",
+        type=int,
+        help="""Maximum number of stop locations held in memory per ATCO-CIF
+        file, beyond which they overflow into the working database. Optional,
+        defaults to no limit.""",
+    )
+    parser.add_argument(
+        "--stop_reference",
+        nargs="?",
+        dest="stop_reference",
+        help="""Filename (directory optional) for an external stop reference,
+        loaded once and used for stop names and coordinates missing from
+        ATCO-CIF: CSV with GTFS stops.txt or NaPTAN (ATCOCode, CommonName,
+        Latitude, Longitude) columns, or a GTFS-structured sqlite file.
+        Optional, defaults to ATCO-CIF data only.""",
+    )
+    parser.add_argument(
+        "--stop_reference_priority",
+        dest="stop_reference_priority",
+        action="store_true",
+        help="""Stop reference names and coordinates replace those in
+        ATCO-CIF. Optional, defaults to only filling in missing data.""",
+    )
     parser.add_argument(
         "-s",
         "--school_term",
@@ -213,16 +503,54 @@ def arguments():
         help="""Timezone in IANA TZ format. Optional, defaults to
         Europe/London.""",
     )
+    parser.add_argument(
+        "--warning_limit",
+        nargs="?",
+        default=10,
+        dest="warning_limit",
+        type=int,
+        help="""Number of malformed line warnings logged per file and
+        category (such as time or date), beyond which they are only counted
+        and summarised. Verbose logs all. Optional, defaults to 10.""",
+    )
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        const=2.0,
+        dest="watch",
+        type=float,
+        metavar="SECONDS",
+        help="""Convert, then keep polling the (local) sources every this
+        many seconds, and once changes settle for as long, parse only the
+        changed files again and rewrite the zip or sqlite GTFS atomically.
+        Runs until interrupted. Optional, defaults to a single conversion,
+        or 2 seconds if given alone.""",
+    )
+    parser.add_argument(
+        "--window_end",
+        nargs="?",
+        dest="window_end",
+        help="""Last yyyymmdd date to keep: Later journeys are skipped and
+        calendars are cut short. Optional, defaults to no limit.""",
+    )
+    parser.add_argument(
+        "--window_start",
+        nargs="?",
+        dest="window_start",
+        help="""First yyyymmdd date to keep: Earlier journeys are skipped and
+        calendars start no earlier. Optional, defaults to no limit.""",
+    )
     # Extendable: Add desc as atcocif var. Add desc to atcocif._arg_vars
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def walk(source, processor):
-    """Walks/downloads/extracts @param source, where source is a directory,
-    file, url, or zip (including mixed sources or sources containing a
-    mixture), and @param processor is an existing atcocif instance, then
-    initates ATCO-CIF processing. @return processor."""
+    """Walks/downloads/streams @param source, where source is a directory,
+    file, url, or zip, any file plain or gzip, bzip2 or xz compressed
+    (including mixed sources or sources containing a mixture), and @param
+    processor is an existing atcocif instance, then initates ATCO-CIF
+    processing. @return processor."""
 
     if os.path.isdir(source):
         for (root, dirs, files) in os.walk(source):
@@ -233,24 +561,453 @@ def walk(source, processor):
                 )
 
     elif os.path.isfile(source):
+        try:
+            with open(source, "rb") as stream:
+                processor = walk_stream(
+                    name=source, stream=stream, processor=processor
+                )
+        except Exception as e:
+            logging.warning("Skipped %s: %s", source, e)
+
+    else:
+
+        try:
+            request = urllib.request.Request(source)
+            request_type = request.type
+
+        except ValueError:
+            request_type = None
+
+        if request_type in ["http", "https"]:
+            logging.info("Acquiring %s", source)  # URL implies delay
 
-        if zipfile.is_zipfile(source):
             try:
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    zip = zipfile.ZipFile(source)
-                    zip.extractall(path=temp_dir)
-                    zip.close()
-                    processor = walk(
-                        source=temp_dir,
-                        processor=processor
+                with urllib.request.urlopen(request) as response:
+                    # nosec - Filtered for non-http/https
+                    if response.peek(4)[:4] != b"PK\x03\x04":
+                        processor = walk_stream(
+                            name=urllib.parse.urlparse(source).path,
+                            stream=response,
+                            processor=processor,
+                        )  # Streamed, decompressed if need be
+                    else:
+                        with tempfile.NamedTemporaryFile(
+                            delete=False
+                        ) as temp_file:
+                            # Zip needs random access, so to temp first
+                            shutil.copyfileobj(response, temp_file)
+                        processor = walk(
+                            source=temp_file.name,
+                            processor=processor
+                        )
+                        os.remove(temp_file.name)
+
+            except Exception as e:
+                logging.warning("Skipped %s: %s", source, e)
+
+        else:
+            logging.warning("Skipped missing/unhandleable source %s", source)
+
+    return processor
+
+
+def feeds(filename="", workers=None):
+    """Builds every feed of JSON manifest @param filename, {"feeds":
+    [{"args": [command line arguments]}, ...]}. Feeds are grouped by
+    feed_options(), and each group is built by feed_group() in one of
+    @param workers processes (None = one per CPU). @return 0 if all feeds
+    were written, 1 not."""
+
+    try:
+        with open(filename, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        groups = collections.OrderedDict()  # feed_options(): [args, ...]
+
+        for feed in manifest["feeds"]:
+            args = arguments(argv=[str(arg) for arg in feed["args"]])
+            if len(args.source) == 0:
+                raise ValueError("Feed {} has no sources".format(args.gtfs))
+            key = feed_options(args=args)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(args)
+
+    except (KeyError, TypeError, ValueError, OSError, SystemExit) as e:
+        # SystemExit as argparse exits on bad arguments
+        logging.error("Failed to read feed manifest %s: %s", filename, e)
+        return 1
+
+    logging.info(
+        "Building %s feed(s) from %s parse(s)...",
+        sum(len(group) for group in groups.values()),
+        len(groups),
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        statuses = list(executor.map(feed_group, groups.values()))
+
+    return max(statuses, default=0)
+
+
+def feed_group(feeds=[]):
+    """Processes the distinct sources of @param feeds (list of args
+    namespaces sharing feed_options()) once, in one atcocif instance,
+    noting each source's trip_id range, then writes each feed's GTFS from
+    the trips of its own sources, in parallel. @return 0 OK or 1 not."""
+
+    processor = atcocif(args=feeds[0])
+    trips = collections.OrderedDict()  # Source: (first, last) trip_id
+
+    for args in feeds:
+        for source in args.source:
+            if source not in trips:
+                first_trip = processor.trip_id + 1
+                processor = walk(source=source, processor=processor)
+                trips[source] = (first_trip, processor.trip_id)
+
+    status = processor.dump(
+        shards={
+            args.gtfs: {
+                "trip_range": [trips[source] for source in args.source]
+            }
+            for args in feeds
+        },
+        combined=False,
+    )
+
+    if status == 0:
+        for args in feeds:
+            logging.info(
+                "Completed %s from %s source(s).", args.gtfs, len(args.source)
+            )
+
+    del processor
+
+    return status
+
+
+def feed_options(args=None):
+    """@return key (JSON string) of the options of @param args namespace
+    that change how sources are processed or written, so feeds with equal
+    keys can share one parse. Other options (shards, columnar and diff are
+    not applied to feeds) are left out. With duplicates first or last, the
+    sources are part of the key, since which copy of a journey is kept
+    depends on the files processed together."""
+
+    unshared = [
+        "columnar", "columnar_format", "diff", "gtfs", "memory_report",
+        "pipeline", "shard", "shard_agency", "skip_unchanged", "verbose",
+    ]
+    options = {
+        key: value for key, value in vars(args).items()
+        if key in atcocif._arg_vars and key not in unshared
+    }
+
+    if options.get("duplicates") in ["first", "last"]:
+        options["source"] = args.source
+
+    return json.dumps(options, sort_keys=True, default=str)
+
+
+def decompress(stream=None):
+    """@return readable binary @param stream, wrapped in a streaming
+    decompressor if its magic bytes show gzip, bzip2 or xz compression
+    (nested compression is unwrapped in turn). Memory use is constant,
+    whatever the size. stream must support peek()."""
+
+    magic = stream.peek(6)[:6]
+
+    if magic.startswith(b"\x1f\x8b"):
+        return decompress(stream=gzip.GzipFile(fileobj=stream, mode="rb"))
+    if magic.startswith(b"BZh"):
+        return decompress(stream=bz2.BZ2File(stream, mode="rb"))
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        return decompress(stream=lzma.LZMAFile(stream, mode="rb"))
+
+    return stream
+
+
+def walk_stream(name="", stream=None, processor=None, size=None):
+    """Sends readable binary @param stream, named @param name, @param size
+    bytes long if known, to @param processor (an existing atcocif
+    instance), without temporary files: Compressed streams are
+    decompressed (see decompress()) and zip archives (if seekable) are
+    walked member by member, otherwise stream is parsed as ATCO-CIF.
+    @return processor."""
+
+    compressed = stream
+    stream = decompress(stream=stream)
+    if stream is not compressed:
+        size = None  # Decompressed size unknown
+
+    if stream.peek(4)[:4] == b"PK\x03\x04" and stream.seekable():
+        with zipfile.ZipFile(stream) as zip:
+            for info in zip.infolist():
+                if not info.is_dir():
+                    with zip.open(info) as member:
+                        processor = walk_stream(
+                            name=os.path.join(name, info.filename),
+                            stream=member,
+                            processor=processor,
+                            size=info.file_size,
+                        )
+
+    else:
+        status = processor.file(filename=name, stream=stream, size=size)
+        if status == 0:
+            logging.info("Processed %s", os.path.basename(name))
+
+    return processor
+
+
+def scan(sources=[], workers=None, chunk_size=1 << 26):
+    """Inventories @param sources (as walk(), but zip members are read in
+    place) without any database, using @param workers processes (None =
+    one per CPU). Valid plain files beyond @param chunk_size bytes are
+    split into byte ranges, so one large file also spreads across workers.
+    @return summary dict of each file and of the whole."""
+
+    start_time = time.time()
+    files = collections.OrderedDict()  # Source: merged result
+    total = dict(files=0, valid=0, **scan_merge())
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tasks = []
+        for source in sources:
+            for path, members in scan_tasks(
+                source=source, temp_dir=temp_dir
+            ):
+                size = os.path.getsize(path)
+                if len(members) == 0 and size > chunk_size:
+                    with open(path, "rb") as cif_file:
+                        header = cif_file.readline().decode("latin-1")
+                    if atcocif.header_status(line=header) is None:
+                        for start in range(0, size, chunk_size):
+                            tasks.append((
+                                path, members, start, start + chunk_size
+                            ))
+                        continue
+                tasks.append((path, members, 0, None))
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            for result in executor.map(
+                scan_file,
+                [path for path, members, start, end in tasks],
+                [members for path, members, start, end in tasks],
+                [start for path, members, start, end in tasks],
+                [end for path, members, start, end in tasks],
+            ):
+                if result["source"] in files:
+                    scan_merge(total=files[result["source"]], result=result)
+                else:
+                    files[result["source"]] = result
+
+    for result in files.values():
+        total["files"] += 1
+        if result["status"] is None:
+            total["valid"] += 1
+        scan_merge(total=total, result=result)
+        for key in ["stops", "operators"]:
+            result[key] = len(result[key])
+    for key in ["stops", "operators"]:
+        total[key] = len(total[key])
+    total["seconds"] = round(time.time() - start_time, 3)
+
+    return {"files": list(files.values()), "total": total}
+
+
+def scan_file(path="", members=(), start=0, end=None):
+    """Reads ATCO-CIF @param path (or its zip @param members, nested zip
+    names in order) as a byte stream, counting without processing. If
+    @param end, only lines starting from @param start up to end. @return
+    dict summary: source, status (None if valid, else header reason),
+    bytes, lines, records (ID: count), journeys, stops and operators (sets
+    of IDs), first_date, last_date, open_ended (journeys lacking a last
+    date). Only ASCII fields are decoded, so any encoding is fine."""
+
+    result = dict(
+        source=os.path.join(path, *members), status=None, **scan_merge()
+    )
+    records = {}
+    stops = set()
+    operators = set()
+    first_dates = set()
+    last_dates = set()
+
+    try:
+        with contextlib.ExitStack() as stack:
+            stream = stack.enter_context(open(path, "rb"))
+            for member in members:
+                stream = stack.enter_context(
+                    zipfile.ZipFile(stream).open(member)
+                )
+            stream = stack.enter_context(decompress(stream=stream))
+
+            if start == 0:
+                line = stream.readline()
+                result["lines"] += 1
+                result["status"] = atcocif.header_status(
+                    line=line.decode("latin-1")
+                )
+            else:
+                stream.seek(start - 1)
+                stream.readline()  # Partial line, in the previous range
+
+            if end is None:
+                lines = stream
+            elif stream.tell() < end:
+                block = stream.read(end - stream.tell())
+                if not block.endswith(b"\n"):
+                    block += stream.readline()  # Completes the last line
+                lines = block.splitlines()
+            else:
+                lines = []  # Range within a single line
+
+            if result["status"] is None:
+                journeys = 0
+                open_ended = 0
+                count = 0
+
+                for line in lines:  # Locals only: Loop is the whole cost
+                    count += 1
+                    id = line[:2]
+                    if id in records:
+                        records[id] += 1
+                    else:
+                        records[id] = 1
+
+                    if id == b"QS":
+                        if line[2:3] != b"D" and len(line) >= 29:
+                            journeys += 1
+                            operators.add(line[3:7])
+                            first_dates.add(line[13:21])
+                            last_dates.add(line[21:29])
+                            if line[21:29] == b"99999999":
+                                open_ended += 1
+                    elif id == b"QI" or id == b"QO" or id == b"QT":
+                        stops.add(line[2:14])
+                    elif id == b"QR":
+                        journeys += 1
+                    elif id == b"QL" or id == b"QB":
+                        stops.add(line[3:15])
+
+                result["lines"] += count
+                result["journeys"] = journeys
+                result["open_ended"] = open_ended
+
+            if end is None:
+                result["bytes"] = stream.tell() - start
+            else:
+                result["bytes"] = min(end, os.path.getsize(path)) - start
+
+    except Exception as e:
+        result["status"] = str(e)
+
+    result["records"] = {
+        id.decode("latin-1").strip(): count
+        for id, count in records.items()
+        if id.strip() != b""
+    }
+    result["stops"] = {stop.decode("latin-1").strip() for stop in stops}
+    result["operators"] = {
+        operator.decode("latin-1").strip() for operator in operators
+    }
+    for key, dates, pick in [
+        ("first_date", first_dates, min),
+        ("last_date", last_dates, max),
+    ]:
+        dates = [
+            date.decode("latin-1") for date in dates
+            if date.isdigit() and date != b"99999999"
+        ]
+        if len(dates) > 0:
+            result[key] = pick(dates)
+
+    return result
+
+
+def scan_merge(total=None, result=None):
+    """Adds scan_file() @param result into @param total (both summary
+    dicts, with stops and operators as sets). @return total, or without
+    arguments, a new empty total."""
+
+    if total is None:
+        total = {
+            "bytes": 0,
+            "lines": 0,
+            "records": {},
+            "journeys": 0,
+            "stops": set(),
+            "operators": set(),
+            "first_date": None,
+            "last_date": None,
+            "open_ended": 0,
+        }
+
+    if result is not None:
+        for key in ["bytes", "lines", "journeys", "open_ended"]:
+            total[key] += result[key]
+        for id, count in result["records"].items():
+            total["records"][id] = total["records"].get(id, 0) + count
+        for key in ["stops", "operators"]:
+            total[key] |= result[key]
+        for key, pick in [("first_date", min), ("last_date", max)]:
+            if result[key] is not None:
+                total[key] = pick(
+                    date for date in [total[key], result[key]]
+                    if date is not None
+                )
+
+    return total
+
+
+def scan_tasks(source="", temp_dir=""):
+    """Lists the files of @param source, as walk(), for scan_file(). Urls
+    are downloaded into @param temp_dir. @return list of (path, members),
+    where members are the names of nested zip members leading to a file."""
+
+    tasks = []
+
+    def members(zip, parents=()):
+        """@return tasks for the files in @param zip, within @param parents
+        (names of the zip members containing zip)."""
+
+        zip_tasks = []
+        for info in zip.infolist():
+            if info.is_dir():
+                continue
+            names = parents + (info.filename,)
+            with zip.open(info) as member:
+                if zipfile.is_zipfile(member):
+                    zip_tasks += members(
+                        zip=zipfile.ZipFile(member), parents=names
                     )
+                else:
+                    zip_tasks.append((source, names))
+        return zip_tasks
+
+    if os.path.isdir(source):
+        for (root, dirs, files) in os.walk(source):
+            for file in files:
+                tasks += scan_tasks(
+                    source=os.path.join(root, file), temp_dir=temp_dir
+                )
+
+    elif os.path.isfile(source):
+
+        if zipfile.is_zipfile(source):
+            try:
+                with zipfile.ZipFile(source) as zip:
+                    tasks += members(zip=zip)
             except Exception as e:
                 logging.warning("Skipped %s: %s", source, e)
 
         else:
-            status = processor.file(filename=source)
-            if status == 0:
-                logging.info("Processed %s", os.path.basename(source))
+            tasks.append((source, ()))
 
     else:
 
@@ -262,20 +1019,14 @@ def walk(source, processor):
             request_type = None
 
         if request_type in ["http", "https"]:
-            logging.info("Acquiring %s", source)  # URL implies delay
-
             try:
                 with urllib.request.urlopen(request) as response:
                     # nosec - Filtered for non-http/https
                     with tempfile.NamedTemporaryFile(
-                        delete=False
+                        dir=temp_dir, delete=False
                     ) as temp_file:
-                        # To temp, could be excessive for memory
                         shutil.copyfileobj(response, temp_file)
-                        processor = walk(
-                            source=temp_file.name,
-                            processor=processor
-                        )
+                tasks += scan_tasks(source=temp_file.name, temp_dir=temp_dir)
 
             except Exception as e:
                 logging.warning("Skipped %s: %s", source, e)
@@ -283,4 +1034,341 @@ def walk(source, processor):
         else:
             logging.warning("Skipped missing/unhandleable source %s", source)
 
-    return processor
+    return tasks
+
+
+def convert(args=None):
+    """Runs run() for @param args namespace into a temporary GTFS zip,
+    capturing the log lines of this job alone, including those of any
+    threads it starts (at the job's verbosity, via log_share), for loader
+    serve. Options that write elsewhere on the server, or that do not
+    convert, raise ValueError. @return dict of status, log (list of lines)
+    and gtfs (base64 zip, or None if not written)."""
+
+    rejected = [
+        "--{}".format(option) for option in [
+            "columnar", "diff", "feeds", "memory_report", "serve", "shard",
+            "watch",
+        ] if getattr(args, option, None) is not None
+    ]
+    if len(rejected) > 0:
+        raise ValueError(
+            "Not available to serve jobs: {}".format(", ".join(rejected))
+        )
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    if getattr(args, "verbose", False):
+        handler.setLevel(logging.DEBUG)
+    else:
+        handler.setLevel(logging.WARNING)
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    job = object()
+    token = log_share.job.set(job)  # Copied into threads atcocif starts
+    handler.addFilter(lambda record: log_share.job.get() is job)
+
+    log_share.add(handler=handler)
+    gtfs = None
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            args.gtfs = os.path.join(temp_dir, "gtfs.zip")
+            args.log = None
+            args.output_format = "zip"
+            args.scan = False
+            status = run(args=args)
+
+            if status == 0 and os.path.exists(args.gtfs):
+                with open(args.gtfs, "rb") as gtfs_file:
+                    gtfs = base64.b64encode(gtfs_file.read()).decode("ascii")
+
+    finally:
+        log_share.remove(handler=handler)
+        log_share.job.reset(token)
+
+    return {
+        "status": status,
+        "log": stream.getvalue().splitlines(),
+        "gtfs": gtfs,
+    }
+
+
+class log_share:
+    """Shares the root logger between concurrent convert() jobs: While any
+    job runs, the root level is lowered to the most verbose job's handler,
+    and the other handlers are held at the root's prior level, so their
+    output is unchanged. The prior levels are restored once the last job
+    ends, so no job's levels outlive it. Each job's records are told apart
+    by context variable job, not by thread, since a job may start threads."""
+
+    job = contextvars.ContextVar("job", default=None)  # Logging job
+    lock = threading.Lock()
+    levels = []  # Handler levels of running jobs
+    saved = None  # [root level, {handler: level}] from before first job
+
+    @classmethod
+    def add(cls, handler=None):
+        """Adds @param handler (logging.Handler) to the root logger."""
+
+        root = logging.getLogger()
+        with cls.lock:
+            if len(cls.levels) == 0:
+                cls.saved = [
+                    root.level,
+                    {other: other.level for other in root.handlers},
+                ]
+            cls.levels.append(handler.level)
+            cls.apply(root=root)
+            root.addHandler(handler)
+
+    @classmethod
+    def remove(cls, handler=None):
+        """Removes @param handler (logging.Handler) from the root logger."""
+
+        root = logging.getLogger()
+        with cls.lock:
+            root.removeHandler(handler)
+            cls.levels.remove(handler.level)
+            if len(cls.levels) > 0:
+                cls.apply(root=root)
+            else:
+                root.setLevel(cls.saved[0])
+                for other, level in cls.saved[1].items():
+                    other.setLevel(level)
+                cls.saved = None
+
+    @classmethod
+    def apply(cls, root=None):
+        """Sets levels of @param root logger for the running jobs (locked)."""
+
+        prior = cls.saved[0]
+        level = min([prior] + cls.levels)
+        for other, other_level in cls.saved[1].items():
+            if other_level == logging.NOTSET:
+                other.setLevel(prior if level < prior else logging.NOTSET)
+        root.setLevel(level)
+
+
+def serve(address="8080"):
+    """Serves conversions on @param address ([host:]port, host defaulting
+    to localhost) until interrupted, each job in its own thread and atcocif
+    instance, via service_handler. @return 0 once stopped."""
+
+    host, _, port = address.rpartition(":")
+    server = http.server.ThreadingHTTPServer(
+        (host or "localhost", int(port)), service_handler
+    )
+
+    logging.warning(
+        "Serving conversions on http://%s:%s/convert",
+        *server.server_address[:2]
+    )
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+class service_handler(http.server.BaseHTTPRequestHandler):
+    """Handles loader serve requests: POST /convert a JSON object {"args":
+    [command line arguments]}. Responds with convert() as JSON, or an error
+    status for bad requests."""
+
+    def do_POST(self):
+        """Handles a conversion job."""
+
+        if self.path != "/convert":
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(job["args"], list):
+                raise TypeError("args")
+            args = arguments(argv=[str(arg) for arg in job["args"]])
+        except (KeyError, TypeError, ValueError, SystemExit):
+            # SystemExit as argparse exits on bad arguments
+            self.send_error(400, "Expected JSON {\"args\": [arguments]}")
+            return
+
+        try:
+            body = json.dumps(convert(args=args)).encode("utf-8")
+        except ValueError as e:  # Options refused to serve jobs
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            logging.getLogger(__name__).exception("Failed job: %s", e)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Logs requests at info level, rather than to stderr."""
+
+        logging.info("%s %s", self.address_string(), format % args)
+
+
+class watcher:
+    """Watch mode (loader --watch): Converts the sources of @param args into
+    args.gtfs, then converts again whenever their files change, polling
+    (so no OS-specific notifications), into a persistent atcocif instance.
+    Changed and removed files are forgotten (see atcocif.forget()), changed
+    and added files are processed again, and the GTFS is rewritten
+    atomically. Bursts of changes are debounced: Rebuilds wait until no
+    file has changed for @param settle seconds. IDs are not stable across
+    rebuilds: Files processed again get new trip and service IDs (and with
+    unique_ids, new file suffixes), so differ from a full conversion."""
+
+    def __init__(self, args=None, settle=2.0):
+        """Initialise with @param args Namespace and @param settle."""
+
+        self.args = args
+        self.settle = settle
+        self.processor = atcocif(args=args)
+        self.built = {}  # Snapshot, as files(), last converted
+        self.changed_at = None  # time() of the latest change seen
+        self.latest = None  # Snapshot at the latest poll
+        self.trips = {}  # Path: (first trip_id, last trip_id) processed
+        self.exclude = [
+            os.path.abspath(filename)
+            for filename in [args.gtfs, args.gtfs + ".tmp"]
+        ]  # Output may share a source directory
+
+    def dependents(self, paths=[]):
+        """@return sorted @param paths plus the paths of any file with trips
+        dropped as duplicates of trips from those paths (recursively), which
+        must be processed again to restore them."""
+
+        paths = set(paths)
+        if self.processor.duplicates == "first":
+            kept, dropped = 0, 1  # Index in journey_duplicate pairs
+        else:
+            kept, dropped = 1, 0
+
+        while True:
+            ranges = [self.trips[path] for path in paths if path in self.trips]
+            added = set()
+
+            for pair in self.processor.journey_duplicate:
+                if any(first <= pair[kept] <= last for first, last in ranges):
+                    for path, (first, last) in self.trips.items():
+                        if first <= pair[dropped] <= last:
+                            added.add(path)
+
+            if added <= paths:
+                return sorted(paths)
+            paths |= added
+
+    def files(self):
+        """@return snapshot dict of path: (mtime_ns, size) of every file in
+        the local sources (directories walked, zips whole)."""
+
+        snapshot = {}
+
+        for source in self.args.source:
+            if os.path.isdir(source):
+                paths = [
+                    os.path.join(root, file)
+                    for (root, dirs, files) in os.walk(source)
+                    for file in files
+                ]
+            else:
+                paths = [source]
+
+            for path in paths:
+                if os.path.abspath(path) in self.exclude:
+                    continue
+                try:
+                    stat = os.stat(path)
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass  # Missing, or removed since walked
+
+        return snapshot
+
+    def poll(self):
+        """Takes a snapshot, and converts if it has changed since the last
+        conversion and has settled. @return list of paths changed, added or
+        removed, and so converted (empty if no conversion)."""
+
+        snapshot = self.files()
+        now = time.time()
+
+        if snapshot != self.latest:
+            self.latest = snapshot
+            self.changed_at = now
+
+        if snapshot == self.built or now - self.changed_at < self.settle:
+            return []
+
+        changed = sorted(
+            path for path in set(snapshot) | set(self.built)
+            if snapshot.get(path) != self.built.get(path)
+        )
+
+        if self.processor.duplicates in ["first", "last"]:
+            changed = self.dependents(paths=changed)
+
+        for path in changed:
+            if path in self.trips:
+                self.processor.forget(*self.trips.pop(path))
+
+            if path in snapshot:
+                first_trip = self.processor.trip_id + 1
+                self.processor = walk(source=path, processor=self.processor)
+                self.trips[path] = (first_trip, self.processor.trip_id)
+
+        self.built = snapshot
+        status = self.processor.dump(
+            filename=self.args.gtfs + ".tmp", shards={}
+        )
+
+        if status == 0:
+            os.replace(self.args.gtfs + ".tmp", self.args.gtfs)
+            logging.info(
+                "Updated %s from %s changed file(s).",
+                self.args.gtfs,
+                len(changed),
+            )
+
+        return changed
+
+    def run(self, interval=2.0, cycles=None):
+        """Polls every @param interval seconds, for @param cycles (None =
+        until interrupted). @return 0 once stopped, 1 if unable to start."""
+
+        if len(getattr(self.args, "source", None) or []) == 0:
+            logging.error("No sources to process.")
+            return 1
+
+        if self.args.gtfs == "-" or self.processor.output_format not in [
+            "zip", "sqlite"
+        ]:
+            logging.error("Watch requires a zip or sqlite output file.")
+            return 1
+
+        logging.info("Watching %s...", ", ".join(self.args.source))
+        cycle = 0
+
+        try:
+            while cycles is None or cycle < cycles:
+                if cycle > 0:
+                    time.sleep(interval)
+                self.poll()
+                cycle += 1
+
+        except KeyboardInterrupt:
+            pass
+
+        return 0
@@ -0,0 +1,162 @@
+"""records contains compact record classes for the per-file caches of class
+atcocif. Each record behaves as a small dict keyed by its field names (an
+unset field is a missing key), but holds its values in __slots__, and
+packs numeric values into arrays, so costs far less memory per entity."""
+
+
+import array
+
+
+class record:
+    """Base for compact dict-like records. Subclasses list their field
+    names in _fields and the same names (or their private storage) in
+    __slots__. Fields hold None until set, and None is never a value."""
+
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, **fields):
+        """Initialise with optional @param fields keyword values."""
+
+        for field in self._fields:
+            setattr(self, field, fields.get(field))
+
+    def __contains__(self, field):
+        """@return True if @param field is set."""
+
+        return field in self._fields and getattr(self, field) is not None
+
+    def __eq__(self, other):
+        """@return True if @param other record or dict holds equal values."""
+
+        if isinstance(other, record):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __getitem__(self, field):
+        """@return value of @param field. Raises KeyError if unset."""
+
+        if field not in self:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __repr__(self):
+        """@return representation, as the equivalent dict."""
+
+        return "{}({})".format(type(self).__name__, self.as_dict())
+
+    def __setitem__(self, field, value):
+        """Sets @param field to @param value. Raises KeyError if unknown."""
+
+        if field not in self._fields:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def as_dict(self):
+        """@return dict of set fields: values."""
+
+        return {
+            field: getattr(self, field)
+            for field in self._fields
+            if getattr(self, field) is not None
+        }
+
+    def get(self, field, default=None):
+        """@return value of @param field, or @param default if unset."""
+
+        value = getattr(self, field, None) if field in self._fields else None
+        return default if value is None else value
+
+
+class agency_record(record):
+    """Agency data pending processing: name, phone."""
+
+    __slots__ = ("name", "phone")
+    _fields = __slots__
+
+
+class route_record(record):
+    """Route data pending processing: agency (agency_id), num (route
+    number), inbound and outbound (route descriptions)."""
+
+    __slots__ = ("agency", "num", "inbound", "outbound")
+    _fields = __slots__
+
+
+class stop_record(record):
+    """Stop data pending processing: name, easting, northing. Grid
+    references are held as their original strings, since their count of
+    figures determines their precision."""
+
+    __slots__ = ("name", "easting", "northing")
+    _fields = __slots__
+
+
+class service_record(record):
+    """Service data of one trip, pending processing: calendar (as
+    atcocif.calendar_list()) and calendar_dates (list of [date, action]).
+    Both are packed into integer arrays, with yyyymmdd dates as integers,
+    and each calendar_dates entry as date * 10 + action. Since values are
+    unpacked into new lists, edit by assignment, not in place. Dates that
+    are not 8 digits cannot be packed, so are held as lists."""
+
+    __slots__ = ("_calendar", "_calendar_dates")
+    _fields = ("calendar", "calendar_dates")
+
+    @property
+    def calendar(self):
+        """@return calendar list, or None if unset."""
+
+        if isinstance(self._calendar, array.array):
+            return list(self._calendar[:7]) + [
+                "{:08d}".format(date) for date in self._calendar[7:]
+            ]
+        return self._calendar
+
+    @calendar.setter
+    def calendar(self, calendar):
+        """Sets calendar from @param calendar list (or None)."""
+
+        if calendar is not None and len(calendar) == 9 and all(
+            isinstance(date, str) and len(date) == 8 and date.isdigit()
+            for date in calendar[7:]
+        ):
+            try:
+                self._calendar = array.array(
+                    "l", list(calendar[:7]) + [
+                        int(calendar[7]), int(calendar[8])
+                    ]
+                )
+                return
+            except TypeError:
+                pass  # Non-integer weekday flags
+
+        self._calendar = calendar
+
+    @property
+    def calendar_dates(self):
+        """@return calendar_dates list, or None if unset."""
+
+        if isinstance(self._calendar_dates, array.array):
+            return [
+                ["{:08d}".format(value // 10), value % 10]
+                for value in self._calendar_dates
+            ]
+        return self._calendar_dates
+
+    @calendar_dates.setter
+    def calendar_dates(self, calendar_dates):
+        """Sets calendar_dates from @param calendar_dates list (or None)."""
+
+        if calendar_dates is not None and all(
+            isinstance(date[0], str)
+            and len(date[0]) == 8
+            and date[0].isdigit()
+            and date[1] in (1, 2)
+            for date in calendar_dates
+        ):
+            self._calendar_dates = array.array(
+                "l", [int(date[0]) * 10 + date[1] for date in calendar_dates]
+            )
+        else:
+            self._calendar_dates = calendar_dates
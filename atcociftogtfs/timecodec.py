@@ -0,0 +1,19 @@
+"""timecodec contains lookup tables for the times of class atcocif, built once
+on import: Every ATCO-CIF HHMM and GTFS HH:MM string to its (hour, minute)
+time_tuple, and every time_tuple to its GTFS HH:MM:SS string. Both formats
+are limited to 2-digit hours and minutes, so 10000 entries cover each. Any
+other value is absent, for the caller to handle as malformed."""
+
+
+atco_tuples = {}  # ATCO-CIF HHMM string: (hour, minute)
+gtfs_tuples = {}  # GTFS HH:MM string (HH:MM:SS less seconds): (hour, minute)
+gtfs_strings = {}  # (hour, minute): GTFS HH:MM:SS string
+
+for hour in range(100):
+    for minute in range(100):
+        time_tuple = (hour, minute)
+        atco_tuples["{:02d}{:02d}".format(hour, minute)] = time_tuple
+        gtfs_tuples["{:02d}:{:02d}".format(hour, minute)] = time_tuple
+        gtfs_strings[time_tuple] = "{:02d}:{:02d}:00".format(hour, minute)
+
+del hour, minute, time_tuple
@@ -37,12 +37,14 @@ setuptools.setup(
     },
     classifiers=[
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         ],
     install_requires=[
             "pyproj",
         ],
-    python_requires='>=3.3',  # According to vermin
+    python_requires='>=3.7',  # ThreadingHTTPServer, sqlite3 backup
     include_package_data=True,
 )
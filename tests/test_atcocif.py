@@ -1,6 +1,15 @@
 import datetime
+import importlib.util
+import json
+import os
+import random
+import sqlite3
+import types
 import unittest
 import tempfile
+import threading
+import tracemalloc
+import zipfile
 
 from atcociftogtfs.atcocif import atcocif
 
@@ -62,6 +71,167 @@ class test_atcocif(unittest.TestCase):
                     datetime.datetime(2020, 4, 1, 0, 0),
                 ],
             )
+            self.assertEqual(
+                len(self.processor.dates_from_file(filename=temp_file.name)),
+                4,
+            )  # Warm, from cache
+
+            with open(temp_file.name, "w") as txt_file:
+                txt_file.write("20200402\n")
+
+            self.assertListEqual(
+                self.processor.dates_from_file(filename=temp_file.name),
+                [datetime.datetime(2020, 4, 2, 0, 0)],
+            )  # Changed file replaces cache
+
+    def test_instance_isolation(self):
+        """Test arguments and accumulated data stay with their instance."""
+
+        first = atcocif(args=types.SimpleNamespace(mode=0, unique_ids=True))
+        first.unsupported["QX"] = 1
+        first.warning_count[(1, "date")] = 1
+
+        self.assertEqual(self.processor.mode, 3)
+        self.assertFalse(self.processor.unique_ids)
+        self.assertDictEqual(self.processor.unsupported, {})
+        self.assertDictEqual(self.processor.warning_count, {})
+        self.assertEqual(first.mode, 0)
+
+    def test_memory_profile(self):
+        """Test memory use is recorded by phase and saved as JSON."""
+
+        processor = atcocif(args=types.SimpleNamespace(memory_report=""))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w") as cif_file:
+                cif_file.write("\n".join([
+                    "ATCO-CIF0500Test",
+                    "QPNOP1 Big Bus Company",
+                    "QSNOP1 00000120200101202001121111100  42  "
+                    "101-00BIGBUS  TC=10142I",
+                    "QOSTOP-REF00010615A  T1F1",
+                    "QTSTOP-REF00020655A  T1F0",
+                ]) + "\n")
+            processor.file(filename=source)
+            processor.dump(filename=os.path.join(temp_dir, "gtfs.zip"))
+
+            self.assertListEqual(
+                sorted(processor.memory_phases),
+                ["agency", "calendar", "dump", "file", "route", "stops"],
+            )
+            for phase in processor.memory_phases.values():
+                self.assertEqual(phase["calls"], 1)
+                self.assertGreaterEqual(phase["peak"], 0)
+            self.assertGreaterEqual(
+                processor.memory_phases["file"]["peak"],
+                processor.memory_phases["route"]["peak"],
+            )  # Nested phases count towards file
+            self.assertFalse(tracemalloc.is_tracing())
+
+            report = os.path.join(temp_dir, "memory.json")
+            self.assertEqual(processor.memory_save(filename=report), 0)
+            with open(report, encoding="utf-8") as report_file:
+                self.assertDictEqual(
+                    json.load(report_file), processor.memory_phases
+                )
+
+    def test_memory_profile_shared(self):
+        """Test memory tracing is shared by overlapping instances, and peaks
+        unmeasurable without tracemalloc.reset_peak are None."""
+
+        processors = [
+            atcocif(args=types.SimpleNamespace(memory_report=""))
+            for instance in range(2)
+        ]
+        phases = [
+            processor._memory_phase(phase="file") for processor in processors
+        ]
+        for phase in phases:
+            phase.__enter__()
+        phases[0].__exit__(None, None, None)
+        self.assertTrue(tracemalloc.is_tracing())  # Still used by second
+        phases[1].__exit__(None, None, None)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        reset_peak = getattr(tracemalloc, "reset_peak", None)
+        if reset_peak is not None:
+            del tracemalloc.reset_peak  # As Python 3.7 and 3.8
+        try:
+            with processors[0]._memory_phase(phase="dump"):
+                with processors[0]._memory_phase(phase="stops"):
+                    pass
+        finally:
+            if reset_peak is not None:
+                tracemalloc.reset_peak = reset_peak
+
+        self.assertGreaterEqual(processors[0].memory_phases["dump"]["peak"], 0)
+        self.assertIsNone(processors[0].memory_phases["stops"]["peak"])
+
+    def test_progress(self):
+        """Test progress events while parsing and dumping."""
+
+        events = []
+        processor = atcocif(
+            args=types.SimpleNamespace(progress_callback=events.append)
+        )
+        processor.progress = 0  # Every check
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w") as cif_file:
+                cif_file.write("ATCO-CIF0500Test\n")
+                for journey in range(1500):
+                    cif_file.write(
+                        "QSNOP1 {:06d}20200101202001121111100  42  "
+                        "101-00BIGBUS  TC=10142I\n".format(journey)
+                    )
+                    cif_file.write("QOSTOP-REF00010615A  T1F1\n")
+                    cif_file.write("QTSTOP-REF00020655A  T1F0\n")
+            self.assertEqual(processor.file(filename=source), 0)
+            size = os.path.getsize(source)
+            self.assertEqual(
+                processor.dump(filename=os.path.join(temp_dir, "gtfs.zip")),
+                0,
+            )
+
+        parsing = [event for event in events if event["stage"] == "file"]
+        self.assertEqual(len(parsing), 5)  # 1024 line checks, then done
+        self.assertEqual(parsing[0]["total"], size)
+        self.assertLess(parsing[0]["bytes"], parsing[0]["total"])
+        self.assertIsNotNone(parsing[0]["eta"])
+        self.assertEqual(parsing[-1]["journeys"], 1500)
+        self.assertEqual(parsing[-1]["bytes"], parsing[-1]["total"])
+        self.assertTrue(parsing[-1]["done"])
+
+        dumping = [event for event in events if event["stage"] == "dump"]
+        self.assertEqual(dumping[-1]["source"], "gtfs.zip")
+        self.assertEqual(dumping[-1]["rows"], dumping[-1]["total"])
+        self.assertEqual(dumping[-1]["percent"], 100)
+        self.assertIsNone(processor.progress_state)
+
+    def test_progress_pipeline(self):
+        """Test pipelined progress counts bytes, not decoded characters."""
+
+        events = []
+        processor = atcocif(
+            args=types.SimpleNamespace(
+                pipeline=True, progress_callback=events.append
+            )
+        )
+        processor.progress = 0  # Every check
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w", encoding="utf-8") as cif_file:
+                cif_file.write("ATCO-CIF0500Test\n")
+                for stop in range(2000):
+                    cif_file.write(
+                        "QLNSTOP{:05d}   Caf\u00e9 Stra\u00dfe\n".format(stop)
+                    )  # 2 bytes per accented character
+            self.assertEqual(processor.file(filename=source), 0)
+            size = os.path.getsize(source)
+
+        parsing = [event for event in events if event["stage"] == "file"]
+        self.assertEqual(parsing[-1]["bytes"], size)
+        self.assertTrue(parsing[-1]["done"])
 
     def test_calendar_exception_school_days_only(self):
         """Test School Day Only Service."""
@@ -127,6 +297,82 @@ class test_atcocif(unittest.TestCase):
             [["20200101", 1], ["20200102", 1]],
         )
 
+    def test_warning_limit(self):
+        """Test repeated line problems are counted, not all logged."""
+
+        self.processor.base_filename = "test_warning_limit.cif"
+        self.processor.verbose = False
+        self.processor.warning_limit = 2
+
+        with self.assertLogs(level="ERROR") as logs:
+            for attempt in range(5):
+                self.processor.time_str_to_time_tuple(time_str="12AB")
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(
+            self.processor.warning_count[(self.processor.file_num, "time")],
+            5,
+        )
+
+    def test_warning_limit_files(self):
+        """Test line problems are counted per file, though files share a
+        name."""
+
+        self.processor.verbose = False
+        self.processor.warning_limit = 2
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for directory in ["a", "b"]:
+                os.mkdir(os.path.join(temp_dir, directory))
+                source = os.path.join(temp_dir, directory, "same.cif")
+                with open(source, "w") as cif_file:
+                    cif_file.write("\n".join([
+                        "ATCO-CIF0500Test",
+                        "QSNOP1 00000120200101202001121111100  42  "
+                        "101-00BIGBUS  TC=10142I",
+                        "QOSTOP-REF00010615A  T1F1",
+                        "QISTOP-REF000112AB12ABB  T1F1",  # 4 time problems
+                        "QTSTOP-REF00020655A  T1F0",
+                    ]) + "\n")
+
+                with self.assertLogs(level="WARNING") as logs:
+                    self.assertEqual(self.processor.file(filename=source), 0)
+                self.assertIn(
+                    "WARNING:root:2 further time problem(s) in same.cif not "
+                    "logged.",
+                    logs.output,
+                )  # Not 6, as if one file
+
+        self.assertListEqual(
+            sorted(self.processor.warning_count.items()),
+            [((1, "time"), 4), ((2, "time"), 4)],
+        )
+
+    def test_time_day_offset(self):
+        """Test times past midnight, via lookup and malformed fallback."""
+
+        self.processor.day_offset = 1
+        self.assertTupleEqual(
+            self.processor.time_str_to_time_tuple(time_str="0115"), (25, 15)
+        )
+        self.assertTupleEqual(
+            self.processor.time_str_to_time_tuple(
+                time_str="01:15:00", is_gtfs=True
+            ),
+            (25, 15),
+        )
+        self.processor.day_offset = 5
+        self.assertTupleEqual(
+            self.processor.time_str_to_time_tuple(time_str="0115"), (99, 15)
+        )
+        self.assertTupleEqual(
+            self.processor.time_str_to_time_tuple(time_str=" 115"), (99, 15)
+        )  # Not in lookup, but as before
+        self.processor.day_offset = 0
+        self.assertEqual(
+            self.processor.time_tuple_to_gtfs_str(time_tuple=(123, 5)),
+            "123:05:00",
+        )
+
     def test_line_date_exceptions(self):
         """Test ATCO-CIF QE line."""
 
@@ -134,10 +380,148 @@ class test_atcocif(unittest.TestCase):
 
         self.processor.date_exceptions(line="QE20200101202001021")
         self.assertDictEqual(
-            self.processor.service[self.processor.trip_id],
+            self.processor.service[self.processor.trip_id].as_dict(),
             {"calendar_dates": [["20200101", 1], ["20200102", 1]]},
         )
 
+    def test_calendar_closed_form_equivalence(self):
+        """Test closed-form QE/S calendar trimming against day-by-day
+        expansion of the same journey, for many random journeys."""
+
+        randomiser = random.Random(26)
+        base_dt = datetime.datetime(2020, 1, 1, 0, 0)
+        self.processor.final_date = "20211231"
+        self.processor.bank_holidays = None
+
+        def date_str(days):
+            return (base_dt + datetime.timedelta(days=days)).strftime(
+                "%Y%m%d"
+            )
+
+        for attempt in range(200):
+            self.processor.service = {}
+            start = randomiser.randint(0, 300)
+            end = randomiser.choice([start + randomiser.randint(0, 400), None])
+            weekdays = "".join(randomiser.choice("01") for day in range(7))
+            term = None
+            if randomiser.random() < 0.5:
+                first = randomiser.randint(0, 600)
+                term = [
+                    base_dt + datetime.timedelta(days=day) for day in range(
+                        first, first + randomiser.randint(0, 120)
+                    )
+                ]
+            self.processor.school_term = term
+
+            self.processor.journey(
+                line="{}{}{}{}{}".format(
+                    "QSNOP  42    ",
+                    date_str(start),
+                    "99999999" if end is None else date_str(end),
+                    weekdays,
+                    "S  101 101-42BIGBUS  TC=10142I",
+                )
+            )
+            last = 730 if end is None else end
+            flagged = set(
+                date_str(day) for day in range(start, last + 1)
+                if weekdays[(base_dt + datetime.timedelta(
+                    days=day
+                )).weekday()] == "1"
+            )  # Day-by-day expansion, without holidays or exceptions
+            expected = set(flagged)
+            if term is not None:
+                expected &= set(day.strftime("%Y%m%d") for day in term)
+            added = set()
+
+            for exception in range(randomiser.randint(0, 3)):
+                exception_start = randomiser.randint(start - 30, last + 30)
+                exception_end = randomiser.choice([
+                    exception_start + randomiser.randint(0, 200), None
+                ])
+                action = randomiser.choice("01")
+                self.processor.date_exceptions(
+                    line="QE{}{}{}".format(
+                        date_str(exception_start),
+                        "99999999" if exception_end is None else date_str(
+                            exception_end
+                        ),
+                        action,
+                    )
+                )
+                if exception_end is None:
+                    exception_end = 730
+                period = set(
+                    date_str(day) for day in range(
+                        exception_start, exception_end + 1
+                    ) if weekdays[(base_dt + datetime.timedelta(
+                        days=day
+                    )).weekday()] == "1"
+                )  # Additions may fall outside the journey's period
+                if action == "0":
+                    expected -= period
+                else:
+                    added |= period
+
+            service = self.processor.service[self.processor.trip_id]
+            self.assertSetEqual(
+                self.processor.calendar_active_dates(
+                    calendar=service["calendar"],
+                    calendar_dates=service.get("calendar_dates", []),
+                ),
+                expected | added,
+            )
+
+        self.processor.school_term = None
+
+    def test_calendar_clip_open_ended(self):
+        """Test QE removal to an indefinite end trims the calendar instead of
+        listing every day."""
+
+        self.processor.final_date = "20301231"
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP  42    2020010199999999",
+                "1111111  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.date_exceptions(line="QE20200201999999990")
+        self.assertDictEqual(
+            self.processor.service[self.processor.trip_id].as_dict(),
+            {"calendar": [1, 1, 1, 1, 1, 1, 1, "20200101", "20200131"]},
+        )
+
+    def test_calendar_clip_whole(self):
+        """Test QE removal of the whole calendar collapses it, instead of
+        listing every day, yet later additions still run."""
+
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP  42    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.date_exceptions(line="QE20191201202001310")
+        self.processor.date_exceptions(line="QE20200106202001071")
+        self.assertDictEqual(
+            self.processor.service[self.processor.trip_id].as_dict(),
+            {
+                "calendar": [1, 0, 1, 0, 1, 0, 0, "20200101", "20191231"],
+                "calendar_dates": [["20200106", 1]],
+            },
+        )
+        self.processor.calendar()
+        c = self.processor.db.cursor()
+        c.execute(
+            """SELECT monday, tuesday, wednesday, thursday, friday, saturday,
+            sunday, start_date, end_date FROM calendar"""
+        )
+        self.assertListEqual(
+            c.fetchall(), [(0, 0, 0, 0, 0, 0, 0, "20200101", "20200101")]
+        )
+        c.execute("""SELECT date, exception_type FROM calendar_dates""")
+        self.assertListEqual(c.fetchall(), [("20200106", 1)])
+
     def test_line_journey_trip(self):
         """Test ATCO-CIF QS line trip data."""
 
@@ -167,10 +551,63 @@ class test_atcocif(unittest.TestCase):
             )
         )
         self.assertDictEqual(
-            self.processor.service[self.processor.trip_id],
+            self.processor.service[self.processor.trip_id].as_dict(),
             {"calendar": [1, 0, 1, 0, 1, 0, 0, "20200101", "20200112"]},
         )
 
+    def test_journey_filter(self):
+        """Test ATCO-CIF QS line skipped by include/exclude filters."""
+
+        self.processor.include_agency = ["OP11"]
+        self.processor.window_start = "20200105"
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP1242    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.assertFalse(self.processor.in_trip)
+        self.processor.stop_times(line="QOSTOP-REF00162315A  T1F1")
+        self.assertNotIn("STOP-REF0016", self.processor.stop_used)
+
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP1142    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.assertTrue(self.processor.in_trip)
+        self.assertListEqual(
+            self.processor.service[self.processor.trip_id]["calendar"][7:],
+            ["20200105", "20200112"],
+        )  # Calendar starts no earlier than window
+        self.processor.include_agency = None
+        self.processor.window_start = None
+
+    def test_journey_filter_exceptions(self):
+        """Test ATCO-CIF QE additions are limited to the date window."""
+
+        self.processor.window_start = "20200105"
+        self.processor.window_end = "20200110"
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP1142    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.date_exceptions(line="QE20200102202001031")
+        self.processor.date_exceptions(line="QE20200110202001111")
+        self.processor.date_exceptions(line="QE20200111202001121")
+        self.assertDictEqual(
+            self.processor.service[self.processor.trip_id].as_dict(),
+            {
+                "calendar": [1, 0, 1, 0, 1, 0, 0, "20200105", "20200110"],
+                "calendar_dates": [["20200110", 1]],
+            },
+        )  # Additions outside the window dropped, others clamped
+        self.processor.window_start = None
+        self.processor.window_end = None
+
     def test_journey_note(self):
         """Test ATCO-CIF QN line calendar data."""
 
@@ -206,7 +643,7 @@ class test_atcocif(unittest.TestCase):
         self.processor.epsg = 29903
         self.processor.location(line="QBNSTOP-REF0002333448  373764")
         self.assertDictEqual(
-            self.processor.stop_cache["STOP-REF0002"],
+            self.processor.stop_cache["STOP-REF0002"].as_dict(),
             {"easting": "333448", "northing": "373764"},
         )
 
@@ -222,7 +659,7 @@ class test_atcocif(unittest.TestCase):
             )
         )
         self.assertDictEqual(
-            self.processor.agency_cache["OP2"],
+            self.processor.agency_cache["OP2"].as_dict(),
             {"name": "Operator Two", "phone": "08712002233"},
         )
 
@@ -289,6 +726,126 @@ class test_atcocif(unittest.TestCase):
             ],
         )
 
+    def test_repetition_pattern_store(self):
+        """Test repeated trips share one stop pattern, expanded as full
+        stop_times rows only on request."""
+
+        self.processor.pattern_store = True
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP  42    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.stop_times(line="QOSTOP-REF00082315A  T1F1")
+        self.processor.stop_times(line="QTSTOP-REF00092355A  T1F0")
+        self.processor.repetition(
+            line="QRSTOP-REF0008234543    101-43BIGBUS  "
+        )
+        repeat_id = self.processor.trip_id
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP  42    2020010120200112",
+                "1010100  101 101-44BIGBUS  TC=10142I"
+            )
+        )  # Closes the repeated trip
+
+        c = self.processor.db.cursor()
+        c.execute("""SELECT COUNT(*) FROM stop_times""")
+        self.assertEqual(c.fetchone()[0], 0)
+        c.execute("""SELECT COUNT(DISTINCT pattern_id) FROM temp.trip_times""")
+        self.assertEqual(c.fetchone()[0], 1)
+        self.assertEqual(self.processor.expand_patterns(), 2)
+        self.assertListEqual(
+            [
+                row[1:] for row in self.processor.iter_table(
+                    table="stop_times", order=True
+                ) if row[0] == repeat_id
+            ],
+            [
+                ("23:45:00", "23:45:00", "STOP-REF0008", 1, 0, 1, 1),
+                ("24:25:00", "24:25:00", "STOP-REF0009", 2, 1, 0, 1),
+            ],
+        )
+
+    def test_journey_duplicates(self):
+        """Test identical journeys are detected, then kept per policy."""
+
+        def journeys():
+            trip_ids = []
+            for board, time in [
+                ("42", "2315"), ("43", "2315"), ("44", "2316")
+            ]:
+                self.processor.journey(
+                    line="{}{}{}".format(
+                        "QSNOP  42    2020010120200112",
+                        "1010100  101 101-",
+                        "{}BIGBUS  TC=10142I".format(board),
+                    )
+                )
+                self.processor.stop_times(
+                    line="QOSTOP-REF0031{}A  T1F1".format(time)
+                )
+                self.processor.stop_times(line="QTSTOP-REF00322355A  T1F0")
+                trip_ids.append(self.processor.trip_id)
+            self.processor._end_trip()
+            return trip_ids
+
+        c = self.processor.db.cursor()
+
+        for policy, kept in [("first", [0, 2]), ("last", [1, 2])]:
+            self.processor.duplicates = policy
+            self.processor.journey_duplicate = []
+            trip_ids = journeys()
+            self.assertListEqual(
+                self.processor.journey_duplicate, [(trip_ids[0], trip_ids[1])]
+            )  # Running board differs, but is not part of the journey
+            c.execute(
+                """SELECT DISTINCT trip_id FROM stop_times WHERE trip_id>=?
+                ORDER BY trip_id""",
+                (trip_ids[0],),
+            )
+            self.assertListEqual(
+                c.fetchall(), [(trip_ids[i],) for i in kept]
+            )
+            c.execute("""DELETE FROM temp.trip_fingerprints""")
+
+    def test_journey_duplicates_files(self):
+        """Test a file parsed twice is wholly duplicate, though a journey
+        runs past midnight."""
+
+        processor = atcocif(args=types.SimpleNamespace(duplicates="first"))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w") as cif_file:
+                cif_file.write("\n".join([
+                    "ATCO-CIF0500Test",
+                    "QSNOP1 00000120200101202001121111100  42  "
+                    "101-00BIGBUS  TC=10142I",
+                    "QOSTOP-REF00012345A  T1F1",
+                    "QTSTOP-REF00020015A  T1F0",  # Next day
+                    "QSNOP1 00000220200101202001121111100  42  "
+                    "101-00BIGBUS  TC=10142I",
+                    "QOSTOP-REF00010845A  T1F1",
+                    "QTSTOP-REF00020915A  T1F0",
+                ]) + "\n")
+            self.assertEqual(processor.file(filename=source), 0)
+            self.assertEqual(processor.file(filename=source), 0)
+
+        self.assertListEqual(processor.journey_duplicate, [(1, 3), (2, 4)])
+        c = processor.db.cursor()
+        c.execute(
+            """SELECT trip_id, arrival_time FROM stop_times ORDER BY trip_id,
+            stop_sequence"""
+        )
+        self.assertListEqual(
+            c.fetchall(),
+            [
+                (1, "23:45:00"), (1, "24:15:00"),
+                (2, "08:45:00"), (2, "09:15:00"),
+            ],
+        )
+
     def test_route_description(self):
         """Test ATCO-CIF QD line."""
 
@@ -296,7 +853,7 @@ class test_atcocif(unittest.TestCase):
         self.processor.directional_routes = False
         self.processor.route_description(line="QDNOP3 45A OCity - Town ")
         self.assertDictEqual(
-            self.processor.route_cache["OP3_45A"],
+            self.processor.route_cache["OP3_45A"].as_dict(),
             {"agency": "OP3", "num": "45A", "outbound": "City - Town"},
         )
 
@@ -348,6 +905,25 @@ class test_atcocif(unittest.TestCase):
             c.fetchone()[0], None
         )  # None should be filled by calendar()
 
+    def test_calendar_reuse(self):
+        """Test calendar processing reuses a matching service (including
+        calendar_dates) from an earlier file."""
+
+        for repeat in range(2):
+            self.processor.service = {}  # As each new file
+            self.processor.journey(
+                line="{}{}".format(
+                    "QSNOP5 44    2020010120200112",
+                    "1010100  101 101-42BIGBUS  TC=10142I"
+                )
+            )
+            self.processor.date_exceptions(line="QE20200106202001080")
+            self.processor.calendar()
+
+        c = self.processor.db.cursor()
+        c.execute("""SELECT DISTINCT service_id FROM trips""")
+        self.assertListEqual(c.fetchall(), [(1,)])
+
     def test_calendar(self):
         """Test calendar processing into calendar."""
 
@@ -387,6 +963,41 @@ class test_atcocif(unittest.TestCase):
         )
         self.processor.date_exceptions(line="QE20200101202001030")
 
+        self.processor.calendar()
+        c = self.processor.db.cursor()
+        c.execute(
+            """SELECT service_id FROM trips WHERE trip_id=?""",
+            (self.processor.trip_id,),
+        )
+        service_id = c.fetchone()[0]
+        c.execute(
+            """SELECT monday, tuesday, wednesday, thursday, friday, saturday,
+            sunday, start_date, end_date FROM calendar WHERE service_id=?""",
+            (service_id,),
+        )
+        self.assertListEqual(
+            c.fetchall(), [(1, 0, 1, 0, 1, 0, 0, "20200104", "20200112")]
+        )  # Removal from the start trims the calendar
+        c.execute(
+            """SELECT date, exception_type FROM calendar_dates WHERE
+            service_id=? ORDER BY date ASC""",
+            (service_id,),
+        )
+        self.assertListEqual(c.fetchall(), [])  # Rather than 1/3 January
+
+    def test_calendar_dates_within(self):
+        """Test calendar processing into calendar_dates, for removals within
+        the calendar."""
+
+        self.processor.service = {}  # Clear any prior tests
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP7 46    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.date_exceptions(line="QE20200106202001090")
+
         self.processor.calendar()
         c = self.processor.db.cursor()
         c.execute(
@@ -400,8 +1011,41 @@ class test_atcocif(unittest.TestCase):
             (service_id,),
         )
         self.assertListEqual(
-            c.fetchall(), [("20200101", 2), ("20200103", 2)]
-        )  # Never operates thursday, so no 2 January 2020 removal
+            c.fetchall(), [("20200106", 2), ("20200108", 2)]
+        )  # Never operates tuesday/thursday, so no 7/9 January removal
+
+    def test_compact(self):
+        """Test calendar compaction merges equivalent services."""
+
+        self.processor.service = {}  # Clear any prior tests
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP5 42    2020010620200112",
+                "1111100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.date_exceptions(line="QE20200107202001080")
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP5 43    2020010620200112",
+                "1001100  101 101-43BIGBUS  TC=10143I"
+            )
+        )  # Same days (Monday, Thursday, Friday), expressed differently
+        self.processor.calendar()
+
+        self.processor.compact()
+        c = self.processor.db.cursor()
+        c.execute("""SELECT DISTINCT service_id FROM trips""")
+        self.assertListEqual(c.fetchall(), [(1,)])
+        c.execute(
+            """SELECT monday, tuesday, wednesday, thursday, friday, saturday,
+            sunday, start_date, end_date FROM calendar"""
+        )
+        self.assertListEqual(
+            c.fetchall(), [(1, 0, 0, 1, 1, 0, 0, "20200106", "20200110")]
+        )
+        c.execute("""SELECT COUNT(*) FROM calendar_dates""")
+        self.assertEqual(c.fetchone()[0], 0)
 
     def test_route(self):
         """Test route processing."""
@@ -451,6 +1095,71 @@ class test_atcocif(unittest.TestCase):
         )
         self.assertListEqual(c.fetchall(), [("Bus Stop",)])
 
+    def test_stops_spilled(self):
+        """Test stops processing beyond the stop_cache memory limit."""
+
+        self.processor.unique_ids = False
+        self.processor.stop_cache_limit = 1
+        self.processor.stop_cache = {}  # Clear any prior tests
+        self.processor.location(line="QLNSTOP-REF0012Spilled Stop")
+        self.processor.location(line="QLNSTOP-REF0013Unused Stop")
+        self.processor.location(line="QLNSTOP-REF0014Another Stop")
+        self.assertLessEqual(len(self.processor.stop_cache), 1)
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP9 42    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.stop_times(line="QOSTOP-REF00122315A  T1F1")
+        self.processor.stop_times(line="QTSTOP-REF00142325A  T1F0")
+
+        self.processor.stops()
+        c = self.processor.db.cursor()
+        c.execute(
+            """SELECT stop_id, stop_name FROM stops WHERE stop_id IN
+            (?,?,?) ORDER BY stop_id""",
+            ("STOP-REF0012", "STOP-REF0013", "STOP-REF0014"),
+        )
+        self.assertListEqual(
+            c.fetchall(),
+            [
+                ("STOP-REF0012", "Spilled Stop"),
+                ("STOP-REF0014", "Another Stop"),
+            ],
+        )
+
+    def test_stops_reference(self):
+        """Test stops processing with an external stop reference."""
+
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            with open(temp_file.name, "w") as csv_file:
+                csv_file.write(
+                    "ATCOCode,CommonName,Easting,Northing,Longitude,Latitude\n"
+                    "STOP-REF0015,Reference Stop,0,0,-5.9,54.6\n"
+                )
+            self.processor.reference_from_file(filename=temp_file.name)
+        self.processor.stop_reference = temp_file.name
+
+        self.processor.unique_ids = False
+        self.processor.stop_cache = {}  # Clear any prior tests
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP9 42    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )  # No QL/QB records, so stop unknown to ATCO-CIF
+        self.processor.stop_times(line="QOSTOP-REF00152315A  T1F1")
+
+        self.processor.stops()
+        c = self.processor.db.cursor()
+        c.execute(
+            """SELECT stop_name, stop_lat, stop_lon FROM stops WHERE
+            stop_id=?""",
+            ("STOP-REF0015",),
+        )
+        self.assertListEqual(c.fetchall(), [("Reference Stop", 54.6, -5.9)])
+
     def test_stops_coordinates(self):
         """Test stops processing (with coordinates)."""
 
@@ -474,6 +1183,641 @@ class test_atcocif(unittest.TestCase):
         )
         self.assertListEqual(c.fetchall(), [(54.59449625, -5.93612739)])
 
+    def test_cluster_stops(self):
+        """Test stops clustering into parent stations by distance and name
+        stem, against pairwise comparison of many random stops."""
+
+        c = self.processor.db.cursor()
+        self.processor.verbose = False
+        self.processor.parent_stations = 50
+
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.processor.cluster_stops(), 0)  # No grid
+
+        stops = [
+            ("A", "Bus Station Stand A", 100000, 200000),
+            ("B", "Bus Station Stand B", 100030, 200000),
+            ("C", "Bus Station Stand C", 100060, 200000),  # Via B
+            ("D", "Main Street", 100010, 200010),
+            ("E", "Bus Station Stand E", 105000, 200000),
+            ("F", "Bus Station (Bay 2)", 100000, 200045),
+        ]
+        c.executemany(
+            """INSERT INTO stops (stop_id, stop_name, stop_lat, stop_lon)
+            VALUES (?,?,?,?)""",
+            [(id, name, northing / 1e4, easting / 1e4) for (
+                id, name, easting, northing
+            ) in stops],
+        )
+        c.execute(
+            """CREATE TEMP TABLE stop_grid (stop_id TEXT PRIMARY KEY,
+            easting REAL, northing REAL)"""
+        )
+        c.executemany(
+            """INSERT INTO temp.stop_grid VALUES (?,?,?)""",
+            [(id, easting, northing) for (id, _, easting, northing) in stops],
+        )
+        c.execute("""INSERT INTO trips (trip_id) VALUES (?)""", (1,))
+        c.execute(
+            """INSERT INTO stop_times (trip_id, stop_id) VALUES (?,?)""",
+            (1, "B"),
+        )
+
+        for attempt in range(2):  # Rerun replaces
+            self.assertEqual(self.processor.cluster_stops(), 1)
+            c.execute(
+                """SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops
+                WHERE location_type=1"""
+            )
+            self.assertListEqual(
+                c.fetchall(),
+                [("station_A", "Bus Station", 20.001125, 10.00225)],
+            )
+            c.execute(
+                """SELECT stop_id FROM stops WHERE parent_station=? ORDER BY
+                stop_id""",
+                ("station_A",),
+            )
+            self.assertListEqual(
+                c.fetchall(), [("A",), ("B",), ("C",), ("F",)]
+            )
+
+        self.assertListEqual(
+            [
+                row[0] for row in self.processor.iter_table(
+                    table="stops", shard={"trip_range": [[1, 1]]}
+                )
+            ],
+            ["B", "station_A"],
+        )  # Shards keep parents
+
+        randomiser = random.Random(50)
+        c.execute("""DELETE FROM stops""")
+        c.execute("""DELETE FROM temp.stop_grid""")
+        stops = [
+            (
+                "{:04d}".format(index),
+                randomiser.choice(["North", "South"]),
+                randomiser.uniform(0, 2000),
+                randomiser.uniform(0, 2000),
+            )
+            for index in range(400)
+        ]
+        c.executemany(
+            """INSERT INTO stops (stop_id, stop_name, stop_lat, stop_lon)
+            VALUES (?,?,?,?)""",
+            [(id, name, 0, 0) for (id, name, _, _) in stops],
+        )
+        c.executemany(
+            """INSERT INTO temp.stop_grid VALUES (?,?,?)""",
+            [(id, easting, northing) for (id, _, easting, northing) in stops],
+        )
+        self.processor.cluster_stops()
+
+        groups = {id: {id} for (id, _, _, _) in stops}
+        for first in stops:
+            for second in stops:
+                if first[1] == second[1] and (
+                    (first[2] - second[2]) ** 2
+                    + (first[3] - second[3]) ** 2
+                ) <= 50 ** 2 and groups[first[0]] is not groups[second[0]]:
+                    merged = groups[first[0]] | groups[second[0]]
+                    for id in merged:
+                        groups[id] = merged
+        c.execute("""SELECT stop_id, parent_station FROM stops""")
+        for id, parent_station in c.fetchall():
+            if id.startswith("station_"):
+                continue
+            if len(groups[id]) > 1:
+                self.assertEqual(
+                    parent_station, "station_{}".format(min(groups[id]))
+                )
+            else:
+                self.assertIsNone(parent_station)
+
+    def test_dump_shards(self):
+        """Test dump of referentially closed shards."""
+
+        self.processor.unique_ids = False
+        self.processor.directional_routes = False
+        self.processor.stop_used = []
+        self.processor.agency_used = []
+        self.processor.route_used = []
+        self.processor.service = {}  # Clear any prior tests
+        for operator, stop in [
+            ("OP13", "STOP-REF0017"), ("OP14", "STOP-REF0018")
+        ]:
+            self.processor.journey(
+                line="{}{}{}{}".format(
+                    "QSN", operator, "42    2020010120200112",
+                    "1010100  101 101-42BIGBUS  TC=10142I"
+                )
+            )
+            self.processor.stop_times(line="QO{}2315A  T1F1".format(stop))
+        self.processor.agency()
+        self.processor.calendar()
+        self.processor.route()
+        self.processor.stops()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            combined = os.path.join(temp_dir, "gtfs.zip")
+            shard = os.path.join(temp_dir, "op14.zip")
+            self.assertEqual(
+                self.processor.dump(
+                    filename=combined,
+                    shards={shard: {"agency_id": ["OP14"]}},
+                ),
+                0,
+            )
+            with zipfile.ZipFile(shard) as zip:
+                self.assertEqual(
+                    zip.read("stops.txt").decode("utf-8").splitlines(),
+                    [
+                        "stop_id,stop_name,stop_lat,stop_lon,location_type,"
+                        "parent_station",
+                        "STOP-REF0018,Unknown,0,0,,",
+                    ],
+                )
+                self.assertEqual(
+                    len(zip.read("trips.txt").decode("utf-8").splitlines()),
+                    2,
+                )  # Header and 1 trip
+            with zipfile.ZipFile(combined) as zip:
+                self.assertEqual(
+                    len(zip.read("stops.txt").decode("utf-8").splitlines()),
+                    3,
+                )
+
+    def test_dump_shards_threads(self):
+        """Test parallel shard dumps use the working database from the
+        calling thread alone."""
+
+        class recorder:
+            def __init__(self, db, threads):
+                self.db = db
+                self.threads = threads
+
+            def __getattr__(self, name):
+                self.threads.add(threading.get_ident())
+                return getattr(self.db, name)
+
+        self.processor.unique_ids = False
+        self.processor.directional_routes = False
+        self.processor.service = {}  # Clear any prior tests
+        for operator in ["OP13", "OP14"]:
+            self.processor.journey(
+                line="{}{}{}{}".format(
+                    "QSN", operator, "42    2020010120200112",
+                    "1010100  101 101-42BIGBUS  TC=10142I"
+                )
+            )
+            self.processor.stop_times(line="QOSTOP-REF00172315A  T1F1")
+        self.processor.agency()
+        self.processor.calendar()
+        self.processor.route()
+        self.processor.stops()
+        db = self.processor.db
+
+        for output_format in ["zip", "sqlite"]:
+            with self.subTest(output_format=output_format):
+                threads = set()
+                self.processor.db = recorder(db, threads)
+                self.processor.output_format = output_format
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    shards = {
+                        os.path.join(temp_dir, operator): {
+                            "agency_id": [operator]
+                        } for operator in ["OP13", "OP14"]
+                    }
+                    self.assertEqual(
+                        self.processor.dump(
+                            filename=os.path.join(temp_dir, "gtfs"),
+                            shards=shards,
+                        ),
+                        0,
+                    )
+                    self.assertEqual(len(os.listdir(temp_dir)), 3)
+                self.assertSetEqual(threads, {threading.get_ident()})
+
+        self.processor.db = db
+        self.processor.output_format = "zip"
+
+    def test_dump_shards_sqlite(self):
+        """Test sqlite shards keep only the stops their trips use, and
+        those stops' parents."""
+
+        self.processor.unique_ids = False
+        self.processor.directional_routes = False
+        self.processor.stop_used = []
+        self.processor.agency_used = []
+        self.processor.route_used = []
+        self.processor.service = {}  # Clear any prior tests
+        for operator, stop in [
+            ("OP13", "STOP-REF0017"),
+            ("OP14", "STOP-REF0018"),
+            ("OP15", "STOP-REF0019"),
+        ]:
+            self.processor.journey(
+                line="{}{}{}{}".format(
+                    "QSN", operator, "42    2020010120200112",
+                    "1010100  101 101-42BIGBUS  TC=10142I"
+                )
+            )
+            self.processor.stop_times(line="QO{}2315A  T1F1".format(stop))
+        self.processor.agency()
+        self.processor.calendar()
+        self.processor.route()
+        self.processor.stops()
+        c = self.processor.db.cursor()
+        c.execute(
+            """INSERT INTO stops (stop_id, stop_name, stop_lat, stop_lon,
+            location_type) VALUES (?,?,?,?,?)""",
+            ("station_STOP-REF0018", "Station", 0, 0, 1),
+        )
+        c.execute(
+            """UPDATE stops SET parent_station=? WHERE stop_id=?""",
+            ("station_STOP-REF0018", "STOP-REF0018"),
+        )
+        self.processor.output_format = "sqlite"
+
+        for operator, stops in [
+            ("OP13", [("STOP-REF0017",)]),  # No parent
+            ("OP14", [("STOP-REF0018",), ("station_STOP-REF0018",)]),
+        ]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                shard = os.path.join(temp_dir, "shard.sqlite")
+                self.assertEqual(
+                    self.processor.dump(
+                        shards={shard: {"agency_id": [operator]}},
+                        combined=False,
+                    ),
+                    0,
+                )
+                output = sqlite3.connect(shard)
+                c = output.cursor()
+                c.execute("""SELECT stop_id FROM stops ORDER BY stop_id""")
+                self.assertListEqual(c.fetchall(), stops)
+                c.execute(
+                    """SELECT COUNT(*) FROM stops WHERE stop_id NOT IN (SELECT
+                    stop_id FROM stop_times) AND stop_id NOT IN (SELECT
+                    parent_station FROM stops WHERE stop_id IN (SELECT
+                    stop_id FROM stop_times) AND parent_station IS NOT
+                    NULL)"""
+                )
+                self.assertEqual(c.fetchone()[0], 0)  # All used or parents
+                output.close()
+
+    def test_dump_sqlite(self):
+        """Test dump to a standalone GTFS-structured sqlite file."""
+
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP1542    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.stop_times(line="QOSTOP-REF00192315A  T1F1")
+        self.processor.output_format = "sqlite"
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "gtfs.sqlite")
+            self.assertEqual(self.processor.dump(filename=filename), 0)
+            output = sqlite3.connect(filename)
+            c = output.cursor()
+            c.execute(
+                """SELECT arrival_time, stop_id FROM stop_times WHERE
+                trip_id=?""",
+                (self.processor.trip_id,),
+            )
+            self.assertListEqual(c.fetchall(), [("23:15:00", "STOP-REF0019")])
+            c.execute(
+                """SELECT name FROM sqlite_master WHERE type=? AND
+                name=?""",
+                ("index", "stop_times_trip_id_stop_sequence"),
+            )
+            self.assertIsNotNone(c.fetchone())
+            output.close()
+
+    def test_diff(self):
+        """Test hash manifest comparison between runs."""
+
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP1542    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.stop_times(line="QOSTOP-REF00192315A  T1F1")
+        self.processor.stop_times(line="QTSTOP-REF00202330A  T1F1")
+        self.processor.calendar()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "manifest.json")
+            self.assertIsNone(self.processor.diff_changes(filename=filename))
+            self.assertEqual(self.processor.diff_save(filename=filename), 0)
+            changes = self.processor.diff_changes(filename=filename)
+            self.assertFalse(any(
+                keys for section in changes.values()
+                for keys in section.values()
+            ))
+
+            c = self.processor.db.cursor()
+            c.execute(
+                """UPDATE stop_times SET arrival_time=? WHERE trip_id=? AND
+                stop_sequence=?""",
+                ("23:31:00", self.processor.trip_id, 2),
+            )
+            changes = self.processor.diff_changes(filename=filename)
+            self.assertIn(
+                "OP15_101|1|101-42|STOP-REF0019|23:15:00",
+                changes["trips"]["modified"],
+            )
+            self.assertListEqual(changes["trips"]["added"], [])
+
+    def test_forget(self):
+        """Test removal of one file's trips and what only they used."""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name, operator, stop in [
+                ("a", "OP1", "0001"),
+                ("b", "OP2", "0002"),
+            ]:
+                with open(os.path.join(temp_dir, name), "w") as cif_file:
+                    cif_file.write("\n".join([
+                        "ATCO-CIF0500Test",
+                        "QPN{} Bus Company".format(operator),
+                        "QSN{} 00000120200101202001121111100  42  "
+                        "101-00BIGBUS  TC=10142I".format(operator),
+                        "QOSTOP-REF{}0615A  T1F1".format(stop),
+                        "QTSTOP-REF00030655A  T1F0",
+                    ]) + "\n")
+
+            self.processor.service = {}
+            self.processor.file(filename=os.path.join(temp_dir, "a"))
+            first_trip = self.processor.trip_id
+            self.processor.file(filename=os.path.join(temp_dir, "b"))
+
+        self.assertEqual(
+            self.processor.forget(first_trip=1, last_trip=first_trip), 1
+        )
+        c = self.processor.db.cursor()
+        c.execute("""SELECT agency_id FROM agency""")
+        self.assertListEqual(c.fetchall(), [("OP2",)])
+        c.execute("""SELECT route_id FROM routes""")
+        self.assertListEqual(c.fetchall(), [("OP2_42",)])
+        c.execute("""SELECT stop_id FROM stops ORDER BY stop_id""")
+        self.assertListEqual(
+            c.fetchall(), [("STOP-REF0002",), ("STOP-REF0003",)]
+        )
+        c.execute("""SELECT COUNT(*) FROM stop_times""")
+        self.assertEqual(c.fetchone()[0], 2)
+        c.execute("""SELECT COUNT(*) FROM calendar""")
+        self.assertEqual(c.fetchone()[0], 1)
+
+    def test_file_pipeline(self):
+        """Test pipelined file processing matches the serial path."""
+
+        lines = ["ATCO-CIF0500Test"]
+        for trip in range(300):
+            lines += [
+                "{}{:06d}{}{:02d}{}".format(
+                    "QSNOP1 ",
+                    trip,
+                    "20200101202001121111100  4",
+                    trip % 7,
+                    " 101-42BIGBUS  TC=10142I",
+                ),
+                "QNNote {}".format(trip % 3),
+                "QOSTOP-REF{:04d}0615A  T1F1".format(trip % 11),
+                "QISTOP-REF00200625{:02d}26B  T1F1".format(trip % 60),
+                "QTSTOP-REF00300655A  T1F0",
+            ]
+            if trip % 50 == 0:
+                lines.append("QRSTOP-REF0001074543    101-43BIGBUS  ")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "pipeline.cif")
+            with open(filename, "w") as cif_file:
+                cif_file.write("\n".join(lines) + "\n")
+
+            tables = []
+            for pipeline in [False, True]:
+                processor = atcocif()
+                processor.pipeline = pipeline
+                processor.service = {}
+                self.assertEqual(processor.file(filename=filename), 0)
+                self.assertIsNone(processor.writer)
+                tables.append(
+                    {
+                        table: list(rows)
+                        for table, rows in processor.iter_tables(order=True)
+                    }
+                )
+                del processor
+
+            self.assertEqual(len(tables[0]["stop_times"]), 918)
+            self.assertDictEqual(tables[0], tables[1])
+
+    def test_file_equivalence(self):
+        """Test the serial, pipeline, pattern store and spilled stop cache
+        paths (alone and together) write byte-identical GTFS."""
+
+        lines = ["ATCO-CIF0500Test"]
+        for stop in range(12):
+            lines += [
+                "QLNSTOP-REF{:04d}Stop {}".format(stop, stop),
+                "QBNSTOP-REF{:04d}{:8d}{:8d}".format(
+                    stop, 333448 + stop * 100, 373764 + stop * 50
+                ),
+            ]
+        for trip in range(120):
+            lines += [
+                "{}{:06d}{}{:02d}{}".format(
+                    "QSNOP1 ",
+                    trip,
+                    "20200101202001121111100  4",
+                    trip % 5,
+                    " 101-42BIGBUS  TC=10142I",
+                ),
+                "QOSTOP-REF{:04d}0615A  T1F1".format(trip % 12),
+                "QISTOP-REF{:04d}0625{:02d}26B  T1F1".format(
+                    (trip + 5) % 12, trip % 60
+                ),
+                "QTSTOP-REF{:04d}0655A  T1F0".format((trip + 7) % 12),
+            ]
+            if trip % 20 == 0:
+                lines.append("QRSTOP-REF{:04d}074543    101-43BIGBUS  ".format(
+                    trip % 12
+                ))
+
+        options = [
+            {},
+            {"pipeline": True},
+            {"pattern_store": True},
+            {"stop_cache_limit": 2},
+            {"pipeline": True, "pattern_store": True, "stop_cache_limit": 2},
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "equivalence.cif")
+            with open(filename, "w") as cif_file:
+                cif_file.write("\n".join(lines) + "\n")
+
+            outputs = []
+            for option in options:
+                with self.subTest(option=option):
+                    processor = atcocif()
+                    for key, value in option.items():
+                        setattr(processor, key, value)
+                    gtfs = os.path.join(temp_dir, "gtfs.zip")
+                    self.assertEqual(processor.file(filename=filename), 0)
+                    self.assertEqual(processor.dump(filename=gtfs), 0)
+                    with zipfile.ZipFile(gtfs) as archive:
+                        outputs.append({
+                            name: archive.read(name)
+                            for name in archive.namelist()
+                        })
+                    del processor
+                    self.assertDictEqual(outputs[-1], outputs[0])
+
+            self.assertGreater(len(outputs[0]["stop_times.txt"]), 0)
+            self.assertIn(b"STOP-REF0011", outputs[0]["stops.txt"])
+
+    def test_iter_table(self):
+        """Test lazy, ordered, named row iteration without any file."""
+
+        self.processor.journey(
+            line="{}{}".format(
+                "QSNOP1542    2020010120200112",
+                "1010100  101 101-42BIGBUS  TC=10142I"
+            )
+        )
+        self.processor.stop_times(line="QOSTOP-REF00192315A  T1F1")
+        self.processor.stop_times(line="QTSTOP-REF00202330A  T1F1")
+
+        rows = [
+            row for row in self.processor.iter_table(
+                table="stop_times", batch_size=1, order=True, named=True
+            ) if row.trip_id == self.processor.trip_id
+        ]
+        self.assertListEqual(
+            [(row.stop_sequence, row.stop_id) for row in rows],
+            [(1, "STOP-REF0019"), (2, "STOP-REF0020")],
+        )
+        self.assertEqual(rows[0].departure_time, "23:15:00")
+        c = self.processor.db.cursor()
+        c.execute(
+            """SELECT name FROM sqlite_master WHERE type=? AND name=?""",
+            ("index", "stop_times_trip_id_stop_sequence"),
+        )
+        self.assertIsNotNone(c.fetchone())
+        tables = dict(self.processor.iter_tables())
+        self.assertListEqual(
+            list(tables.keys()), list(self.processor._gtfs_structure.keys())
+        )
+        with self.assertRaises(ValueError):
+            self.processor.iter_table(table="shapes")  # Without iterating
+        with self.assertRaises(ValueError):
+            self.processor.iter_table(table="trips", order=("x",))
+
+    def columnar_source(self, temp_dir=""):
+        """@return filename of a test file, in @param temp_dir, whose last
+        journey runs past midnight (leaving a day_offset)."""
+
+        source = os.path.join(temp_dir, "source.cif")
+        with open(source, "w") as cif_file:
+            cif_file.write("\n".join([
+                "ATCO-CIF0500Test",
+                "QSNOP1 00000120200101202001121111100  42  "
+                "101-00BIGBUS  TC=10142I",
+                "QOSTOP-REF00010845A  T1F1",
+                "QTSTOP-REF00020915A  T1F0",
+                "QSNOP1 00000220200101202001121111100  42  "
+                "101-00BIGBUS  TC=10142I",
+                "QOSTOP-REF00012345A  T1F1",
+                "QTSTOP-REF00020015A  T1F0",  # Next day
+            ]) + "\n")
+        return source
+
+    def test_export_columnar_times(self):
+        """Test columnar times are read as stored, whatever day_offset the
+        last journey parsed left behind."""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertEqual(
+                self.processor.file(
+                    filename=self.columnar_source(temp_dir=temp_dir)
+                ),
+                0,
+            )
+
+        self.assertEqual(self.processor.day_offset, 1)
+        self.assertListEqual(
+            [
+                self.processor._gtfs_time_seconds(time_str=row[1])
+                for row in self.processor.iter_table(
+                    table="stop_times", order=True
+                )
+            ],
+            [31500, 33300, 85500, 87300],
+        )
+        self.assertEqual(
+            self.processor._gtfs_time_seconds(time_str="100:05:30"), 360330
+        )
+        self.assertIsNone(self.processor._gtfs_time_seconds(time_str="8:4x"))
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("pyarrow"), "Optional pyarrow missing"
+    )
+    def test_export_columnar(self):
+        """Test typed columnar export, read back as a Parquet table."""
+
+        import pyarrow.parquet
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertEqual(
+                self.processor.file(
+                    filename=self.columnar_source(temp_dir=temp_dir)
+                ),
+                0,
+            )  # Writes calendar at end of file
+            self.assertEqual(
+                self.processor.export_columnar(
+                    directory=temp_dir, batch_size=1
+                ),
+                0,
+            )
+            table = pyarrow.parquet.read_table(
+                os.path.join(temp_dir, "stop_times.parquet")
+            ).to_pydict()
+            self.assertListEqual(
+                sorted(table["arrival_time"]), [31500, 33300, 85500, 87300]
+            )  # Not a day later, despite ending past midnight
+            self.assertListEqual(
+                sorted(table["stop_id"]),
+                ["STOP-REF0001"] * 2 + ["STOP-REF0002"] * 2,
+            )
+            calendar = pyarrow.parquet.read_table(
+                os.path.join(temp_dir, "calendar.parquet")
+            ).to_pydict()
+            self.assertListEqual(
+                calendar["start_date"], [datetime.date(2020, 1, 1)]
+            )
+            self.assertListEqual(
+                calendar["end_date"], [datetime.date(2020, 1, 12)]
+            )
+
+    @unittest.skipIf(
+        importlib.util.find_spec("pyarrow"), "Optional pyarrow present"
+    )
+    def test_export_columnar_missing(self):
+        """Test columnar export declines without optional pyarrow."""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertEqual(
+                self.processor.export_columnar(directory=temp_dir), 1
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,25 @@
+import base64
+import bz2
+import gzip
+import http.server
+import io
+import json
+import logging
+import lzma
+import os
 import tempfile
+import threading
 import types
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+import zipfile
 
-from atcociftogtfs.loader import main
+from atcociftogtfs.atcocif import atcocif
+from atcociftogtfs.loader import (
+    arguments, convert, main, scan, service_handler, walk, watcher
+)
 
 
 class test_loader(unittest.TestCase):
@@ -25,6 +42,335 @@ class test_loader(unittest.TestCase):
 
                     self.assertEqual(main(args=args), 0)
 
+    def test_main_skip_unchanged(self):
+        """Test a rerun with unchanged data writes no output."""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w") as cif_file:
+                cif_file.write("ATCO-CIF0500")
+            gtfs = os.path.join(temp_dir, "gtfs.zip")
+            args = types.SimpleNamespace(
+                diff=os.path.join(temp_dir, "manifest.json"),
+                gtfs=gtfs,
+                log=os.path.join(temp_dir, "log.txt"),
+                skip_unchanged=True,
+                source=[source],
+            )
+
+            self.assertEqual(main(args=args), 0)
+            self.assertTrue(os.path.exists(gtfs))
+            os.remove(gtfs)
+            self.assertEqual(main(args=args), 0)
+            self.assertFalse(os.path.exists(gtfs))
+
+    def test_feeds(self):
+        """Test manifest feeds share parses, each with its own trips."""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name, operator in [("a.cif", "OP1"), ("b.cif", "OP2")]:
+                with open(os.path.join(temp_dir, name), "w") as cif_file:
+                    cif_file.write("\n".join([
+                        "ATCO-CIF0500Test",
+                        "QSN{} 00000120200101202001121111100  42  "
+                        "101-00BIGBUS  TC=10142I".format(operator),
+                        "QOSTOP-REF00010615A  T1F1",
+                        "QTSTOP-REF00020655A  T1F0",
+                    ]) + "\n")
+
+            def path(name):
+                return os.path.join(temp_dir, name)
+
+            manifest = path("feeds.json")
+            with open(manifest, "w") as manifest_file:
+                json.dump({"feeds": [
+                    {"args": [path("a.cif"), path("b.cif"), "-g", path("1")]},
+                    {"args": [path("b.cif"), "-g", path("2")]},
+                    {"args": [path("a.cif"), "-g", path("3"), "-m", "0"]},
+                ]}, manifest_file)
+
+            args = types.SimpleNamespace(
+                feeds=manifest, log=path("log.txt")
+            )
+            self.assertEqual(main(args=args), 0)
+
+            for feed, routes in [
+                ("1", [b"OP1_42,OP1,42,,3", b"OP2_42,OP2,42,,3"]),
+                ("2", [b"OP2_42,OP2,42,,3"]),
+                ("3", [b"OP1_42,OP1,42,,0"]),
+            ]:
+                with zipfile.ZipFile(path(feed)) as archive:
+                    self.assertEqual(
+                        sorted(
+                            archive.read("routes.txt").splitlines()[1:]
+                        ),
+                        routes,
+                    )
+                    self.assertEqual(
+                        len(archive.read("trips.txt").splitlines()),
+                        len(routes) + 1,
+                    )
+
+            with open(manifest, "w") as manifest_file:
+                json.dump(
+                    {"feeds": [{"args": ["-g", path("4")]}]}, manifest_file
+                )  # No sources
+            self.assertEqual(main(args=args), 1)
+
+    def test_scan(self):
+        """Test inventory of files and zip members, whole and in ranges."""
+
+        lines = [
+            "ATCO-CIF0500Test",
+            "QPNOP1 Big Bus Company",
+            "QSNOP1 000001202001012020011211111004",
+            "QOSTOP-REF00420615A  T1F1",
+            "QTSTOP-REF00430655A  T1F0",
+            "QRSTOP-REF0042074543",
+            "QSNOP2 000002201912019999999911111004",
+            "QOSTOP-REF00430715A  T1F1",
+            "QTSTOP-REF00440755A  T1F0",
+            "QLSTOP-REF0045Unused",
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w") as cif_file:
+                cif_file.write("\n".join(lines) + "\n")
+            archive = os.path.join(temp_dir, "source.zip")
+            with zipfile.ZipFile(archive, "w") as zip:
+                zip.write(source, arcname="member.cif")
+                zip.writestr("rail.cif", "HDTPS.UDFROC1.PD200101")
+
+            summary = scan(sources=[source, archive], workers=1)
+
+            self.assertEqual(
+                [file["status"] for file in summary["files"]],
+                [None, None, "Non-ATCO-CIF file, likely railway CIF"],
+            )
+            self.assertEqual(
+                summary["files"][1]["source"],
+                os.path.join(archive, "member.cif"),
+            )
+            self.assertDictEqual(
+                summary["files"][0]["records"],
+                {"QP": 1, "QS": 2, "QO": 2, "QT": 2, "QR": 1, "QL": 1},
+            )
+            self.assertEqual(summary["files"][0]["journeys"], 3)
+            self.assertEqual(summary["files"][0]["stops"], 4)
+            self.assertEqual(summary["files"][0]["operators"], 2)
+            self.assertEqual(summary["files"][0]["first_date"], "20191201")
+            self.assertEqual(summary["files"][0]["last_date"], "20200112")
+            self.assertEqual(summary["files"][0]["open_ended"], 1)
+            self.assertEqual(summary["total"]["files"], 3)
+            self.assertEqual(summary["total"]["valid"], 2)
+            self.assertEqual(summary["total"]["journeys"], 6)
+            self.assertEqual(summary["total"]["stops"], 4)
+
+            for chunk_size in [1, 30, 64, 100]:
+                ranges = scan(
+                    sources=[source], workers=1, chunk_size=chunk_size
+                )
+                self.assertEqual(ranges["files"][0], summary["files"][0])
+
+    def test_service(self):
+        """Test concurrent conversion jobs through the service."""
+
+        server = http.server.ThreadingHTTPServer(
+            ("localhost", 0), service_handler
+        )
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://localhost:{}/convert".format(server.server_address[1])
+        root = logging.getLogger()
+        levels = [root.level] + [other.level for other in root.handlers]
+
+        def post(job):
+            request = urllib.request.Request(
+                url, data=json.dumps(job).encode("utf-8")
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)
+
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                source = os.path.join(temp_dir, "source.cif")
+                with open(source, "w") as cif_file:
+                    cif_file.write("ATCO-CIF0500\nQPNOP1 Big Bus Company")
+
+                jobs = [
+                    {"args": [source, "-v"]},
+                    {"args": [source, "-m", "0"]},
+                ]
+                results = []
+                threads = [
+                    threading.Thread(
+                        target=lambda job: results.append(post(job)),
+                        args=(job,),
+                    )
+                    for job in jobs
+                ]
+                for job_thread in threads:
+                    job_thread.start()
+                for job_thread in threads:
+                    job_thread.join()
+
+                self.assertEqual(len(results), 2)
+                for result in results:
+                    self.assertEqual(result["status"], 0)
+                    archive = zipfile.ZipFile(
+                        io.BytesIO(base64.b64decode(result["gtfs"]))
+                    )
+                    self.assertIn("stop_times.txt", archive.namelist())
+                self.assertEqual(
+                    sorted(len(result["log"]) > 0 for result in results),
+                    [False, True],
+                )  # Only the verbose job logs info
+                self.assertListEqual(
+                    [root.level] + [other.level for other in root.handlers],
+                    levels,
+                )  # Restored after the jobs
+
+                with self.assertRaises(urllib.error.HTTPError):
+                    post({"args": "not a list"})
+                diff = os.path.join(temp_dir, "diff.json")
+                with self.assertRaises(urllib.error.HTTPError) as error:
+                    post({"args": [source, "--diff", diff]})
+                self.assertEqual(error.exception.code, 400)
+                self.assertFalse(os.path.exists(diff))  # Refused, unwritten
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_convert_threads(self):
+        """Test a service job's log includes its own worker threads."""
+
+        def fail(self, filename="", directory="", arcnames=[]):
+            logging.error("Failed %s", os.path.basename(filename))
+            return 1
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = os.path.join(temp_dir, "source.cif")
+            with open(source, "w") as cif_file:
+                cif_file.write("\n".join([
+                    "ATCO-CIF0500Test",
+                    "QSNOP1 00000120200101202001121111100  42  "
+                    "101-00BIGBUS  TC=10142I",
+                    "QOSTOP-REF00010615A  T1F1",
+                    "QTSTOP-REF00020655A  T1F0",
+                    "QSNOP2 00000220200101202001121111100  42  "
+                    "101-00BIGBUS  TC=10142I",
+                    "QOSTOP-REF00010715A  T1F1",
+                    "QTSTOP-REF00020755A  T1F0",
+                ]) + "\n")
+
+            with unittest.mock.patch.object(atcocif, "_dump_zip", fail):
+                result = convert(
+                    args=arguments(argv=[source, "--shard_agency"])
+                )
+
+        self.assertEqual(result["status"], 1)
+        self.assertListEqual(
+            sorted(result["log"]),
+            [
+                "ERROR:Failed gtfs.zip",
+                "ERROR:Failed gtfs_OP1.zip",
+                "ERROR:Failed gtfs_OP2.zip",
+            ],
+        )  # Logged by dump threads, not the job's thread
+        with self.assertRaises(ValueError):
+            convert(args=arguments(argv=[source, "--watch"]))
+
+    def test_watch(self):
+        """Test watch polling converts changed files only, once settled."""
+
+        def journey(operator):
+            return "\n".join([
+                "ATCO-CIF0500Test",
+                "QSN{} 00000120200101202001121111100  42  "
+                "101-00BIGBUS  TC=10142I".format(operator),
+                "QOSTOP-REF00010615A  T1F1",
+                "QTSTOP-REF00020655A  T1F0",
+            ]) + "\n"
+
+        def routes(gtfs):
+            with zipfile.ZipFile(gtfs) as archive:
+                with archive.open("routes.txt") as routes_file:
+                    return sorted(
+                        line.split(b",")[0]
+                        for line in routes_file.read().splitlines()[1:]
+                    )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name, operator in [("a.cif", "OP1"), ("b.cif", "OP2")]:
+                with open(os.path.join(temp_dir, name), "w") as cif_file:
+                    cif_file.write(journey(operator))
+            gtfs = os.path.join(temp_dir, "gtfs.zip")  # Among sources
+            args = types.SimpleNamespace(
+                gtfs=gtfs, output_format="zip", source=[temp_dir]
+            )
+            watch = watcher(args=args, settle=0)
+
+            self.assertEqual(watch.run(interval=0, cycles=2), 0)
+            self.assertEqual(routes(gtfs), [b"OP1_42", b"OP2_42"])
+            self.assertEqual(watch.poll(), [])  # Unchanged
+
+            with open(os.path.join(temp_dir, "b.cif"), "w") as cif_file:
+                cif_file.write(journey("OP3"))
+            watch.settle = 60
+            self.assertEqual(watch.poll(), [])  # Not yet settled
+            watch.settle = 0
+            self.assertEqual(
+                watch.poll(), [os.path.join(temp_dir, "b.cif")]
+            )
+            self.assertEqual(routes(gtfs), [b"OP1_42", b"OP3_42"])
+
+            os.remove(os.path.join(temp_dir, "a.cif"))
+            watch.poll()
+            self.assertEqual(routes(gtfs), [b"OP3_42"])
+            self.assertFalse(os.path.exists(gtfs + ".tmp"))
+
+    def test_walk_compressed(self):
+        """Test compressed files and zip members are streamed to parse."""
+
+        cif = "\n".join([
+            "ATCO-CIF0500Test",
+            "QSNOP1 00000120200101202001121111100  42  "
+            "101-00BIGBUS  TC=10142I",
+            "QOSTOP-REF00010615A  T1F1",
+            "QTSTOP-REF00020655A  T1F0",
+        ]).encode("ascii") + b"\n"
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sources = {
+                "plain.cif": cif,
+                "gzip.cif.gz": gzip.compress(cif),
+                "bzip2.cif.bz2": bz2.compress(cif),
+                "xz.cif.xz": lzma.compress(cif),
+                "nested.cif.gz.xz": lzma.compress(gzip.compress(cif)),
+            }
+            for name, data in sources.items():
+                with open(os.path.join(temp_dir, name), "wb") as source:
+                    source.write(data)
+            with zipfile.ZipFile(os.path.join(temp_dir, "a.zip"), "w") as zip:
+                zip.writestr("member.cif.gz", gzip.compress(cif))
+                zip.writestr("folder/member.cif", cif)
+            sources["a.zip"] = None
+
+            for name in sources:
+                processor = atcocif()
+                processor = walk(
+                    source=os.path.join(temp_dir, name), processor=processor
+                )
+                self.assertEqual(
+                    processor.trip_id, 2 if name == "a.zip" else 1, name
+                )
+                c = processor.db.cursor()
+                c.execute("""SELECT COUNT(*) FROM stop_times""")
+                self.assertEqual(c.fetchone()[0], processor.trip_id * 2)
+                del processor
+
 
 if __name__ == "__main__":
     unittest.main()
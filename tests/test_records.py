@@ -0,0 +1,70 @@
+import tracemalloc
+import unittest
+
+from atcociftogtfs.records import service_record, stop_record
+
+
+class test_records(unittest.TestCase):
+    """Test records (compact per-file cache entries)."""
+
+    def test_stop_record(self):
+        """Test dict-like access to a slotted record."""
+
+        stop = stop_record(name="Town Square")
+        stop["easting"] = "333448"
+        self.assertIn("name", stop)
+        self.assertNotIn("northing", stop)
+        self.assertEqual(stop.get("northing", "0"), "0")
+        self.assertDictEqual(
+            stop.as_dict(), {"name": "Town Square", "easting": "333448"}
+        )
+        with self.assertRaises(KeyError):
+            stop["northing"]
+        with self.assertRaises(KeyError):
+            stop["stop_lat"] = 0
+
+    def test_service_record(self):
+        """Test packed calendars unpack to their original lists."""
+
+        calendar = [1, 0, 1, 0, 1, 0, 0, "20200101", "20200112"]
+        calendar_dates = [["20200103", 2], ["20200104", 1]]
+        service = service_record()
+        self.assertNotIn("calendar", service)
+        service["calendar"] = calendar
+        service["calendar_dates"] = calendar_dates
+        self.assertListEqual(service["calendar"], calendar)
+        self.assertListEqual(service["calendar_dates"], calendar_dates)
+
+        malformed = [0] * 7 + [" " * 8] * 2
+        service["calendar"] = malformed
+        self.assertListEqual(service["calendar"], malformed)
+
+    def test_service_record_memory(self):
+        """Test records use less memory than the equivalent dicts."""
+
+        def allocated(make):
+            tracemalloc.start()
+            cache = {trip_id: make(trip_id) for trip_id in range(2000)}
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del cache
+            return size
+
+        def service_dict(trip_id):
+            return {
+                "calendar": [1, 1, 1, 1, 1, 0, 0, "20200101", "20201231"],
+                "calendar_dates": [
+                    ["202001{:02d}".format(day), 2] for day in range(1, 9)
+                ],
+            }
+
+        def service_compact(trip_id):
+            return service_record(**service_dict(trip_id))
+
+        self.assertLess(
+            allocated(service_compact), allocated(service_dict) * 0.6
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
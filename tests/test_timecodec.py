@@ -0,0 +1,25 @@
+import unittest
+
+from atcociftogtfs import timecodec
+
+
+class test_timecodec(unittest.TestCase):
+    """Test timecodec (time lookup tables)."""
+
+    def test_tables(self):
+        """Test every 2-digit hour and minute round trips."""
+
+        self.assertEqual(len(timecodec.atco_tuples), 10000)
+
+        for atco_str, time_tuple in timecodec.atco_tuples.items():
+            gtfs_str = timecodec.gtfs_strings[time_tuple]
+            self.assertEqual(gtfs_str[:2] + gtfs_str[3:5], atco_str)
+            self.assertEqual(timecodec.gtfs_tuples[gtfs_str[:5]], time_tuple)
+
+        self.assertEqual(timecodec.atco_tuples["2315"], (23, 15))
+        self.assertEqual(timecodec.gtfs_strings[(24, 25)], "24:25:00")
+        self.assertNotIn("23AB", timecodec.atco_tuples)
+
+
+if __name__ == "__main__":
+    unittest.main()